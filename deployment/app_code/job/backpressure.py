@@ -0,0 +1,170 @@
+"""Adaptive micro-batch sizing for the Kafka streaming jobs.
+
+BackpressureController reads each StreamingQueryProgress (as a dict) and proposes the
+maxOffsetsPerTrigger cap and trigger interval that hold a target batch duration.
+Both options are fixed when a query starts, so msk_consumer.py applies a new setting by
+restarting the query from its checkpoint. The controller only asks for that when the
+cap moves by more than `hysteresis`, and at most every `min_batches` batches.
+
+`python3 backpressure.py` runs a local simulation under bursty input and a startup backlog.
+"""
+import argparse
+import json
+import math
+import random
+
+class BackpressureController:
+
+  def __init__(self, target_seconds, initial_cap=100000, min_cap=1000, max_cap=10000000,
+      smoothing=0.5, max_step=2.0, hysteresis=0.25, min_batches=3):
+    self.target_seconds = target_seconds
+    self.min_cap = min_cap
+    self.max_cap = max_cap
+    self.smoothing = smoothing
+    self.max_step = max_step
+    self.hysteresis = hysteresis
+    self.min_batches = min_batches
+    self.cap = initial_cap
+    self.trigger_seconds = 0
+    self.rate = None
+    self.behind = None
+    self.restarts = 0
+    self._batches_since_change = 0
+
+  def observe(self, rows, duration_seconds, behind=None):
+    """Update the estimates from one batch. behind is the offsets still waiting in Kafka, if known."""
+    self.behind = behind
+    self._batches_since_change += 1
+    # only batches filled up to the cap measure what the cluster can do, smaller ones
+    # just mean there was nothing more to read. rows / duration includes the fixed
+    # per-batch overhead, so cap = rate * target converges to the cap that takes target seconds.
+    if rows < 0.9 * self.cap or duration_seconds <= 0:
+      return
+    rate = rows / duration_seconds
+    self.rate = rate if self.rate is None else self.smoothing * rate + (1 - self.smoothing) * self.rate
+
+  def proposal(self):
+    """(cap, trigger_seconds) that would hold the target duration with the current estimates."""
+    if self.rate is None:
+      return self.cap, self.trigger_seconds
+    cap = self.rate * self.target_seconds
+    cap = min(max(cap, self.cap / self.max_step, self.min_cap), self.cap * self.max_step, self.max_cap)
+    # while catching up run batches back to back, once caught up trigger on the target period.
+    # the band between half and two batches behind keeps the current trigger to avoid flapping
+    trigger = self.trigger_seconds
+    if self.behind is not None and self.behind < 0.5 * cap:
+      trigger = self.target_seconds
+    elif self.behind is None or self.behind > 2 * cap:
+      trigger = 0
+    return int(cap), trigger
+
+  def update(self, progress):
+    """Observe one progress dict, return the new (cap, trigger_seconds) if the query should be restarted."""
+    behind = None
+    for source in progress.get("sources", []):
+      lag = offsets_behind(source)
+      if lag is not None:
+        behind = (behind or 0) + lag
+    self.observe(progress["numInputRows"], progress["durationMs"].get("triggerExecution", 0) / 1000.0, behind)
+    return self.decide()
+
+  def decide(self):
+    if self._batches_since_change < self.min_batches:
+      return None
+    cap, trigger = self.proposal()
+    # a new trigger interval alone isn't worth a restart, it rides along with the next cap change
+    if abs(cap - self.cap) <= self.hysteresis * self.cap:
+      return None
+    self.cap, self.trigger_seconds = cap, trigger
+    self._batches_since_change = 0
+    self.restarts += 1
+    return cap, trigger
+
+def _partition_offsets(offsets):
+  # {"topic": {"0": 1200, ...}}, a JSON string in some progress reports
+  if isinstance(offsets, str):
+    try:
+      offsets = json.loads(offsets)
+    except ValueError:
+      return None
+  if not isinstance(offsets, dict):
+    return None
+  return {(topic, p): int(o) for topic, partitions in offsets.items() if isinstance(partitions, dict)
+    for p, o in partitions.items()}
+
+def offsets_behind(source):
+  """Offsets of a Kafka source still waiting after the batch, summed over all partitions. None if unknown.
+
+  maxOffsetsBehindLatest is the lag of the worst partition only, maxOffsetsPerTrigger caps
+  the offsets of all partitions together, so the total comes from latestOffset - endOffset,
+  or else from the average lag times the partition count.
+  """
+  end, latest = _partition_offsets(source.get("endOffset")), _partition_offsets(source.get("latestOffset"))
+  if end and latest:
+    return float(sum(max(0, latest[key] - offset) for key, offset in end.items() if key in latest))
+  average = source.get("metrics", {}).get("avgOffsetsBehindLatest")
+  if average is not None and end:
+    return float(average) * len(end)
+  return None
+
+def bursty_rate(t, base, burst, period, burst_seconds):
+  return burst if t % period < burst_seconds else base
+
+def simulate(target_seconds=10.0, capacity=40000, overhead=2.0, base=5000, burst=60000, period=120,
+    burst_seconds=30, backlog=3000000, restart_seconds=15.0, duration=1800, controlled=True, initial_cap=None,
+    noise=0.0, seed=None):
+  """Simulate batches of a consumer processing `capacity` rows/sec with `overhead` seconds per batch.
+
+  Input arrives at `base` rows/sec with bursts of `burst` rows/sec, starting with `backlog` rows
+  queued as after a restart. Each batch takes up to `noise` (a fraction) longer or shorter, drawn
+  from a generator seeded with `seed`. Returns one dict per batch and the number of query restarts.
+  """
+  rng = random.Random(seed)
+  controller = BackpressureController(target_seconds, initial_cap=initial_cap or 100000)
+  cap = controller.cap if controlled else math.inf
+  trigger, t, batches = 0, 0.0, []
+  while t < duration:
+    rows = min(backlog, cap)
+    batch_seconds = (overhead + rows / capacity) * (rng.uniform(1 - noise, 1 + noise) if noise else 1)
+    backlog -= rows
+    elapsed = max(batch_seconds, trigger)
+    for second in range(int(t), int(t + elapsed)):
+      backlog += bursty_rate(second, base, burst, period, burst_seconds)
+    t += elapsed
+    batches.append({"t": round(t, 1), "rows": int(rows), "seconds": round(batch_seconds, 2),
+      "backlog": int(backlog), "cap": cap, "trigger": trigger})
+    if controlled:
+      controller.observe(rows, batch_seconds, backlog)
+      decision = controller.decide()
+      if decision:
+        cap, trigger = decision
+        t += restart_seconds
+  return batches, controller.restarts if controlled else 0
+
+def summarize(batches, target_seconds, tail=0.5):
+  steady = batches[int(len(batches) * (1 - tail)):]
+  seconds = sorted(b["seconds"] for b in steady)
+  return {"batches": len(batches), "max_seconds": max(b["seconds"] for b in batches),
+    "steady_p50_seconds": seconds[len(seconds) // 2], "steady_p99_seconds": seconds[int(len(seconds) * 0.99)],
+    "steady_within_2x_target": sum(1 for s in seconds if s <= 2 * target_seconds) / len(seconds),
+    "final_backlog": batches[-1]["backlog"]}
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Simulate the backpressure controller under bursty input")
+  parser.add_argument("--target-seconds", type=float, default=10.0)
+  parser.add_argument("--capacity", type=int, default=40000, help="rows/sec the simulated cluster processes")
+  parser.add_argument("--backlog", type=int, default=3000000, help="rows queued at startup")
+  parser.add_argument("--duration", type=int, default=1800, help="simulated seconds")
+  parser.add_argument("--noise", type=float, default=0.0, help="batch duration jitter, e.g. 0.1 for +-10%%")
+  parser.add_argument("--seed", type=int, help="seed of the batch duration jitter")
+  parser.add_argument("--trace", action="store_true", help="print every controlled batch")
+  args = parser.parse_args()
+
+  for controlled in (False, True):
+    batches, restarts = simulate(args.target_seconds, args.capacity, backlog=args.backlog, duration=args.duration,
+      controlled=controlled, noise=args.noise, seed=args.seed)
+    if args.trace and controlled:
+      for b in batches:
+        print(b)
+    print("{:<12}{}".format("controlled" if controlled else "uncapped",
+      dict(summarize(batches, args.target_seconds), restarts=restarts)))
@@ -0,0 +1,124 @@
+"""Map taxi ride coordinates to grid cells and zones for msk_consumer.py.
+
+Coordinates become cells of a fixed lat/lon grid with column arithmetic, and cells become
+zones through a small precomputed cell -> zone index that Spark broadcasts to every task.
+No Python runs per row in the query, the point-in-polygon tests only run once per cell
+when the index is built.
+
+Zones come from a GeoJSON FeatureCollection of (Multi)Polygons, e.g. the NYC TLC taxi
+zones with their "zone" property. Without one, every grid cell is its own zone.
+pyspark is only imported by the functions building Spark expressions.
+"""
+import json
+import math
+
+# min lon, min lat, max lon, max lat around the five boroughs
+NYC_BOUNDS = (-74.30, 40.48, -73.65, 40.95)
+
+class Grid:
+  """Fixed grid of `cell_degrees` square cells over bounds, numbered row by row from the south west corner."""
+
+  def __init__(self, bounds=NYC_BOUNDS, cell_degrees=0.005):
+    self.min_lon, self.min_lat, self.max_lon, self.max_lat = bounds
+    self.cell_degrees = cell_degrees
+    self.columns = int(math.ceil((self.max_lon - self.min_lon) / cell_degrees))
+    self.rows = int(math.ceil((self.max_lat - self.min_lat) / cell_degrees))
+
+  @property
+  def cells(self):
+    return self.columns * self.rows
+
+  def cell(self, lon, lat):
+    """Cell id of a point, None outside the bounds."""
+    if not (self.min_lon <= lon < self.max_lon and self.min_lat <= lat < self.max_lat):
+      return None
+    x = int((lon - self.min_lon) / self.cell_degrees)
+    y = int((lat - self.min_lat) / self.cell_degrees)
+    return y * self.columns + x
+
+  def center(self, cell):
+    y, x = divmod(cell, self.columns)
+    return (self.min_lon + (x + 0.5) * self.cell_degrees, self.min_lat + (y + 0.5) * self.cell_degrees)
+
+  def cell_column(self, lon, lat):
+    """Spark expression of cell() over two column names, null outside the bounds."""
+    from pyspark.sql.functions import col, floor, when
+    lon, lat = col(lon), col(lat)
+    inside = (lon >= self.min_lon) & (lon < self.max_lon) & (lat >= self.min_lat) & (lat < self.max_lat)
+    x = floor((lon - self.min_lon) / self.cell_degrees)
+    y = floor((lat - self.min_lat) / self.cell_degrees)
+    return when(inside, y * self.columns + x).cast("long")
+
+def _in_ring(x, y, ring):
+  # ray casting, ring is a list of [lon, lat] with the first point repeated at the end
+  inside = False
+  for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+    if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+      inside = not inside
+  return inside
+
+def _in_polygon(x, y, polygon):
+  # the first ring is the outline, the others are holes
+  return _in_ring(x, y, polygon[0]) and not any(_in_ring(x, y, hole) for hole in polygon[1:])
+
+class Zones:
+  """Named (multi)polygons with bounding boxes to skip most of the point-in-polygon tests."""
+
+  def __init__(self, zones):
+    self.zones = []
+    for name, polygons in zones:
+      points = [p for polygon in polygons for p in polygon[0]]
+      bbox = (min(p[0] for p in points), min(p[1] for p in points),
+        max(p[0] for p in points), max(p[1] for p in points))
+      self.zones.append((name, bbox, polygons))
+
+  def zone_at(self, lon, lat):
+    for name, (x1, y1, x2, y2), polygons in self.zones:
+      if x1 <= lon <= x2 and y1 <= lat <= y2 and any(_in_polygon(lon, lat, p) for p in polygons):
+        return name
+    return None
+
+def load_zones(text, name_property="zone"):
+  """Zones of a GeoJSON FeatureCollection document, named by the given feature property."""
+  zones = []
+  for feature in json.loads(text)["features"]:
+    geometry = feature["geometry"]
+    polygons = geometry["coordinates"] if geometry["type"] == "MultiPolygon" else [geometry["coordinates"]]
+    zones.append((str(feature["properties"][name_property]), polygons))
+  return Zones(zones)
+
+def rectangle_zones(bounds=NYC_BOUNDS, n=8):
+  """n x n rectangular zones over bounds, a stand-in when no zone file is at hand."""
+  min_lon, min_lat, max_lon, max_lat = bounds
+  dx, dy = (max_lon - min_lon) / n, (max_lat - min_lat) / n
+  zones = []
+  for j in range(n):
+    for i in range(n):
+      x1, y1 = min_lon + i * dx, min_lat + j * dy
+      ring = [[x1, y1], [x1 + dx, y1], [x1 + dx, y1 + dy], [x1, y1 + dy], [x1, y1]]
+      zones.append(("zone-{}-{}".format(i, j), [[ring]]))
+  return Zones(zones)
+
+def build_cell_index(grid, zones=None):
+  """{cell: zone} by the zone containing each cell center, every cell is a zone of its own without zones."""
+  if zones is None:
+    return {cell: "cell-{}".format(cell) for cell in range(grid.cells)}
+  index = {}
+  for cell in range(grid.cells):
+    zone = zones.zone_at(*grid.center(cell))
+    if zone is not None:
+      index[cell] = zone
+  return index
+
+def cell_index_frame(spark, index):
+  return spark.createDataFrame(sorted(index.items()), "cell long, zone string")
+
+def enrich(rides, grid, index_frame):
+  """Add startCell/endCell and startZone/endZone to rides, looking zones up in the broadcast index."""
+  from pyspark.sql.functions import broadcast, col
+  def lookup(prefix):
+    return broadcast(index_frame.select(col("cell").alias(prefix + "Cell"), col("zone").alias(prefix + "Zone")))
+  return rides.withColumn("startCell", grid.cell_column("startLon", "startLat")) \
+              .withColumn("endCell", grid.cell_column("endLon", "endLat")) \
+              .join(lookup("start"), "startCell", "left") \
+              .join(lookup("end"), "endCell", "left")
@@ -0,0 +1,86 @@
+"""Decoding of the pyspark-kinesis JSON messages, and a local-mode microbenchmark of the options.
+
+  record     json.loads + json.dumps per record in a lambda, the original format_sample
+  partition  one decoder per partition via mapPartitions, the raw JSON is kept instead of
+             being serialized again, malformed records get a None message type
+  dataframe  the whole batch goes to the JVM JSON reader with a fixed schema
+
+  spark-submit --master 'local[1]' --py-files kinesis_writer.py kinesis_decode.py --records 500000
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import time
+
+MESSAGE_DDL = 'message_type STRING, count INT'
+MODES = ['record', 'partition', 'dataframe']
+
+
+def format_sample(x):
+    data = json.loads(x)
+    return (data['message_type'], json.dumps(data))
+
+
+def parse_partition(records):
+    """(message_type, raw JSON) for a whole partition, message_type is None for a malformed record."""
+    decode = json.JSONDecoder().decode
+    for record in records:
+        try:
+            yield decode(record).get('message_type'), record
+        except (ValueError, AttributeError):
+            yield None, record
+
+
+def decode_dataframe(spark, rdd):
+    """Parse an RDD of JSON strings in the JVM with the fixed message schema."""
+    return spark.read.schema(MESSAGE_DDL).option('mode', 'PERMISSIVE').json(rdd)
+
+
+def decode(rdd, mode, spark=None):
+    """Decode one batch, an RDD of (message_type, raw JSON) or a DataFrame for mode 'dataframe'."""
+    if mode == 'record':
+        return rdd.map(format_sample)
+    if mode == 'partition':
+        return rdd.mapPartitions(parse_partition)
+    if mode == 'dataframe':
+        return decode_dataframe(spark, rdd)
+    raise ValueError("unknown decode mode {!r}, choose from {}".format(mode, MODES))
+
+
+def message_type_counts(decoded):
+    # the same aggregate for every mode, so nothing gets pruned away and the work is comparable
+    if hasattr(decoded, 'schema'):
+        return {row[0]: row[1] for row in decoded.groupBy('message_type').count().collect()}
+    return dict(decoded.map(lambda kv: (kv[0], 1)).reduceByKey(lambda a, b: a + b).collect())
+
+
+if __name__ == "__main__":
+    from pyspark.sql import SparkSession
+    import kinesis_writer
+
+    parser = argparse.ArgumentParser(description="Records/sec per core of the Kinesis JSON decoding options")
+    parser.add_argument('--records', type=int, default=500000)
+    parser.add_argument('--record-bytes', type=int, default=200)
+    parser.add_argument('--partitions', type=int, default=8)
+    parser.add_argument('--runs', type=int, default=3, help="best of")
+    parser.add_argument('--modes', default=','.join(MODES))
+    args = parser.parse_args()
+
+    spark = SparkSession.builder.appName('KinesisDecodeBenchmark').getOrCreate()
+    sc = spark.sparkContext
+    cores = sc.defaultParallelism
+    rdd = sc.parallelize([data for data, _ in kinesis_writer.generate_records(args.records, args.record_bytes)],
+                         args.partitions).cache()
+    rdd.count()
+
+    for mode in args.modes.split(','):
+        best = None
+        for _ in range(args.runs):
+            start = time.time()
+            counts = message_type_counts(decode(rdd, mode, spark))
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        assert sum(counts.values()) == args.records, counts
+        print(json.dumps({'mode': mode, 'records': args.records, 'cores': cores, 'seconds': round(best, 3),
+                          'records_per_sec_per_core': round(args.records / best / cores)}))
@@ -0,0 +1,228 @@
+"""Batched, shard-parallel Kinesis writer for the Kinesis demo jobs and load tests.
+
+Records are packed into put_records calls of up to 500 entries and 5 MB, grouped by the shard
+their partition key hashes to, and each shard's calls are sent from its own worker so a
+throttled shard doesn't hold up the others. Only the entries a call reports as failed are
+retried, with full-jitter exponential backoff.
+
+As a load generator, against AWS or a local stand-in such as `moto_server -p 4567`:
+
+  python3 kinesis_writer.py us-east-1 pyspark-kinesis --records 200000 --record-bytes 200 \\
+      --target-records-per-sec 5000 --endpoint-url http://localhost:4567
+"""
+from __future__ import print_function
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import bisect
+import hashlib
+import json
+import math
+import random
+import time
+
+MAX_RECORDS_PER_CALL = 500
+MAX_BYTES_PER_CALL = 5 * 1024 * 1024
+MAX_RECORD_BYTES = 1024 * 1024
+# provisioned shard write limits
+SHARD_BYTES_PER_SEC = 1024 * 1024
+SHARD_RECORDS_PER_SEC = 1000
+
+
+def make_client(region, endpoint_url=None):
+    import boto3
+    return boto3.client('kinesis', region, endpoint_url=endpoint_url)
+
+
+def shard_count_for(records_per_sec, avg_record_bytes=1024, headroom=1.25):
+    """Shards needed to absorb a target write rate, with some headroom for key skew."""
+    by_records = records_per_sec / float(SHARD_RECORDS_PER_SEC)
+    by_bytes = records_per_sec * avg_record_bytes / float(SHARD_BYTES_PER_SEC)
+    return max(1, int(math.ceil(max(by_records, by_bytes) * headroom)))
+
+
+def ensure_stream(client, stream_name, shard_count=1):
+    """Create the stream if needed and wait until it's active. Returns its open shard count."""
+    try:
+        print("create a new stream")
+        client.create_stream(StreamName=stream_name, ShardCount=shard_count)
+    except client.exceptions.ResourceInUseException:
+        print("the stream exists")
+    client.get_waiter('stream_exists').wait(StreamName=stream_name)
+    return len(list_open_shards(client, stream_name))
+
+
+def list_open_shards(client, stream_name):
+    shards, kwargs = [], {'StreamName': stream_name}
+    while True:
+        response = client.list_shards(**kwargs)
+        shards += [s for s in response['Shards'] if 'EndingSequenceNumber' not in s['SequenceNumberRange']]
+        if not response.get('NextToken'):
+            return shards
+        kwargs = {'NextToken': response['NextToken']}
+
+
+def latest_sequence_numbers(client, stream_name, lookbacks=(10, 60, 600, 3600, 86400), clock=time.time):
+    """{shard id: sequence number of its last record} of the open shards, e.g. the end of a backlog to drain.
+
+    Kinesis has no call for the tip of a shard, so each shard is read from `lookback` seconds
+    back until it's no longer behind, widening the lookback while that finds no record. Shards
+    without a record in the retention are left out.
+    """
+    latest = {}
+    now = clock()
+    for shard in list_open_shards(client, stream_name):
+        for lookback in lookbacks:
+            iterator = client.get_shard_iterator(StreamName=stream_name, ShardId=shard['ShardId'],
+                ShardIteratorType='AT_TIMESTAMP', Timestamp=now - lookback)['ShardIterator']
+            while iterator:
+                response = client.get_records(ShardIterator=iterator, Limit=10000)
+                if response['Records']:
+                    latest[shard['ShardId']] = response['Records'][-1]['SequenceNumber']
+                if not response.get('MillisBehindLatest'):
+                    break
+                iterator = response.get('NextShardIterator')
+            if shard['ShardId'] in latest:
+                break
+    return latest
+
+
+class ShardMap(object):
+    """Maps a partition key to its shard like Kinesis does, via the MD5 hash key ranges."""
+
+    def __init__(self, shards):
+        if not shards:
+            raise ValueError("no open shards to route to, is the stream still CREATING or UPDATING?")
+        ranges = sorted((int(s['HashKeyRange']['StartingHashKey']), int(s['HashKeyRange']['EndingHashKey']),
+                         s['ShardId']) for s in shards)
+        self.starts = [r[0] for r in ranges]
+        self.ranges = ranges
+
+    def shard_for(self, partition_key):
+        hash_key = int(hashlib.md5(partition_key.encode('utf8')).hexdigest(), 16)
+        return self.ranges[max(0, bisect.bisect_right(self.starts, hash_key) - 1)][2]
+
+
+def pack(entries):
+    """Split put_records entries into calls that respect the count and payload limits."""
+    batch, size = [], 0
+    for entry in entries:
+        entry_size = len(entry['Data']) + len(entry['PartitionKey'].encode('utf8'))
+        if entry_size > MAX_RECORD_BYTES:
+            raise ValueError("record of {} bytes exceeds the 1 MB Kinesis limit".format(entry_size))
+        if batch and (len(batch) == MAX_RECORDS_PER_CALL or size + entry_size > MAX_BYTES_PER_CALL):
+            yield batch
+            batch, size = [], 0
+        batch.append(entry)
+        size += entry_size
+    if batch:
+        yield batch
+
+
+class KinesisWriter(object):
+
+    def __init__(self, client, stream_name, max_workers=8, max_retries=8, base_delay=0.1, max_delay=5.0,
+                 shard_aware=True, sleep=time.sleep, rand=random.uniform):
+        self.client = client
+        self.stream_name = stream_name
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._sleep = sleep
+        self._rand = rand
+        self._shard_map = ShardMap(self._open_shards()) if shard_aware else None
+
+    def _open_shards(self):
+        shards = list_open_shards(self.client, self.stream_name)
+        if not shards:
+            # a stream being created has no shards yet, they are there once it's ACTIVE
+            self.client.get_waiter('stream_exists').wait(StreamName=self.stream_name)
+            shards = list_open_shards(self.client, self.stream_name)
+        return shards
+
+    def _backoff(self, attempt):
+        # full jitter: anywhere between 0 and the exponential cap
+        return self._rand(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _send(self, batch):
+        """put_records with retries of the failed entries only. Returns (calls, retried, failed entries)."""
+        calls = retried = 0
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._sleep(self._backoff(attempt - 1))
+            calls += 1
+            try:
+                response = self.client.put_records(StreamName=self.stream_name, Records=batch)
+            except self.client.exceptions.ProvisionedThroughputExceededException:
+                retried += len(batch)
+                continue
+            if not response.get('FailedRecordCount'):
+                return calls, retried, []
+            batch = [entry for entry, result in zip(batch, response['Records']) if 'ErrorCode' in result]
+            retried += len(batch)
+        return calls, retried, batch
+
+    def _send_all(self, batches):
+        stats = {'calls': 0, 'retried': 0, 'failed': []}
+        for batch in batches:
+            calls, retried, failed = self._send(batch)
+            stats['calls'] += calls
+            stats['retried'] += retried
+            stats['failed'] += failed
+        return stats
+
+    def put(self, records):
+        """Write (data, partition_key) pairs, data as bytes or str. Returns throughput stats."""
+        start = time.time()
+        groups, count, size = {}, 0, 0
+        for data, partition_key in records:
+            data = data.encode('utf8') if not isinstance(data, bytes) else data
+            shard = self._shard_map.shard_for(partition_key) if self._shard_map else count % self.max_workers
+            groups.setdefault(shard, []).append({'Data': data, 'PartitionKey': partition_key})
+            count += 1
+            size += len(data)
+
+        stats = {'records': count, 'bytes': size, 'calls': 0, 'retried': 0, 'failed': []}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for result in pool.map(lambda entries: self._send_all(pack(entries)), groups.values()):
+                for key in ('calls', 'retried', 'failed'):
+                    stats[key] += result[key]
+        stats['seconds'] = time.time() - start
+        stats['records_per_sec'] = count / max(stats['seconds'], 1e-9)
+        return stats
+
+
+def generate_records(count, record_bytes, keys=1000):
+    padding = 'x' * max(0, record_bytes - 60)
+    for i in range(count):
+        yield json.dumps({'message_type': 'message{}'.format(i % 3 + 1), 'count': i, 'pad': padding}), str(i % keys)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test a Kinesis stream with batched put_records")
+    parser.add_argument('region')
+    parser.add_argument('stream_name')
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--record-bytes', type=int, default=200)
+    parser.add_argument('--target-records-per-sec', type=int, default=1000, help="sizes the stream if it's created")
+    parser.add_argument('--chunk', type=int, default=50000, help="records handed to the writer per put()")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--endpoint-url', help="local Kinesis stand-in, e.g. moto_server or localstack")
+    args = parser.parse_args()
+
+    client = make_client(args.region, args.endpoint_url)
+    shards = ensure_stream(client, args.stream_name,
+                           shard_count_for(args.target_records_per_sec, args.record_bytes))
+    writer = KinesisWriter(client, args.stream_name, max_workers=args.workers)
+    records = generate_records(args.records, args.record_bytes)
+    total = {'records': 0, 'calls': 0, 'retried': 0, 'failed': 0, 'seconds': 0.0}
+    while total['records'] < args.records:
+        chunk = [r for _, r in zip(range(args.chunk), records)]
+        stats = writer.put(chunk)
+        for key in ('records', 'calls', 'retried', 'seconds'):
+            total[key] += stats[key]
+        total['failed'] += len(stats['failed'])
+        print("shards={} records={} calls={} retried={} failed={} rate={:,.0f} rec/s".format(
+            shards, total['records'], total['calls'], total['retried'], total['failed'],
+            total['records'] / max(total['seconds'], 1e-9)))
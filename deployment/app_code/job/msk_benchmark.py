@@ -0,0 +1,579 @@
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import col, lit, when, split, format_string, current_timestamp, window, expr, rand, pow, \
+  floor, pmod, udf
+from msk_consumer import taxiRidesSchema, parse_data_from_kafka_message, driver_window_counts, driver_pane_counts, \
+  driver_early_counts, driver_salted_counts, detect_hot_keys, driver_revenue, configure_state_store, state_metrics, \
+  progress_dicts, kafka_sink_options
+import urllib.request as request
+import taxi_codec
+import geo_grid
+import argparse
+import itertools
+import json
+import time
+
+# local-mode benchmarks for msk_consumer, no Kafka broker needed
+# usage: spark-submit --py-files msk_consumer.py,taxi_codec.py,backpressure.py,stream_metrics.py,geo_grid.py msk_benchmark.py \
+#   {parse,codecs,streaming,state,pane,early,skew,join,geo,sink} [options]
+# the avro/protobuf codecs need --packages org.apache.spark:spark-avro_2.12:<ver>,org.apache.spark:spark-protobuf_2.12:<ver>
+
+SAMPLE_RIDE = "{},START,2013-01-01 00:00:00,1970-01-01 00:00:00,-73.866135,40.77109,-73.961334,40.764563,6,{},{}"
+
+def generate_ride_lines(spark, rows, drivers=10000, malformed_every=1000):
+  # one malformed row every malformed_every rows, to exercise the side output
+  return spark.range(rows).select(
+    when(col("id") % malformed_every == 0, lit("not,a,ride"))
+    .otherwise(format_string(SAMPLE_RIDE, col("id"), col("id") % drivers, col("id") % drivers))
+    .alias("value")).cache()
+
+def parse_split_per_column(sdf, schema):
+  # the pre-from_csv parser: one withColumn projection per field, re-splitting the value each time
+  col = split(sdf['value'], ',')
+  for idx, field in enumerate(schema):
+      sdf = sdf.withColumn(field.name, col.getItem(idx).cast(field.dataType))
+      if field.name=="timestamp":
+          sdf = sdf.withColumn(field.name, current_timestamp())
+  return sdf.select([field.name for field in schema])
+
+def timed_rows_per_sec(df, rows):
+  start = time.perf_counter()
+  df.write.format("noop").mode("overwrite").save()
+  return rows / (time.perf_counter() - start)
+
+def bench_parse(spark, rows, path=None):
+  # a taxi_generator.py CSV instead of the repeated sample line when a path is given
+  if path:
+    lines = spark.read.text(path).limit(rows).cache()
+    rows = lines.count()
+  else:
+    lines = generate_ride_lines(spark, rows)
+    lines.count()
+  parsed, malformed = parse_data_from_kafka_message(lines, taxiRidesSchema)
+  results = {
+    "split_per_column": timed_rows_per_sec(parse_split_per_column(lines, taxiRidesSchema), rows),
+    "from_csv_single_pass": timed_rows_per_sec(parsed, rows),
+  }
+  results["malformed_rows"] = malformed.count()
+  lines.unpersist()
+  return results
+
+def sample_rides(rows, drivers=10000):
+  base = taxi_codec.parse_ride_line(SAMPLE_RIDE.format(0, 0, 0))
+  for i in range(rows):
+    yield (i, "START" if i % 2 else "END", base[2] + i * 1000, base[3]) \
+      + tuple(taxi_codec.to_float32(v + i * 1e-6) for v in base[4:8]) + (i % 7, i % drivers, i % drivers)
+
+def bench_codecs(spark, rows):
+  """Round-trip every codec: encode in Python, decode in Spark, compare, then encode the counts back."""
+  rides = list(sample_rides(rows))
+  results = {}
+  for codec in taxi_codec.CODECS:
+    encode = taxi_codec.ride_encoder(codec)
+    payloads = spark.createDataFrame([(encode(r),) for r in rides], "value binary").cache()
+    payloads.count()
+    try:
+      parsed, malformed = parse_data_from_kafka_message(payloads, taxiRidesSchema, codec)
+      rate = timed_rows_per_sec(parsed, rows)
+      decoded = parsed.drop("timestamp").orderBy("rideId").collect()
+      counts = parsed.groupBy("driverId", window("startTime", "10 seconds", "5 seconds")).count()
+      encoded = taxi_codec.encode_payload(counts, codec)
+      decode_count = taxi_codec.count_decoder(codec)
+      out_rows = [decode_count(bytes(r.value) if codec not in ("csv", "json") else r.value.encode("utf-8"))
+        for r in encoded.limit(1000).collect()]
+    except (ImportError, TypeError) as e:
+      if not missing_package(e):
+        raise
+      results[codec] = {"skipped": str(e).splitlines()[0]}
+      continue
+    finally:
+      payloads.unpersist()
+    ok = len(decoded) == rows and all(_ride_matches(r, ride) for r, ride in zip(decoded, rides))
+    results[codec] = {"decode_rows_per_sec": round(rate),
+      "bytes_per_record": sum(len(encode(r)) for r in rides[:1000]) / min(rows, 1000),
+      "round_trip_ok": ok and malformed.count() == 0 and len(out_rows) > 0}
+  return results
+
+def missing_package(e):
+  # from_avro/from_protobuf without spark-avro/spark-protobuf on the class path, or a PySpark without the module
+  return isinstance(e, ImportError) or "'JavaPackage' object is not callable" in str(e)
+
+def _ride_matches(row, ride):
+  # collected timestamps are naive local datetimes
+  return tuple(round(v.timestamp() * 1000) if kind == "timestamp" else v
+    for (_, kind), v in zip(taxi_codec.RIDE_FIELDS, row)) == ride
+
+def rate_ride_lines(spark, rows_per_second, partitions, drivers=10000):
+  """Streaming source of taxirides CSV values, the rate source standing in for the Kafka topic."""
+  return spark.readStream \
+    .format("rate") \
+    .option("rowsPerSecond", rows_per_second) \
+    .option("numPartitions", partitions) \
+    .load() \
+    .select(format_string(SAMPLE_RIDE, col("value"), col("value") % drivers, col("value") % drivers).alias("value"))
+
+def percentile(values, p):
+  values = sorted(values)
+  if not values:
+    return None
+  return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def summarize_progress(progress, config):
+  # the first batches include JVM warm-up and the empty initial trigger
+  batches = [p for p in progress if p["numInputRows"] > 0][1:]
+  durations = [p["durationMs"]["triggerExecution"] for p in batches]
+  states = [state_metrics(p) for p in batches]
+  state_rows = [m["stateRows"] for m in states]
+  state_bytes = [m["stateMemoryBytes"] for m in states]
+  commits = [m["commitTimeMs"] for m in states]
+  rows = sum(p["numInputRows"] for p in batches)
+  return dict(config,
+    batches=len(batches),
+    input_rows=rows,
+    processed_rows_per_sec=rows * 1000.0 / sum(durations) if durations else 0.0,
+    batch_duration_ms={"p50": percentile(durations, 50), "p90": percentile(durations, 90),
+      "p99": percentile(durations, 99), "max": max(durations, default=None)},
+    state_rows={"last": state_rows[-1] if state_rows else None, "max": max(state_rows, default=None)},
+    state_memory_bytes={"last": state_bytes[-1] if state_bytes else None, "max": max(state_bytes, default=None)},
+    state_commit_ms={"p50": percentile(commits, 50), "p99": percentile(commits, 99)})
+
+def run_streaming(spark, source, aggregate, duration, trigger=None, name="bench"):
+  """Run source -> aggregate into the noop sink for `duration` seconds and return its progress reports."""
+  writer = aggregate(source).writeStream.format("noop").outputMode("append").queryName(name)
+  if trigger:
+    writer = writer.trigger(processingTime=trigger)
+  query = writer.start()
+  try:
+    query.awaitTermination(duration)
+  finally:
+    query.stop()
+  return progress_dicts(query)
+
+def bench_streaming(spark, args):
+  """Sweep window/slide/watermark and shuffle partitions over the parse-and-aggregate pipeline."""
+  results = []
+  for window_duration, slide, watermark, partitions in itertools.product(
+      args.windows, args.slides, args.watermarks, args.shuffle_partitions):
+    spark.conf.set("spark.sql.shuffle.partitions", partitions)
+    config = {"window": window_duration, "slide": slide, "watermark": watermark, "shuffle_partitions": partitions,
+      "rows_per_second": args.rows_per_second}
+    source = rate_ride_lines(spark, args.rows_per_second, args.source_partitions, args.drivers)
+    aggregate = lambda sdf: driver_window_counts(parse_data_from_kafka_message(sdf, taxiRidesSchema)[0],
+      window_duration, slide, watermark)
+    result = summarize_progress(run_streaming(spark, source, aggregate, args.duration, args.trigger), config)
+    print(json.dumps(result))
+    results.append(result)
+  return results
+
+def bench_state_store(spark, args):
+  """Same aggregation on each state store backend, at a high driverId cardinality."""
+  spark.conf.set("spark.sql.shuffle.partitions", args.shuffle_partitions)
+  results = []
+  for backend in args.backends:
+    configure_state_store(spark, backend, args.rocksdb_memory_mb)
+    source = rate_ride_lines(spark, args.rows_per_second, args.source_partitions, args.drivers)
+    aggregate = lambda sdf: driver_window_counts(parse_data_from_kafka_message(sdf, taxiRidesSchema)[0],
+      args.window, args.slide, args.watermark)
+    result = summarize_progress(run_streaming(spark, source, aggregate, args.duration, args.trigger, backend),
+      {"state_store": backend, "drivers": args.drivers, "rows_per_second": args.rows_per_second})
+    print(json.dumps(result))
+    results.append(result)
+  return results
+
+def shuffle_write_bytes(spark):
+  """Total shuffle bytes written by the application so far, from the Spark UI REST API."""
+  app = spark.sparkContext
+  url = "{}/api/v1/applications/{}/stages?status=complete".format(app.uiWebUrl, app.applicationId)
+  with request.urlopen(url) as f:
+    return sum(stage.get("shuffleWriteBytes", 0) for stage in json.load(f))
+
+def verify_pane_counts(spark, window_duration, slide, rows=200000, drivers=1000):
+  """Compare both aggregations on the same static rides, returns the number of differing rows."""
+  rides = spark.range(rows).select((col("id") % drivers).alias("driverId"),
+    expr("timestamp_seconds(id / 100)").alias("timestamp"))
+  expected = driver_window_counts(rides, window_duration, slide)
+  actual = driver_pane_counts(rides, window_duration, slide)
+  return expected.exceptAll(actual).count() + actual.exceptAll(expected).count()
+
+def bench_panes(spark, args):
+  """window() against pane aggregation, as the window/slide ratio grows."""
+  spark.conf.set("spark.sql.shuffle.partitions", args.shuffle_partitions)
+  results = []
+  for window_duration in args.windows:
+    mismatches = verify_pane_counts(spark, window_duration, args.slide)
+    for name, aggregation in (("window", driver_window_counts), ("pane", driver_pane_counts)):
+      source = rate_ride_lines(spark, args.rows_per_second, args.source_partitions, args.drivers)
+      aggregate = lambda sdf: aggregation(parse_data_from_kafka_message(sdf, taxiRidesSchema)[0],
+        window_duration, args.slide, args.watermark)
+      before = shuffle_write_bytes(spark)
+      progress = run_streaming(spark, source, aggregate, args.duration, args.trigger, name)
+      result = summarize_progress(progress, {"aggregation": name, "window": window_duration, "slide": args.slide,
+        "verify_mismatched_rows": mismatches})
+      result["shuffle_write_bytes"] = shuffle_write_bytes(spark) - before
+      result["shuffle_bytes_per_input_row"] = result["shuffle_write_bytes"] / max(1, sum(p["numInputRows"] for p in progress))
+      print(json.dumps(result))
+      results.append(result)
+  return results
+
+def event_time_rides(spark, rows_per_second, partitions, drivers, start_ms):
+  """Rate source rides whose event time follows the row number, so two queries see the same rides."""
+  return spark.readStream \
+    .format("rate") \
+    .option("rowsPerSecond", rows_per_second) \
+    .option("numPartitions", partitions) \
+    .load() \
+    .select((col("value") % drivers).alias("driverId"),
+      expr("timestamp_millis({} + value * 1000 div {})".format(start_ms, rows_per_second)).alias("timestamp"))
+
+def emit_latency(rows, since):
+  """p50/p99 seconds between a window's `since` bound ('start' or 'end') and the emit time of rows."""
+  seconds = [(r["emitted"] - r["window"][since]).total_seconds() for r in rows]
+  return {"p50": percentile(seconds, 50), "p99": percentile(seconds, 99), "rows": len(seconds)}
+
+def bench_early(spark, args):
+  """window() against the early firing aggregation: same final counts, and how soon counts are visible."""
+  spark.conf.set("spark.sql.shuffle.partitions", args.shuffle_partitions)
+  start_ms = int(time.time() * 1000)
+  tables = {}
+  for name, aggregation in (("window", driver_window_counts), ("early", driver_early_counts)):
+    rides = event_time_rides(spark, args.rows_per_second, args.source_partitions, args.drivers, start_ms)
+    query = aggregation(rides, args.window, args.slide, args.watermark) \
+      .withColumn("emitted", current_timestamp()) \
+      .writeStream.format("memory").outputMode("append").queryName("early_bench_" + name) \
+      .trigger(processingTime=args.trigger).start()
+    try:
+      query.awaitTermination(args.duration)
+    finally:
+      query.stop()
+    tables[name] = spark.table("early_bench_" + name)
+
+  window_rows = tables["window"].collect()
+  early_rows = tables["early"].collect()
+  final_rows = [r for r in early_rows if r["final"]]
+  # compare the windows both queries have closed
+  cutoff = min(max((r["window"]["end"] for r in rows), default=None) for rows in (window_rows, final_rows))
+  expected = {(r["driverId"], r["window"]["start"]): r["count"] for r in window_rows if r["window"]["end"] <= cutoff}
+  actual = {(r["driverId"], r["window"]["start"]): r["count"] for r in final_rows if r["window"]["end"] <= cutoff}
+  mismatches = sum(1 for k in set(expected) | set(actual) if expected.get(k) != actual.get(k))
+
+  first = {}
+  for r in early_rows:
+    k = (r["driverId"], r["window"]["start"])
+    if k not in first or r["emitted"] < first[k]["emitted"]:
+      first[k] = r
+  result = {"window": args.window, "slide": args.slide, "watermark": args.watermark,
+    "compared_windows": len(expected), "mismatched_windows": mismatches,
+    "window_first_emit_after_window_start_s": emit_latency(window_rows, "start"),
+    "early_first_emit_after_window_start_s": emit_latency(list(first.values()), "start"),
+    "window_emit_after_window_end_s": emit_latency(window_rows, "end"),
+    "early_final_emit_after_window_end_s": emit_latency(final_rows, "end"),
+    "early_rows_per_final_row": len(early_rows) / max(1, len(final_rows))}
+  print(json.dumps(result))
+  return [result]
+
+def zipf_rides(spark, rows, drivers, exponent, seed=42, seconds=3600):
+  """Rides with Zipf-like driverIds: floor(u ** (-1 / (s - 1))) is the continuous approximation of Zipf(s).
+
+  The tail beyond `drivers` wraps around instead of piling up on the last driverId.
+  """
+  heavy_tail = pow(lit(1.0) - rand(seed), lit(-1.0 / (exponent - 1))) - lit(1.0)
+  return spark.range(rows).select(col("id").alias("rideId"),
+    (floor(pmod(heavy_tail, lit(float(drivers)))) + 1).cast("long").alias("driverId"),
+    expr("timestamp_seconds(id * {} div {})".format(seconds, rows)).alias("timestamp"))
+
+def stage_ids(spark):
+  app = spark.sparkContext
+  url = "{}/api/v1/applications/{}/stages?status=complete".format(app.uiWebUrl, app.applicationId)
+  with request.urlopen(url) as f:
+    return [(stage["stageId"], stage["attemptId"], stage.get("shuffleReadBytes", 0)) for stage in json.load(f)]
+
+def reduce_task_times(spark, since):
+  """p50/p99/max executor run time (ms) of the tasks of the shuffle-reading stages not in `since`."""
+  app = spark.sparkContext
+  summary = {"p50": 0, "p99": 0, "max": 0}
+  for stage, attempt, shuffle_read in stage_ids(spark):
+    if (stage, attempt, shuffle_read) in since or not shuffle_read:
+      continue
+    url = "{}/api/v1/applications/{}/stages/{}/{}/taskSummary?quantiles=0.5,0.99,1.0".format(
+      app.uiWebUrl, app.applicationId, stage, attempt)
+    with request.urlopen(url) as f:
+      p50, p99, top = json.load(f)["executorRunTime"]
+    summary = {"p50": max(summary["p50"], p50), "p99": max(summary["p99"], p99), "max": max(summary["max"], top)}
+  return summary
+
+def bench_skew(spark, args):
+  """window(), pane and salted aggregation of Zipf distributed drivers: slowest reduce tasks of each."""
+  spark.conf.set("spark.sql.shuffle.partitions", args.shuffle_partitions)
+  # AQE would coalesce the shuffle partitions and blur the per-task picture
+  spark.conf.set("spark.sql.adaptive.enabled", "false")
+  rides = zipf_rides(spark, args.rows, args.drivers, args.zipf_exponent).cache()
+  rides.count()
+  hot_keys = detect_hot_keys(rides, args.share)
+  expected = driver_window_counts(rides, args.window, args.slide).cache()
+  expected.count()
+  results = []
+  for name, aggregate in (("window", lambda: driver_window_counts(rides, args.window, args.slide)),
+      ("pane", lambda: driver_pane_counts(rides, args.window, args.slide)),
+      ("salted", lambda: driver_salted_counts(rides, args.window, args.slide, hot_keys=hot_keys, salts=args.salts))):
+    before = set(stage_ids(spark))
+    start = time.perf_counter()
+    aggregate().write.format("noop").mode("overwrite").save()
+    elapsed = time.perf_counter() - start
+    task_ms = reduce_task_times(spark, before)
+    actual = aggregate()
+    mismatches = expected.exceptAll(actual).count() + actual.exceptAll(expected).count()
+    result = {"aggregation": name, "rows": args.rows, "zipf_exponent": args.zipf_exponent, "hot_keys": len(hot_keys),
+      "salts": args.salts if name == "salted" else None, "seconds": round(elapsed, 2),
+      "reduce_task_ms": task_ms, "mismatched_rows": mismatches}
+    print(json.dumps(result))
+    results.append(result)
+  rides.unpersist()
+  expected.unpersist()
+  return results
+
+def simulated_rides_and_fares(spark, args, base_ms=1356998400000):
+  """Rate sources of START rides and their fares whose event time runs `speedup` times faster than the clock.
+
+  A fare arrives up to fare_lag_seconds before or after its ride, every 100th fare has no ride
+  and only leaves the join state by eviction.
+  """
+  ms_per_row = args.speedup * 1000.0 / args.rows_per_second
+  event_time = "timestamp_millis(cast({} + value * {} as bigint){{}})".format(base_ms, ms_per_row)
+  def rate():
+    return spark.readStream.format("rate").option("rowsPerSecond", args.rows_per_second) \
+      .option("numPartitions", args.source_partitions).load()
+  rides = rate().select(col("value").alias("rideId"), (col("value") % args.drivers).alias("driverId"),
+    lit("START").alias("isStart"), expr(event_time.format("")).alias("timestamp"))
+  lag = args.fare_lag_seconds
+  fares = rate().select(when(col("value") % 100 == 0, -col("value")).otherwise(col("value")).alias("rideId"),
+    expr(event_time.format(" + (pmod(value * 7919, {}) - {}) * 1000".format(2 * lag + 1, lag))).alias("timestamp"),
+    (lit(5.0) + col("value") % 50).alias("totalFare"), (col("value") % 5).cast("double").alias("tip"))
+  return rides, fares
+
+def bench_join(spark, args):
+  """Rides joined with fares for hours of simulated time, the join state must level off instead of growing."""
+  spark.conf.set("spark.sql.shuffle.partitions", args.shuffle_partitions)
+  rides, fares = simulated_rides_and_fares(spark, args)
+  query = driver_revenue(rides, fares, args.window, args.slide, args.watermark, args.join_bound) \
+    .writeStream.format("noop").outputMode("append").queryName("join_bench") \
+    .trigger(processingTime=args.trigger).start()
+  try:
+    query.awaitTermination(args.duration)
+  finally:
+    query.stop()
+  batches = [p for p in progress_dicts(query) if p["numInputRows"] > 0][1:]
+  states = [state_metrics(p) for p in batches]
+  join_rows = [m["stateRowsByOperator"].get("symmetricHashJoin", 0) for m in states]
+  quarter = max(1, len(join_rows) // 4)
+  second, last = join_rows[quarter:2 * quarter], join_rows[-quarter:]
+  watermarks = [p["eventTime"]["watermark"] for p in batches if p.get("eventTime", {}).get("watermark")]
+  seconds = sum(p["durationMs"]["triggerExecution"] for p in batches) / 1000.0
+  result = dict(summarize_progress(progress_dicts(query), {"window": args.window, "watermark": args.watermark,
+      "join_bound": args.join_bound, "speedup": args.speedup}),
+    simulated_hours=round(args.duration * args.speedup / 3600.0, 2),
+    first_watermark=watermarks[0] if watermarks else None, last_watermark=watermarks[-1] if watermarks else None,
+    join_state_rows={"max": max(join_rows, default=None), "last": join_rows[-1] if join_rows else None},
+    # around 1.0 when the state is bounded, it keeps growing with the run length otherwise
+    join_state_growth=(sum(last) / len(last)) / max(1.0, sum(second) / max(1, len(second))) if join_rows else None,
+    state_rows_removed_per_sec=sum(m["stateRowsRemoved"] for m in states) / max(seconds, 1e-9))
+  print(json.dumps(result))
+  return [result]
+
+def bench_geo(spark, args):
+  """Rows/sec per core of the broadcast grid lookup against a per-row Python point-in-polygon UDF."""
+  grid = geo_grid.Grid(cell_degrees=args.grid_degrees)
+  zones = geo_grid.rectangle_zones(n=args.zones)
+  start = time.perf_counter()
+  index = geo_grid.build_cell_index(grid, zones)
+  build_seconds = time.perf_counter() - start
+  index_frame = geo_grid.cell_index_frame(spark, index).cache()
+  lon = lambda seed: lit(grid.min_lon) + rand(seed) * (grid.max_lon - grid.min_lon)
+  lat = lambda seed: lit(grid.min_lat) + rand(seed) * (grid.max_lat - grid.min_lat)
+  rides = spark.range(args.rows).select(col("id").alias("rideId"), lon(1).cast("float").alias("startLon"),
+    lat(2).cast("float").alias("startLat"), lon(3).cast("float").alias("endLon"),
+    lat(4).cast("float").alias("endLat")).cache()
+  rides.count()
+  zone_at = udf(zones.zone_at, "string")
+  per_row = rides.withColumn("startZone", zone_at("startLon", "startLat")) \
+                 .withColumn("endZone", zone_at("endLon", "endLat"))
+  cores = spark.sparkContext.defaultParallelism
+  results = []
+  for name, enriched in (("broadcast_grid", geo_grid.enrich(rides, grid, index_frame)), ("python_udf", per_row)):
+    rate = timed_rows_per_sec(enriched, args.rows)
+    result = {"lookup": name, "rows": args.rows, "cores": cores, "rows_per_sec": round(rate),
+      "rows_per_sec_per_core": round(rate / cores)}
+    print(json.dumps(result))
+    results.append(result)
+  # the grid maps a point to the zone of its cell center, it differs only along zone borders
+  same = geo_grid.enrich(rides, grid, index_frame).select("rideId", "startZone") \
+    .join(per_row.select("rideId", col("startZone").alias("exactZone")), "rideId") \
+    .where(col("startZone").eqNullSafe(col("exactZone"))).count()
+  results.append({"cells": grid.cells, "index_build_seconds": round(build_seconds, 2),
+    "zone_agreement": same / float(args.rows)})
+  print(json.dumps(results[-1]))
+  rides.unpersist()
+  index_frame.unpersist()
+  return results
+
+def bench_sink(spark, args):
+  """Write window counts to a local broker with each sink setting, then read them back to check keys and spread."""
+  counts = spark.range(args.rows).select((col("id") % args.drivers).alias("driverId"),
+    expr("named_struct('start', timestamp_seconds(id div {0} * 5), 'end', timestamp_seconds(id div {0} * 5 + 10))"
+      .format(args.drivers)).alias("window"), (col("id") % 50).alias("count")).cache()
+  counts.count()
+  results = []
+  for compression, codec in itertools.product(args.compressions, args.codecs):
+    topic = "{}-{}-{}".format(args.topic_prefix, codec, compression)
+    encoded = taxi_codec.encode_payload(counts, codec, key="driverId")
+    start = time.perf_counter()
+    encoded.write.format("kafka") \
+      .option("kafka.bootstrap.servers", args.bootstrap_servers) \
+      .option("topic", topic) \
+      .options(**kafka_sink_options(compression, args.linger_ms, args.batch_size)) \
+      .save()
+    elapsed = time.perf_counter() - start
+    written = spark.read.format("kafka") \
+      .option("kafka.bootstrap.servers", args.bootstrap_servers) \
+      .option("subscribe", topic) \
+      .load()
+    per_partition = [r["count"] for r in written.groupBy("partition").count().collect()]
+    # keyed by driverId, every driver must land in exactly one partition
+    split_keys = written.groupBy("key").agg(expr("count(distinct partition) as partitions")).where("partitions > 1").count()
+    result = {"codec": codec, "compression": compression, "rows_per_sec": args.rows / elapsed,
+      "value_bytes": written.selectExpr("sum(length(value))").first()[0],
+      "partition_rows_min": min(per_partition), "partition_rows_max": max(per_partition),
+      "keys_in_several_partitions": split_keys}
+    print(json.dumps(result))
+    results.append(result)
+  counts.unpersist()
+  return results
+
+def csv_list(kind=str):
+  return lambda value: [kind(v.strip()) for v in value.split(",")]
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(description="Local-mode benchmarks for msk_consumer.py")
+  sub = parser.add_subparsers(dest="bench", required=True)
+  p = sub.add_parser("parse", help="from_csv parser against the old split-per-column parser")
+  p.add_argument("--rows", type=int, default=2000000)
+  p.add_argument("--input", help="CSV lines written by taxi_generator.py, e.g. rides.csv.gz")
+  p = sub.add_parser("codecs", help="round-trip and decode throughput of every taxi_codec codec")
+  p.add_argument("--rows", type=int, default=200000)
+  p = sub.add_parser("streaming", help="sweep the windowed aggregation over a rate source")
+  p.add_argument("--rows-per-second", type=int, default=50000)
+  p.add_argument("--source-partitions", type=int, default=4)
+  p.add_argument("--drivers", type=int, default=10000)
+  p.add_argument("--duration", type=int, default=60, help="seconds per configuration")
+  p.add_argument("--trigger", help="processing time trigger, e.g. '5 seconds', as fast as possible if unset")
+  p.add_argument("--windows", type=csv_list(), default=["10 seconds"])
+  p.add_argument("--slides", type=csv_list(), default=["5 seconds"])
+  p.add_argument("--watermarks", type=csv_list(), default=["10 seconds"])
+  p.add_argument("--shuffle-partitions", type=csv_list(int), default=[8, 32])
+  p = sub.add_parser("state", help="hdfs (heap) against rocksdb state store at high key cardinality")
+  p.add_argument("--backends", type=csv_list(), default=["hdfs", "rocksdb"])
+  p.add_argument("--drivers", type=int, default=500000)
+  p.add_argument("--rows-per-second", type=int, default=100000)
+  p.add_argument("--source-partitions", type=int, default=4)
+  p.add_argument("--shuffle-partitions", type=int, default=16)
+  p.add_argument("--duration", type=int, default=120, help="seconds per backend")
+  p.add_argument("--trigger", default="5 seconds")
+  p.add_argument("--window", default="10 seconds")
+  p.add_argument("--slide", default="5 seconds")
+  p.add_argument("--watermark", default="10 seconds")
+  p.add_argument("--rocksdb-memory-mb", type=int)
+  p = sub.add_parser("pane", help="window() against pane aggregation as the window/slide ratio grows")
+  p.add_argument("--windows", type=csv_list(), default=["10 seconds", "60 seconds", "300 seconds"])
+  p.add_argument("--slide", default="5 seconds")
+  p.add_argument("--watermark", default="10 seconds")
+  p.add_argument("--drivers", type=int, default=10000)
+  p.add_argument("--rows-per-second", type=int, default=50000)
+  p.add_argument("--source-partitions", type=int, default=4)
+  p.add_argument("--shuffle-partitions", type=int, default=16)
+  p.add_argument("--duration", type=int, default=60, help="seconds per run")
+  p.add_argument("--trigger", default="5 seconds")
+  p = sub.add_parser("early", help="window() against the early firing aggregation, results and emit latency")
+  p.add_argument("--window", default="10 seconds")
+  p.add_argument("--slide", default="5 seconds")
+  p.add_argument("--watermark", default="10 seconds")
+  p.add_argument("--drivers", type=int, default=1000)
+  p.add_argument("--rows-per-second", type=int, default=5000)
+  p.add_argument("--source-partitions", type=int, default=4)
+  p.add_argument("--shuffle-partitions", type=int, default=8)
+  p.add_argument("--duration", type=int, default=90, help="seconds per query")
+  p.add_argument("--trigger", default="2 seconds")
+  p = sub.add_parser("skew", help="window, pane and salted aggregation of Zipf distributed drivers, p99 task time")
+  p.add_argument("--rows", type=int, default=5000000)
+  p.add_argument("--drivers", type=int, default=100000)
+  p.add_argument("--zipf-exponent", type=float, default=1.2, help="> 1, smaller is more skewed")
+  p.add_argument("--share", type=float, default=0.01, help="share of the rides that makes a driver hot")
+  p.add_argument("--salts", type=int, default=16)
+  p.add_argument("--window", default="60 seconds")
+  p.add_argument("--slide", default="5 seconds")
+  p.add_argument("--shuffle-partitions", type=int, default=32)
+  p = sub.add_parser("join", help="rides/fares join over hours of simulated time, join state size and eviction")
+  p.add_argument("--rows-per-second", type=int, default=2000)
+  p.add_argument("--speedup", type=float, default=60, help="simulated seconds per wall clock second")
+  p.add_argument("--drivers", type=int, default=10000)
+  p.add_argument("--fare-lag-seconds", type=int, default=30, help="how far a fare's time may be from its ride")
+  p.add_argument("--window", default="10 minutes")
+  p.add_argument("--slide", default="5 minutes")
+  p.add_argument("--watermark", default="2 minutes")
+  p.add_argument("--join-bound", default="1 minute")
+  p.add_argument("--source-partitions", type=int, default=4)
+  p.add_argument("--shuffle-partitions", type=int, default=8)
+  p.add_argument("--duration", type=int, default=300, help="wall clock seconds, 5 simulated hours at the default speedup")
+  p.add_argument("--trigger", default="5 seconds")
+  p = sub.add_parser("geo", help="broadcast grid zone lookup against a per-row Python point-in-polygon UDF")
+  p.add_argument("--rows", type=int, default=2000000)
+  p.add_argument("--grid-degrees", type=float, default=0.005)
+  p.add_argument("--zones", type=int, default=16, help="n x n rectangular zones")
+  p = sub.add_parser("sink", help="keyed Kafka sink against a local broker, e.g. a single-node Kafka container")
+  p.add_argument("--bootstrap-servers", default="localhost:9092")
+  p.add_argument("--topic-prefix", default="bench-driver-counts", help="topics are created by the broker on first write")
+  p.add_argument("--rows", type=int, default=1000000)
+  p.add_argument("--drivers", type=int, default=10000)
+  p.add_argument("--codecs", type=csv_list(), default=["json", "fixed"])
+  p.add_argument("--compressions", type=csv_list(), default=["none", "lz4", "zstd"])
+  p.add_argument("--linger-ms", type=int, default=20)
+  p.add_argument("--batch-size", type=int, default=256 * 1024)
+  for p in sub.choices.values():
+    p.add_argument("--report", help="write the results as JSON to this file")
+  return parser.parse_args(argv)
+
+if __name__ == "__main__":
+  args = parse_args()
+  spark = SparkSession.builder \
+    .master("local[*]") \
+    .appName("msk_consumer benchmark") \
+    .config("spark.sql.session.timeZone", "UTC") \
+    .getOrCreate()
+  spark.sparkContext.setLogLevel("WARN")
+
+  if args.bench == "parse":
+    results = bench_parse(spark, args.rows, args.input)
+    for name, value in results.items():
+      print("{:<24}{:>16,.0f}".format(name, value))
+  elif args.bench == "codecs":
+    results = bench_codecs(spark, args.rows)
+    for codec, result in results.items():
+      print("{:<10}{}".format(codec, result))
+  elif args.bench == "sink":
+    results = bench_sink(spark, args)
+  elif args.bench == "pane":
+    results = bench_panes(spark, args)
+  elif args.bench == "early":
+    results = bench_early(spark, args)
+  elif args.bench == "skew":
+    results = bench_skew(spark, args)
+  elif args.bench == "join":
+    results = bench_join(spark, args)
+  elif args.bench == "geo":
+    results = bench_geo(spark, args)
+  elif args.bench == "state":
+    results = bench_state_store(spark, args)
+  else:
+    results = bench_streaming(spark, args)
+
+  if args.report:
+    with open(args.report, "w") as f:
+      json.dump({"benchmark": args.bench, "spark_version": spark.version, "results": results}, f, indent=2)
+  spark.stop()
@@ -1,23 +1,17 @@
 from pyspark.sql import SparkSession
 from pyspark.sql.types import *
 from pyspark.sql.functions import *
-import pyspark
-import sys
-
-spark = SparkSession.builder \
-  .appName("Spark Structured Streaming from Kafka") \
-  .getOrCreate()
-
-sdfRides = spark \
-  .readStream \
-  .format("kafka") \
-  .option("kafka.bootstrap.servers", sys.argv[1]) \
-  .option("subscribe", "taxirides") \
-  .option("startingOffsets", "latest") \
-  .option("auto.offset.reset", "latest") \
-  .load() \
-  .selectExpr("decode(CAST(value AS STRING),'utf-8') as value") 
-    
+from taxi_codec import CODECS, CORRUPT_RECORD_COL, decode_payload, encode_payload, text_to_millis
+from backpressure import BackpressureController
+import geo_grid
+import stream_metrics
+import argparse
+import builtins
+import json
+import math
+import re
+import time
+
 taxiRidesSchema = StructType([ \
   StructField("rideId", LongType()), StructField("isStart", StringType()), \
   StructField("endTime", TimestampType()), StructField("startTime", TimestampType()), \
@@ -26,37 +20,652 @@ taxiRidesSchema = StructType([ \
   StructField("passengerCnt", ShortType()), StructField("taxiId", LongType()), \
   StructField("driverId", LongType()),StructField("timestamp", TimestampType())])
 
-def parse_data_from_kafka_message(sdf, schema):
-  assert sdf.isStreaming == True, "DataFrame doesn't receive streaming data"
-  col = split(sdf['value'], ',') 
-  for idx, field in enumerate(schema): 
-      sdf = sdf.withColumn(field.name, col.getItem(idx).cast(field.dataType)) 
-      if field.name=="timestamp":
-          sdf = sdf.withColumn(field.name, current_timestamp())
-  return sdf.select([field.name for field in schema])
-
-sdfRides = parse_data_from_kafka_message(sdfRides, taxiRidesSchema)
-# sdfFares = parse_data_from_kafka_message(sdfFares, taxiFaresSchema)
-
-query = sdfRides.withWatermark("timestamp", "10 seconds") \
-                .groupBy("driverId", window("timestamp", "10 seconds", "5 seconds")).count()
-
-# query.writeStream \
-#     .outputMode("append") \
-#     .format("console") \
-#     .option("checkpointLocation", "s3://test/stream/checkpoint/consumer_taxi2") \
-#     .option("truncate", False) \
-#     .start() \
-#     .awaitTermination()
-
-output=query.select(to_json(struct("*")).alias("value")) \
-  .selectExpr("CAST(value AS STRING)") \
-  .writeStream \
-  .outputMode("append") \
-  .format("kafka") \
-  .option("kafka.bootstrap.servers", sys.argv[1]) \
-  .option("topic", sys.argv[3]) \
-  .option("checkpointLocation", sys.argv[2]) \
-  .start()
-
-output.awaitTermination()
+taxiFaresSchema = StructType([ \
+  StructField("rideId", LongType()), StructField("taxiId", LongType()), \
+  StructField("driverId", LongType()), StructField("startTime", TimestampType()), \
+  StructField("paymentType", StringType()), StructField("tip", FloatType()), \
+  StructField("tolls", FloatType()), StructField("totalFare", FloatType()), \
+  StructField("timestamp", TimestampType())])
+
+# fields stamped by the consumer rather than sent by the producer
+ARRIVAL_FIELDS = ["timestamp"]
+KAFKA_TIMESTAMP_COL = "kafkaTimestamp"
+EVENT_TIMES = ["arrival", "kafka", "ride"]
+
+def event_time_column(schema, event_time="arrival"):
+  """The `timestamp` that windows and watermarks run on.
+
+  arrival  start of the consumer batch, i.e. processing time
+  kafka    Kafka record timestamp, the producer send time unless the topic uses LogAppendTime
+  ride     time in the record: ride start of START events, ride end of END events, ride start of fares
+  """
+  if event_time == "arrival":
+    return current_timestamp()
+  if event_time == "kafka":
+    return col(KAFKA_TIMESTAMP_COL)
+  if event_time == "ride":
+    if "isStart" in schema.fieldNames():
+      # like nycTaxiRides, the endTime column holds the ride start and startTime the ride end
+      return when(col("isStart") == "START", col("endTime")).otherwise(col("startTime"))
+    return col("startTime")
+  raise ValueError("unknown event time {!r}, choose from {}".format(event_time, EVENT_TIMES))
+
+def parse_data_from_kafka_message(sdf, schema, codec="csv", record="TaxiRide", event_time="arrival"):
+  """Decode each record once and project every field of schema in a single select.
+
+  Returns a (parsed, malformed) pair. Records that can't be decoded are kept
+  in the malformed frame with their raw value instead of being silently nulled.
+  record is TaxiRide for taxiRidesSchema and TaxiFare for taxiFaresSchema.
+  event_time picks the `timestamp` field, see event_time_column; kafka needs the
+  KAFKA_TIMESTAMP_COL of read_kafka_topic.
+  """
+  sdf = decode_payload(sdf, codec, schema, record, [KAFKA_TIMESTAMP_COL] if event_time == "kafka" else [])
+  parsed = sdf.where(col(CORRUPT_RECORD_COL).isNull()) \
+    .select([event_time_column(schema, event_time).alias(field.name) if field.name in ARRIVAL_FIELDS
+             else col(field.name) for field in schema])
+  malformed = sdf.where(col(CORRUPT_RECORD_COL).isNotNull()) \
+    .select(col(CORRUPT_RECORD_COL).alias("value"), current_timestamp().alias("timestamp"))
+  return parsed, malformed
+
+def read_kafka_topic(spark, bootstrap_servers, topic, starting_offsets="latest", max_offsets_per_trigger=None):
+  reader = spark \
+    .readStream \
+    .format("kafka") \
+    .option("kafka.bootstrap.servers", bootstrap_servers) \
+    .option("subscribe", topic) \
+    .option("startingOffsets", starting_offsets) \
+    .option("auto.offset.reset", "latest")
+  if max_offsets_per_trigger:
+    reader = reader.option("maxOffsetsPerTrigger", int(max_offsets_per_trigger))
+  return reader.load().select("value", col("timestamp").alias(KAFKA_TIMESTAMP_COL))
+
+# upper bounds of the latency histogram buckets
+LATENCY_BUCKETS_MS = [1000, 2000, 5000, 10000, 20000, 30000, 60000, 120000, 300000, 600000]
+
+def observe_latency(sdf, name, latency_ms, buckets=LATENCY_BUCKETS_MS):
+  """Histogram of the latency_ms column expression over each batch, as observed metrics of the query (Spark 3.3+).
+
+  They show up in the progress under observedMetrics.<name> and stream_metrics exports them as
+  <name>_<field>: count, p50_ms, p90_ms, p99_ms, max_ms and the cumulative bucket counts
+  le_<ms>. Rows with a null latency are left out.
+  """
+  latency = latency_ms.cast("long")
+  aggregates = [count(latency).alias("count")]
+  aggregates += [percentile_approx(latency, q).alias("p{}_ms".format(int(q * 100))) for q in (0.5, 0.9, 0.99)]
+  aggregates.append(max(latency).alias("max_ms"))
+  aggregates += [sum(when(latency <= bound, 1).otherwise(0)).alias("le_{}".format(bound)) for bound in buckets]
+  return sdf.observe(name, *aggregates)
+
+def observe_input_lag(sdf, name="input_lag"):
+  """How far the event time of each record lies behind the batch start, the lateness --watermark has to cover."""
+  return observe_latency(sdf, name, expr("unix_millis(current_timestamp()) - unix_millis(timestamp)"))
+
+def observe_emit_latency(sdf, name="emit_latency"):
+  """How long after its window end each output row leaves, measured at the batch start.
+
+  With --event-time kafka the last records of a window are sent just before its end, so this
+  is the producer to emit latency of those records. Only final rows of the early aggregation count.
+  """
+  latency = expr("unix_millis(current_timestamp()) - unix_millis(window.end)")
+  if "final" in sdf.columns:
+    latency = when(col("final"), latency)
+  return observe_latency(sdf, name, latency)
+
+def driver_window_counts(sdf, window_duration="10 seconds", slide_duration="5 seconds", watermark="10 seconds"):
+  return sdf.withWatermark("timestamp", watermark) \
+            .groupBy("driverId", window("timestamp", window_duration, slide_duration)).count()
+
+# hdfs is Spark's default provider, it keeps all state rows in executor JVM heap.
+# rocksdb (Spark 3.2+) keeps them in native memory and local disk.
+STATE_STORE_PROVIDERS = {
+  "hdfs": "org.apache.spark.sql.execution.streaming.state.HDFSBackedStateStoreProvider",
+  "rocksdb": "org.apache.spark.sql.execution.streaming.state.RocksDBStateStoreProvider"}
+
+def configure_state_store(spark, backend, bounded_memory_mb=None):
+  """Select the state store provider, must be called before the query starts.
+
+  A checkpoint keeps the provider it was created with, switch backends with a new checkpoint location.
+  """
+  spark.conf.set("spark.sql.streaming.stateStore.providerClass", STATE_STORE_PROVIDERS[backend])
+  if backend == "rocksdb":
+    # upload only the changelog on commit instead of a snapshot of the whole store (Spark 3.4+)
+    spark.conf.set("spark.sql.streaming.stateStore.rocksdb.changelogCheckpointing.enabled", "true")
+    if bounded_memory_mb:
+      # cap block cache and memtables of all RocksDB instances in an executor (Spark 3.5+)
+      spark.conf.set("spark.sql.streaming.stateStore.rocksdb.boundedMemoryUsage", "true")
+      spark.conf.set("spark.sql.streaming.stateStore.rocksdb.maxMemoryUsageMB", str(bounded_memory_mb))
+
+def state_metrics(progress):
+  """Summarize the state operators of one StreamingQueryProgress (as a dict) into a flat record."""
+  # totals are added up by hand, the functions import above shadows the builtin sum
+  metrics = {"batchId": progress["batchId"], "numInputRows": progress["numInputRows"],
+    "stateRows": 0, "stateRowsUpdated": 0, "stateRowsRemoved": 0, "stateMemoryBytes": 0, "commitTimeMs": 0,
+    "rowsDroppedByWatermark": 0, "stateRowsByOperator": {}}
+  keys = {"stateRows": "numRowsTotal", "stateRowsUpdated": "numRowsUpdated", "stateRowsRemoved": "numRowsRemoved",
+    "stateMemoryBytes": "memoryUsedBytes", "commitTimeMs": "commitTimeMs",
+    "rowsDroppedByWatermark": "numRowsDroppedByWatermark"}
+  for op in progress.get("stateOperators", []):
+    for name, key in keys.items():
+      metrics[name] += op.get(key, 0)
+    # e.g. symmetricHashJoin and stateStoreSave of the revenue query
+    by_op = metrics["stateRowsByOperator"]
+    by_op[op.get("operatorName", "unknown")] = by_op.get(op.get("operatorName", "unknown"), 0) + op.get("numRowsTotal", 0)
+    for name, value in op.get("customMetrics", {}).items():
+      if name.startswith("rocksdb"):
+        metrics[name] = metrics.get(name, 0) + value
+  return metrics
+
+def progress_dicts(query):
+  # recentProgress holds dicts up to Spark 3.5 and StreamingQueryProgress objects from 4.0
+  return [p if isinstance(p, dict) else json.loads(p.json) for p in query.recentProgress]
+
+def run_monitored(spark, start_query, controller=None, report_state=False, poll_seconds=5.0):
+  """Block like awaitAnyTermination while watching the progress of the query returned by start_query.
+
+  start_query(max_offsets_per_trigger, trigger_seconds) starts the output query. With a
+  BackpressureController, the query is restarted from its checkpoint whenever the controller
+  asks for a new offset cap. With report_state, state_metrics of every batch are printed.
+  """
+  cap, trigger = (controller.cap, controller.trigger_seconds) if controller else (None, None)
+  query = start_query(cap, trigger)
+  last_batch = -1
+  while True:
+    spark.streams.awaitAnyTermination(poll_seconds)
+    spark.streams.resetTerminated()
+    if not query.isActive:
+      break
+    decision = None
+    for progress in progress_dicts(query):
+      if progress["batchId"] <= last_batch:
+        continue
+      last_batch = progress["batchId"]
+      if report_state and progress["numInputRows"] > 0:
+        print("STATE " + json.dumps(state_metrics(progress)), flush=True)
+      if controller:
+        decision = controller.update(progress) or decision
+    if decision:
+      print("BACKPRESSURE restarting with maxOffsetsPerTrigger={} trigger={}s".format(*decision), flush=True)
+      query.stop()
+      query = start_query(*decision)
+  query.awaitTermination()
+
+def kafka_sink_options(compression=None, linger_ms=None, batch_size=None, acks=None, max_request_size=None):
+  """Producer settings of the Kafka sink, passed through as kafka.* options. Unset values keep the client defaults."""
+  settings = {"compression.type": compression, "linger.ms": linger_ms, "batch.size": batch_size,
+    "acks": acks, "max.request.size": max_request_size}
+  return {"kafka." + name: str(value) for name, value in settings.items() if value is not None}
+
+DURATION_UNITS_MS = {"millisecond": 1, "second": 1000, "minute": 60000, "hour": 3600000}
+
+def duration_ms(text):
+  """Milliseconds of an interval string such as '10 seconds' or '1 minute'."""
+  match = re.fullmatch(r"\s*(\d+)\s*(millisecond|second|minute|hour)s?\s*", text.lower())
+  if not match:
+    raise ValueError("unsupported duration {!r}".format(text))
+  return int(match.group(1)) * DURATION_UNITS_MS[match.group(2)]
+
+def driver_pane_counts(sdf, window_duration="10 seconds", slide_duration="5 seconds", watermark="10 seconds",
+    salt=None):
+  """Same result as driver_window_counts for rides on time, but each ride is counted once in its pane.
+
+  A pane is a tumbling window of gcd(window, slide). Rides are shuffled and kept in
+  state once per (driverId, pane) instead of once per overlapping window, and the
+  pane counts are summed into the sliding windows by a second aggregation. A salt
+  column expression splits the pane counts of a driver over several shuffle partitions,
+  the second aggregation adds them back up. Chained stateful operators and window_time
+  need Spark 3.4+.
+
+  The watermark applies to the panes: a late ride is dropped once its pane has closed,
+  while window() still counts it in the windows that are open. With late rides the
+  later windows can count fewer rides than driver_window_counts.
+  """
+  pane = "{} milliseconds".format(math.gcd(duration_ms(window_duration), duration_ms(slide_duration)))
+  keys = ["driverId"] + ([salt.alias("salt")] if salt is not None else [])
+  panes = sdf.withWatermark("timestamp", watermark) \
+             .groupBy(*keys, window("timestamp", pane).alias("pane")).count()
+  return panes.groupBy("driverId", window(window_time("pane"), window_duration, slide_duration)) \
+              .agg(sum("count").alias("count"))
+
+def hot_key_salt(hot_keys, salts=8):
+  """Salt spreading the rides of the hot drivers over `salts` values, 0 for every other driver."""
+  if not hot_keys:
+    return lit(0)
+  return when(col("driverId").isin(list(hot_keys)), pmod(xxhash64("rideId", "timestamp"), lit(salts))) \
+    .otherwise(lit(0))
+
+def detect_hot_keys(rides, share=0.01, max_keys=100):
+  """driverIds holding more than `share` of the rides of a batch DataFrame, heaviest first."""
+  total = rides.count()
+  if not total:
+    return []
+  heavy = rides.groupBy("driverId").count().where(col("count") > share * total) \
+               .orderBy(desc("count")).limit(max_keys).collect()
+  return [row["driverId"] for row in heavy]
+
+def recent_rides(spark, bootstrap_servers, topic, lookback, codec="csv"):
+  """Batch read of the rides sent to the topic in the last `lookback`, e.g. '5 minutes' (Spark 3.3+)."""
+  since = int(time.time() * 1000) - duration_ms(lookback)
+  values = spark.read \
+    .format("kafka") \
+    .option("kafka.bootstrap.servers", bootstrap_servers) \
+    .option("subscribe", topic) \
+    .option("startingTimestamp", str(since)) \
+    .option("startingOffsetsByTimestampStrategy", "latest") \
+    .load().select("value")
+  return parse_data_from_kafka_message(values, taxiRidesSchema, codec)[0]
+
+def driver_salted_counts(sdf, window_duration="10 seconds", slide_duration="5 seconds", watermark="10 seconds",
+    hot_keys=(), salts=8):
+  """Pane aggregation whose hot drivers are salted over `salts` partitions in the first, heavy shuffle."""
+  return driver_pane_counts(sdf, window_duration, slide_duration, watermark, hot_key_salt(hot_keys, salts))
+
+EARLY_OUTPUT_SCHEMA = "driverId long, window struct<start: timestamp, end: timestamp>, count long, final boolean"
+EARLY_STATE_SCHEMA = "starts array<long>, counts array<long>"
+
+def advance_windows(windows, timestamps_ms, watermark_ms, window_ms, slide_ms):
+  """Add rides to the open sliding windows of one driver and close the windows the watermark has passed.
+
+  windows maps window start (ms) to count and is updated in place. Returns the starts that
+  changed and are still open, and the (start, count) pairs closed by the watermark. A ride
+  that only falls into windows closed before it arrived is dropped, like window() does.
+  """
+  import numpy as np
+  changed = set()
+  if len(timestamps_ms):
+    last_start = timestamps_ms - timestamps_ms % slide_ms
+    for i in range(-(-window_ms // slide_ms)):
+      starts = last_start - i * slide_ms
+      starts = starts[(starts + window_ms > timestamps_ms) & (starts + window_ms > watermark_ms)]
+      for start, n in zip(*np.unique(starts, return_counts=True)):
+        windows[int(start)] = windows.get(int(start), 0) + int(n)
+        changed.add(int(start))
+  closed = sorted((start, windows.pop(start)) for start in list(windows) if start + window_ms <= watermark_ms)
+  return sorted(changed.intersection(windows)), closed
+
+def early_count_updater(window_ms, slide_ms, tz):
+  """The applyInPandasWithState function of driver_early_counts.
+
+  pandas gets naive timestamps in the session time zone `tz`, the watermark is in epoch millis.
+  """
+  import numpy as np
+  import pandas as pd
+
+  def to_millis(timestamps):
+    utc = timestamps.dt.tz_localize(tz).dt.tz_convert("UTC")
+    return ((utc - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(milliseconds=1)).to_numpy(dtype="int64")
+
+  def to_timestamps(millis):
+    return pd.to_datetime(millis, unit="ms", utc=True).tz_convert(tz).tz_localize(None)
+
+  def update(key, pdfs, state):
+    windows = dict(zip(*state.get)) if state.exists else {}
+    timestamps = [to_millis(pdf["timestamp"]) for pdf in pdfs]
+    timestamps = np.concatenate(timestamps) if timestamps else np.empty(0, dtype="int64")
+    watermark_ms = state.getCurrentWatermarkMs()
+    changed, closed = advance_windows(windows, timestamps, watermark_ms, window_ms, slide_ms)
+    if windows:
+      state.update((list(windows), list(windows.values())))
+      # fires once the watermark reaches the end of the earliest open window
+      state.setTimeoutTimestamp(builtins.max(builtins.min(windows) + window_ms - 1, watermark_ms + 1))
+    elif state.exists:
+      state.remove()
+    rows = [(start, windows[start], False) for start in changed] + [(start, n, True) for start, n in closed]
+    if rows:
+      starts = np.array([r[0] for r in rows], dtype="int64")
+      yield pd.DataFrame({"driverId": key[0],
+        "window": [{"start": s, "end": e} for s, e in zip(to_timestamps(starts), to_timestamps(starts + window_ms))],
+        "count": [r[1] for r in rows], "final": [r[2] for r in rows]})
+
+  return update
+
+def driver_early_counts(sdf, window_duration="10 seconds", slide_duration="5 seconds", watermark="10 seconds"):
+  """Sliding window counts per driver that don't wait for the watermark.
+
+  Every trigger emits a provisional count (final=false) for each window a driver's new rides
+  fell into, and a final count (final=true) once the watermark passes the end of the window.
+  Windows are kept per driver in applyInPandasWithState state, an event time timeout closes
+  them for drivers without new rides. The output is an upsert stream keyed by driver and window.
+  Needs Spark 3.4+.
+  """
+  from pyspark.sql.streaming.state import GroupStateTimeout
+  update = early_count_updater(duration_ms(window_duration), duration_ms(slide_duration),
+    sdf.sparkSession.conf.get("spark.sql.session.timeZone"))
+  return sdf.withWatermark("timestamp", watermark) \
+            .select("driverId", "timestamp") \
+            .groupBy("driverId") \
+            .applyInPandasWithState(update, EARLY_OUTPUT_SCHEMA, EARLY_STATE_SCHEMA, "append",
+              GroupStateTimeout.EventTimeTimeout)
+
+def driver_revenue(rides, fares, window_duration="10 seconds", slide_duration="5 seconds", watermark="10 seconds",
+    join_bound="1 minute"):
+  """Rides, revenue and tips per driver in sliding windows, joining START rides with their fares on rideId.
+
+  Both sides have a watermark and the fare must arrive within join_bound of its ride, so
+  Spark can drop join state once the watermark passes the bound instead of keeping every
+  unmatched ride and fare. A join followed by an aggregation in append mode needs Spark 3.4+.
+  """
+  starts = rides.where(col("isStart") == "START") \
+                .select("rideId", "driverId", col("timestamp").alias("rideTime")) \
+                .withWatermark("rideTime", watermark)
+  paid = fares.select(col("rideId").alias("fareRideId"), col("timestamp").alias("fareTime"), "totalFare", "tip") \
+              .withWatermark("fareTime", watermark)
+  joined = starts.join(paid, expr(
+    "rideId = fareRideId AND fareTime BETWEEN rideTime - INTERVAL {0} AND rideTime + INTERVAL {0}".format(join_bound)))
+  return joined.groupBy("driverId", window("rideTime", window_duration, slide_duration)) \
+               .agg(count("*").alias("rides"), sum("totalFare").alias("revenue"), sum("tip").alias("tips"))
+
+def zone_window_counts(rides, grid, index_frame, window_duration="10 seconds", slide_duration="5 seconds",
+    watermark="10 seconds"):
+  """Rides per pickup zone in sliding windows, zones from the broadcast cell index of geo_grid."""
+  return geo_grid.enrich(rides, grid, index_frame) \
+    .where(col("startZone").isNotNull()) \
+    .withWatermark("timestamp", watermark) \
+    .groupBy(col("startZone").alias("zone"), window("timestamp", window_duration, slide_duration)).count()
+
+def start_zone_query(spark, args):
+  """Zone counts of --zone-topic, a second query next to the driver counts with its own checkpoint."""
+  grid = geo_grid.Grid(cell_degrees=args.grid_degrees)
+  zones = None
+  if args.zones_geojson:
+    # read through Spark so the file can live on S3
+    zones = geo_grid.load_zones(spark.read.text(args.zones_geojson, wholetext=True).first()[0], args.zone_property)
+  index = geo_grid.build_cell_index(grid, zones)
+  print("GEO {} cells of {} degrees, {} mapped to zones".format(grid.cells, grid.cell_degrees, len(index)), flush=True)
+  rides, _ = parse_data_from_kafka_message(
+    read_kafka_topic(spark, args.bootstrap_servers, "taxirides", args.starting_offsets, args.max_offsets_per_trigger),
+    taxiRidesSchema, args.input_codec, event_time=args.event_time)
+  counts = zone_window_counts(rides, grid, geo_grid.cell_index_frame(spark, index), args.window, args.slide,
+    args.watermark)
+  if args.latency_metrics:
+    counts = observe_emit_latency(counts)
+  return counts.select(col("zone").alias("key"), to_json(struct("zone", "window", "count")).alias("value")) \
+    .writeStream \
+    .queryName("zone_counts") \
+    .outputMode("append") \
+    .format("kafka") \
+    .option("kafka.bootstrap.servers", args.bootstrap_servers) \
+    .options(**kafka_sink_options(args.sink_compression, args.sink_linger_ms, args.sink_batch_size, args.sink_acks)) \
+    .option("topic", args.zone_topic) \
+    .option("checkpointLocation", args.checkpoint.rstrip("/") + "_zones") \
+    .start()
+
+def encode_revenue(sdf, key="driverId"):
+  """JSON value (and driverId key) of the driver_revenue rows, the other codecs only carry counts."""
+  columns = [to_json(struct("driverId", "window", "rides", "revenue", "tips")).alias("value")]
+  if key:
+    columns.insert(0, col(key).cast("string").alias("key"))
+  return sdf.select(columns)
+
+AGGREGATIONS = {"window": driver_window_counts, "pane": driver_pane_counts, "early": driver_early_counts,
+  "salted": driver_salted_counts}
+# the early aggregation needs a stream, in a batch every window is final anyway
+REPLAY_AGGREGATIONS = ["pane", "salted", "window"]
+
+def kafka_range_options(topic, start="earliest", end="latest"):
+  """Kafka batch source options reading topic from start to end, end exclusive.
+
+  Each end is earliest/latest, a per-partition offset map such as {"0": 1200, "1": 1310},
+  or @ and a record time for every partition, epoch millis or 'yyyy-MM-dd HH:mm:ss' in UTC
+  (Spark 3.3+), or @ and a per-partition map of epoch millis.
+  """
+  options = {}
+  for side, spec in (("starting", start.strip()), ("ending", end.strip())):
+    if spec in ("earliest", "latest"):
+      options[side + "Offsets"] = spec
+    elif spec.startswith("@{"):
+      options[side + "OffsetsByTimestamp"] = json.dumps({topic: json.loads(spec[1:])})
+    elif spec.startswith("@"):
+      options[side + "Timestamp"] = str(range_millis(spec))
+    elif spec.startswith("{"):
+      options[side + "Offsets"] = json.dumps({topic: json.loads(spec)})
+    else:
+      raise ValueError("can't read the replay range {!r}, see kafka_range_options".format(spec))
+  return options
+
+def range_millis(spec):
+  """Epoch millis of an @<time> range end, None for the other forms."""
+  if not spec.startswith("@") or spec.startswith("@{"):
+    return None
+  return int(spec[1:]) if spec[1:].isdigit() else text_to_millis(spec[1:])
+
+def read_kafka_range(spark, bootstrap_servers, topic, start, end, min_partitions=None):
+  reader = spark \
+    .read \
+    .format("kafka") \
+    .option("kafka.bootstrap.servers", bootstrap_servers) \
+    .option("subscribe", topic) \
+    .options(**kafka_range_options(topic, start, end))
+  if min_partitions:
+    # Spark splits the offset ranges of big partitions so the read isn't bound to the partition count
+    reader = reader.option("minPartitions", int(min_partitions))
+  return reader.load().select("value", col("timestamp").alias(KAFKA_TIMESTAMP_COL))
+
+def replay(spark, args):
+  """Run the driver aggregation as a batch over --replay-from/--replay-to of taxirides, e.g. after an outage.
+
+  Results go to --replay-output as Parquet, replacing the dt/hour partitions of the windows it
+  covers, so a rerun writes the same records again. Otherwise they are appended to the output
+  topic. The idempotent producer only drops the duplicates of its own retries, a rerun appends
+  every count again and consumers keep the last one per driverId and window. With --event-time
+  kafka and @<time> bounds, windows sticking out of the range are dropped so partial counts
+  never replace complete ones. Returns the catch-up report: rides, seconds, rides/sec and how
+  many times faster than real time.
+  """
+  from pyspark.sql import Observation
+  if args.event_time == "arrival":
+    raise ValueError("a replay needs --event-time kafka or ride, arrival time would put every ride in one window")
+  if args.aggregation not in REPLAY_AGGREGATIONS:
+    raise ValueError("--aggregation {} can't be replayed, choose from {}".format(args.aggregation, REPLAY_AGGREGATIONS))
+  min_partitions = args.replay_min_partitions or spark.sparkContext.defaultParallelism
+  rides, _ = parse_data_from_kafka_message(
+    read_kafka_range(spark, args.bootstrap_servers, "taxirides", args.replay_from, args.replay_to, min_partitions),
+    taxiRidesSchema, args.input_codec, event_time=args.event_time)
+
+  options = {}
+  if args.aggregation == "salted":
+    options = {"hot_keys": args.skew_hot_keys or detect_hot_keys(rides, args.skew_share), "salts": args.skew_salts}
+    print("SKEW hot drivers: {}".format(options["hot_keys"]), flush=True)
+  observation = Observation("replay")
+  rides = rides.observe(observation, count(lit(1)).alias("rides"), min("timestamp").alias("first"),
+    max("timestamp").alias("last"))
+  counts = AGGREGATIONS[args.aggregation](rides, args.window, args.slide, args.watermark, **options)
+  first, last = range_millis(args.replay_from.strip()), range_millis(args.replay_to.strip())
+  if args.event_time == "kafka" and first is not None:
+    counts = counts.where(col("window.start") >= (lit(first) / 1000).cast("timestamp"))
+  if args.event_time == "kafka" and last is not None:
+    counts = counts.where(col("window.end") <= (lit(last) / 1000).cast("timestamp"))
+
+  start = time.time()
+  if args.replay_output:
+    counts.withColumn("dt", date_format("window.start", "yyyy-MM-dd")) \
+      .withColumn("hour", date_format("window.start", "HH")) \
+      .write \
+      .mode("overwrite") \
+      .option("partitionOverwriteMode", "dynamic") \
+      .partitionBy("dt", "hour") \
+      .parquet(args.replay_output)
+  else:
+    encode_payload(counts, args.output_codec, key=None if args.output_key == "none" else args.output_key) \
+      .write \
+      .format("kafka") \
+      .option("kafka.bootstrap.servers", args.bootstrap_servers) \
+      .options(**kafka_sink_options(args.sink_compression, args.sink_linger_ms, args.sink_batch_size, "all")) \
+      .option("kafka.enable.idempotence", "true") \
+      .option("topic", args.output_topic) \
+      .save()
+  seconds = time.time() - start
+  return replay_report(observation.get, seconds, min_partitions)
+
+def replay_report(observed, seconds, partitions):
+  """The catch-up report of replay() from its observed rides/first/last and the write time."""
+  report = {"rides": observed["rides"], "seconds": builtins.round(seconds, 1),
+    "rides_per_sec": builtins.round(observed["rides"] / seconds) if seconds else None, "partitions": partitions}
+  if observed["rides"]:
+    span = (observed["last"] - observed["first"]).total_seconds()
+    report.update({"first": str(observed["first"]), "last": str(observed["last"]),
+      "times_real_time": builtins.round(span / seconds, 1) if seconds else None})
+  return report
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(description="Count taxi rides per driver in sliding windows, from MSK to MSK")
+  parser.add_argument("bootstrap_servers", help="MSK bootstrap servers")
+  parser.add_argument("checkpoint", help="checkpoint location of the output query")
+  parser.add_argument("output_topic", help="Kafka topic to write the driver counts to")
+  parser.add_argument("malformed_path", nargs="?", help="optional path to keep records that failed to decode")
+  parser.add_argument("--input-codec", choices=CODECS, default="csv", help="payload format of the taxirides topic")
+  parser.add_argument("--output-codec", choices=CODECS, default="json", help="payload format of the output topic")
+  parser.add_argument("--output-key", choices=["driverId", "none"], default="driverId",
+    help="record key of the output topic, keying by driverId keeps a driver's counts in one partition")
+  parser.add_argument("--sink-compression", choices=["none", "gzip", "snappy", "lz4", "zstd"], default="lz4",
+    help="compression of the output topic batches")
+  parser.add_argument("--sink-linger-ms", type=int, default=20, help="how long the sink producer waits to fill a batch")
+  parser.add_argument("--sink-batch-size", type=int, default=256 * 1024, help="sink producer batch size in bytes")
+  parser.add_argument("--sink-acks", choices=["0", "1", "all"], help="sink producer acks, client default if not set")
+  parser.add_argument("--window", default="10 seconds", help="sliding window length")
+  parser.add_argument("--slide", default="5 seconds", help="sliding window interval")
+  parser.add_argument("--watermark", default="10 seconds", help="how late a ride may arrive")
+  parser.add_argument("--event-time", choices=EVENT_TIMES, default="arrival",
+    help="what the windows run on: the batch start (arrival), the Kafka record timestamp (kafka) "
+         "or the ride time in the record (ride)")
+  parser.add_argument("--latency-metrics", action="store_true",
+    help="publish input lag and window emit latency histograms with the --metrics sinks (Spark 3.3+)")
+  parser.add_argument("--aggregation", choices=sorted(AGGREGATIONS) + ["revenue"], default="window",
+    help="window: explode every ride into its sliding windows, pane: count non-overlapping panes and combine them, "
+    "early: provisional counts every trigger and a final one when the window closes, "
+    "salted: pane aggregation with the hot drivers spread over --skew-salts partitions, "
+    "revenue: join rides with --fares-topic and sum the fares per driver (JSON output)")
+  parser.add_argument("--fares-topic", default="taxifares", help="fares topic of --aggregation revenue")
+  parser.add_argument("--fares-codec", choices=[c for c in CODECS if c != "fixed"], default="csv",
+    help="payload format of the fares topic")
+  parser.add_argument("--join-bound", default="1 minute",
+    help="how far apart a ride and its fare may arrive, bounds the join state with the watermark")
+  parser.add_argument("--skew-hot-keys", type=lambda v: [int(k) for k in v.split(",")],
+    help="comma-separated hot driverIds for --aggregation salted, detected from recent rides if not set")
+  parser.add_argument("--skew-salts", type=int, default=8, help="partitions a hot driver is spread over")
+  parser.add_argument("--skew-share", type=float, default=0.01,
+    help="a driver with more than this share of the recent rides is hot")
+  parser.add_argument("--skew-lookback", default="5 minutes", help="how far back hot drivers are detected from")
+  parser.add_argument("--zone-topic", help="also count rides per pickup zone in the same windows into this topic")
+  parser.add_argument("--zones-geojson", help="GeoJSON zones, e.g. the NYC TLC taxi zones, every grid cell is a zone if not set")
+  parser.add_argument("--zone-property", default="zone", help="feature property holding the zone name")
+  parser.add_argument("--grid-degrees", type=float, default=0.005, help="grid cell size in degrees")
+  parser.add_argument("--state-store", choices=sorted(STATE_STORE_PROVIDERS), default="hdfs",
+    help="state store backend of the window aggregation")
+  parser.add_argument("--rocksdb-memory-mb", type=int, help="bound the RocksDB memory per executor")
+  parser.add_argument("--state-report", action="store_true",
+    help="print state rows, memory and commit time of each batch")
+  parser.add_argument("--replay-from", help="run a batch replay from earliest, {partition: offset} JSON or "
+    "@<epoch millis|yyyy-MM-dd HH:mm:ss UTC> instead of the stream, needs --event-time kafka or ride")
+  parser.add_argument("--replay-to", default="latest", help="end of the replay, exclusive, same forms as --replay-from")
+  parser.add_argument("--replay-output", help="write the replayed counts to this Parquet path instead of the output topic, "
+    "only this path can be rerun without duplicates")
+  parser.add_argument("--replay-min-partitions", type=int,
+    help="Spark partitions of the replay read, defaults to the default parallelism")
+  parser.add_argument("--starting-offsets", default="latest",
+    help="where a new checkpoint starts reading: latest, earliest or a JSON offsets spec")
+  parser.add_argument("--max-offsets-per-trigger", type=int, help="fixed cap of offsets read per batch")
+  parser.add_argument("--trigger-interval", help="fixed processing time trigger, e.g. '10 seconds'")
+  parser.add_argument("--target-batch-seconds", type=float,
+    help="adapt maxOffsetsPerTrigger and the trigger interval to hold this batch duration")
+  parser.add_argument("--metrics", help="stream_metrics sinks, e.g. 'prom:/tmp/stream.prom,emf:stdout', "
+    "defaults to the spark.stream.metrics.sinks conf")
+  parser.add_argument("--monitor-interval", type=float, default=5.0, help="seconds between progress checks")
+  return parser.parse_args(argv)
+
+def start_output_query(spark, args, max_offsets_per_trigger=None, trigger_seconds=None):
+  max_offsets_per_trigger = max_offsets_per_trigger or args.max_offsets_per_trigger
+  sdfRides, _ = parse_data_from_kafka_message(
+    read_kafka_topic(spark, args.bootstrap_servers, "taxirides", args.starting_offsets, max_offsets_per_trigger),
+    taxiRidesSchema, args.input_codec, event_time=args.event_time)
+  if args.latency_metrics and args.event_time != "arrival":
+    sdfRides = observe_input_lag(sdfRides)
+  emitted = observe_emit_latency if args.latency_metrics else lambda sdf: sdf
+
+  if args.aggregation == "revenue":
+    if args.output_codec != "json":
+      raise ValueError("--aggregation revenue writes JSON, drop --output-codec {}".format(args.output_codec))
+    sdfFares, _ = parse_data_from_kafka_message(
+      read_kafka_topic(spark, args.bootstrap_servers, args.fares_topic, args.starting_offsets, max_offsets_per_trigger),
+      taxiFaresSchema, args.fares_codec, "TaxiFare", args.event_time)
+    revenue = emitted(driver_revenue(sdfRides, sdfFares, args.window, args.slide, args.watermark, args.join_bound))
+    return start_kafka_sink(encode_revenue(revenue, None if args.output_key == "none" else args.output_key),
+      args, trigger_seconds)
+
+  options = {}
+  if args.aggregation == "salted":
+    # detected again whenever the query is (re)started, e.g. by the backpressure controller
+    hot_keys = args.skew_hot_keys or detect_hot_keys(
+      recent_rides(spark, args.bootstrap_servers, "taxirides", args.skew_lookback, args.input_codec), args.skew_share)
+    print("SKEW hot drivers: {}".format(hot_keys), flush=True)
+    options = {"hot_keys": hot_keys, "salts": args.skew_salts}
+  query = emitted(AGGREGATIONS[args.aggregation](sdfRides, args.window, args.slide, args.watermark, **options))
+
+  # query.writeStream \
+  #     .outputMode("append") \
+  #     .format("console") \
+  #     .option("checkpointLocation", "s3://test/stream/checkpoint/consumer_taxi2") \
+  #     .option("truncate", False) \
+  #     .start() \
+  #     .awaitTermination()
+
+  return start_kafka_sink(encode_payload(query, args.output_codec,
+    key=None if args.output_key == "none" else args.output_key), args, trigger_seconds)
+
+def start_kafka_sink(encoded, args, trigger_seconds=None):
+  writer=encoded \
+    .writeStream \
+    .outputMode("append") \
+    .format("kafka") \
+    .option("kafka.bootstrap.servers", args.bootstrap_servers) \
+    .options(**kafka_sink_options(args.sink_compression, args.sink_linger_ms, args.sink_batch_size, args.sink_acks)) \
+    .option("topic", args.output_topic) \
+    .option("checkpointLocation", args.checkpoint) \
+    .queryName("driver_counts")
+  trigger = "{} seconds".format(trigger_seconds) if trigger_seconds else args.trigger_interval
+  if trigger:
+    writer = writer.trigger(processingTime=trigger)
+  return writer.start()
+
+if __name__ == "__main__":
+  args = parse_args()
+  spark = SparkSession.builder \
+    .appName("Spark Structured Streaming from Kafka") \
+    .getOrCreate()
+  configure_state_store(spark, args.state_store, args.rocksdb_memory_mb)
+  metrics = stream_metrics.attach(spark, args.metrics, args.monitor_interval)
+
+  if args.replay_from:
+    report = replay(spark, args)
+    print("REPLAY " + json.dumps(report), flush=True)
+    # exported like the progress of a batch, so the catch-up shows next to the streaming metrics
+    stream_metrics.ProgressExporter(stream_metrics.sinks_from_spec(
+      args.metrics if args.metrics is not None else spark.conf.get(stream_metrics.CONF_KEY, ""))).export({
+      "name": "replay", "batchId": 0, "numInputRows": report["rides"],
+      "processedRowsPerSecond": report["rides_per_sec"], "durationMs": {"triggerExecution": report["seconds"] * 1000}})
+    spark.stop()
+    raise SystemExit
+
+  if args.malformed_path:
+    _, sdfRidesMalformed = parse_data_from_kafka_message(
+      read_kafka_topic(spark, args.bootstrap_servers, "taxirides", args.starting_offsets, args.max_offsets_per_trigger),
+      taxiRidesSchema, args.input_codec)
+    sdfRidesMalformed.writeStream \
+      .queryName("malformed_rides") \
+      .outputMode("append") \
+      .format("json") \
+      .option("path", args.malformed_path) \
+      .option("checkpointLocation", args.checkpoint.rstrip("/") + "_malformed") \
+      .start()
+
+  if args.zone_topic:
+    start_zone_query(spark, args)
+
+  controller = None
+  if args.target_batch_seconds:
+    controller = BackpressureController(args.target_batch_seconds,
+      initial_cap=args.max_offsets_per_trigger or 100000)
+  try:
+    run_monitored(spark, lambda cap, trigger: start_output_query(spark, args, cap, trigger),
+      controller, args.state_report, args.monitor_interval)
+  finally:
+    stream_metrics.close(metrics)
@@ -0,0 +1,218 @@
+"""Rate-controlled taxi ride producer for the taxirides topic.
+
+Replaces the `zcat | split | kafka-console-producer.sh` loop: one long-lived producer with
+async batched sends, configurable compression/linger, records keyed by driverId and a
+token bucket holding the target events/sec. Needs `pip install kafka-python lz4 numpy`.
+
+  python3 msk_producer.py $MSK_SERVER nycTaxiRides.gz --rate 20000 --compression lz4
+
+Pass `memory` as the bootstrap servers to run against the in-process MemoryProducer instead
+of a broker, e.g. to measure the encoder and rate controller on their own. The input
+`synthetic` sends taxi_generator.py rides instead of a file, with its --drivers, --skew,
+--disorder-seconds and --late-rate options:
+
+  python3 msk_producer.py $MSK_SERVER synthetic --rate 50000 --drivers 100000 --skew 1.2 --limit 10000000
+"""
+import argparse
+import gzip
+import sys
+import threading
+import time
+
+import taxi_codec
+import taxi_generator
+
+RECORDS = {"rides": taxi_codec.RIDE_FIELDS, "fares": taxi_codec.FARE_FIELDS}
+
+class TokenBucket:
+  """Token bucket allowing `rate` events/sec on average and bursts of up to `capacity` events."""
+
+  def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+    self.rate = float(rate)
+    self.capacity = float(capacity or rate)
+    self._clock = clock
+    self._sleep = sleep
+    self._tokens = self.capacity
+    self._last = clock()
+
+  def _refill(self):
+    now = self._clock()
+    self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+    self._last = now
+
+  def acquire(self, n=1):
+    """Block until n tokens are available, then take them. Returns the time spent waiting."""
+    waited = 0.0
+    self._refill()
+    # a request bigger than the bucket is served once the bucket is full, leaving a debt
+    need = min(n, self.capacity)
+    if self._tokens < need:
+      # sleep once for the deficit, re-checking would spin on refills a rounding error short
+      waited = (need - self._tokens) / self.rate
+      self._sleep(waited)
+      self._refill()
+    self._tokens -= n
+    return waited
+
+class ThroughputReporter:
+  """Counts acknowledged sends and prints the rate every `interval` seconds."""
+
+  def __init__(self, interval=5.0, out=sys.stdout, clock=time.monotonic):
+    self.interval = interval
+    self.out = out
+    self._clock = clock
+    self._lock = threading.Lock()
+    self.sent = self.acked = self.failed = self.bytes = 0
+    self._start = self._last_report = clock()
+    self._last_acked = 0
+
+  def on_send(self, size):
+    self.sent += 1
+    self.bytes += size
+
+  def on_success(self, metadata=None):
+    with self._lock:
+      self.acked += 1
+
+  def on_error(self, exc):
+    with self._lock:
+      self.failed += 1
+
+  def maybe_report(self, force=False):
+    now = self._clock()
+    if not force and now - self._last_report < self.interval:
+      return
+    with self._lock:
+      acked = self.acked
+    rate = (acked - self._last_acked) / max(now - self._last_report, 1e-9)
+    self.out.write("sent={} acked={} failed={} rate={:,.0f} msg/s avg={:,.0f} msg/s {:.1f} MB\n".format(
+      self.sent, acked, self.failed, rate, acked / max(now - self._start, 1e-9), self.bytes / 1e6))
+    self.out.flush()
+    self._last_report, self._last_acked = now, acked
+
+class _MemoryFuture:
+  def __init__(self, error=None):
+    self._error = error
+
+  def add_callback(self, fn, *args, **kwargs):
+    if self._error is None:
+      fn(*args, None, **kwargs)
+    return self
+
+  def add_errback(self, fn, *args, **kwargs):
+    if self._error is not None:
+      fn(*args, self._error, **kwargs)
+    return self
+
+class MemoryProducer:
+  """In-process stand-in for kafka.KafkaProducer, keeps the records per topic and partition."""
+
+  def __init__(self, partitions=2, fail_every=0, **config):
+    self.config = config
+    self.partitions = partitions
+    self.fail_every = fail_every
+    self.records = {}
+    self._count = 0
+
+  def send(self, topic, value=None, key=None):
+    self._count += 1
+    if self.fail_every and self._count % self.fail_every == 0:
+      return _MemoryFuture(RuntimeError("simulated send failure"))
+    partition = hash(key) % self.partitions if key is not None else self._count % self.partitions
+    self.records.setdefault((topic, partition), []).append((key, value))
+    return _MemoryFuture()
+
+  def flush(self, timeout=None):
+    pass
+
+  def close(self, timeout=None):
+    pass
+
+def create_producer(bootstrap_servers, compression=None, linger_ms=20, batch_size=256 * 1024,
+    acks=1, buffer_memory=64 * 1024 * 1024):
+  config = dict(compression_type=compression, linger_ms=linger_ms, batch_size=batch_size,
+    acks=acks, buffer_memory=buffer_memory)
+  if bootstrap_servers == "memory":
+    return MemoryProducer(**config)
+  from kafka import KafkaProducer
+  return KafkaProducer(bootstrap_servers=bootstrap_servers.split(","), **config)
+
+def read_rides(path, loops=1, fields=taxi_codec.RIDE_FIELDS):
+  """Yield ride tuples from a (gzipped) nycTaxiRides CSV file, `loops` times (0 = forever).
+
+  With fields=taxi_codec.FARE_FIELDS it reads fare tuples from nycTaxiFares instead.
+  """
+  opener = gzip.open if path.endswith(".gz") else open
+  n = 0
+  while loops == 0 or n < loops:
+    with opener(path, "rt") as f:
+      for line in f:
+        if line.strip():
+          yield taxi_codec.parse_ride_line(line, fields)
+    n += 1
+
+def produce(producer, rides, topic="taxirides", codec="csv", rate=None, burst=None,
+    chunk=500, reporter=None, limit=None, record="rides"):
+  """Send rides (or fares with record="fares") keyed by driverId, pacing chunks of `chunk` records through a token bucket.
+
+  Sends are asynchronous, the client batches them by partition according to its linger/batch
+  settings. Returns the number of records handed to the producer.
+  """
+  fields = RECORDS[record]
+  encode = (taxi_codec.ride_encoder if record == "rides" else taxi_codec.fare_encoder)(codec)
+  driver_id = [name for name, _ in fields].index("driverId")
+  bucket = TokenBucket(rate, burst or max(rate, chunk)) if rate else None
+  reporter = reporter or ThroughputReporter()
+  sent = 0
+  for ride in rides:
+    if bucket is not None and sent % chunk == 0:
+      bucket.acquire(chunk)
+    value = encode(ride)
+    producer.send(topic, value=value, key=str(ride[driver_id]).encode()) \
+      .add_callback(reporter.on_success).add_errback(reporter.on_error)
+    reporter.on_send(len(value))
+    sent += 1
+    if sent % chunk == 0:
+      reporter.maybe_report()
+    if limit and sent >= limit:
+      break
+  producer.flush()
+  reporter.maybe_report(force=True)
+  return sent
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(description="Send taxi rides to MSK at a target rate")
+  parser.add_argument("bootstrap_servers", help="MSK bootstrap servers, or 'memory' for the in-process fake")
+  parser.add_argument("input", help="nycTaxiRides.gz or any CSV file in the same format, or 'synthetic'")
+  parser.add_argument("--record", choices=sorted(RECORDS), default="rides",
+    help="fares reads nycTaxiFares.gz lines, e.g. with --topic taxifares")
+  parser.add_argument("--topic", default="taxirides")
+  parser.add_argument("--codec", choices=taxi_codec.CODECS, default="csv", help="payload format, see taxi_codec.py")
+  parser.add_argument("--rate", type=float, help="target events/sec, unlimited if not set")
+  parser.add_argument("--burst", type=int, help="token bucket capacity in events, defaults to one second at --rate")
+  parser.add_argument("--compression", choices=["gzip", "snappy", "lz4", "zstd"], help="producer compression type")
+  parser.add_argument("--linger-ms", type=int, default=20)
+  parser.add_argument("--batch-size", type=int, default=256 * 1024, help="producer batch size in bytes")
+  parser.add_argument("--acks", default="1", help="0, 1 or all")
+  parser.add_argument("--loops", type=int, default=1, help="replay the input file this many times, 0 = forever")
+  parser.add_argument("--limit", type=int, help="stop after this many records")
+  parser.add_argument("--report-interval", type=float, default=5.0)
+  taxi_generator.add_generator_args(parser.add_argument_group("synthetic input"))
+  args = parser.parse_args(argv)
+  if args.input == "synthetic" and args.record != "rides":
+    parser.error("the synthetic input only generates rides")
+  return args
+
+if __name__ == "__main__":
+  args = parse_args()
+  producer = create_producer(args.bootstrap_servers, args.compression, args.linger_ms, args.batch_size,
+    acks=args.acks if args.acks == "all" else int(args.acks))
+  if args.input == "synthetic":
+    rides = taxi_generator.generator_from_args(args).rides(args.limit)
+  else:
+    rides = read_rides(args.input, args.loops, RECORDS[args.record])
+  try:
+    produce(producer, rides, args.topic, args.codec, args.rate,
+      args.burst, reporter=ThroughputReporter(args.report_interval), limit=args.limit, record=args.record)
+  finally:
+    producer.close()
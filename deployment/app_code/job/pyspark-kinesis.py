@@ -1,9 +1,12 @@
 from __future__ import print_function
 
 from pyspark.streaming.kinesis import KinesisUtils, InitialPositionInStream
-from pyspark import SparkContext
+from pyspark import SparkConf, SparkContext
 from pyspark.streaming import StreamingContext
-import boto3,json,sys
+from pyspark.sql import SparkSession
+import argparse,json
+import kinesis_decode
+import kinesis_writer
 
 # def printRecord(rdd):
 #     print("========================================================")
@@ -11,19 +14,59 @@ import boto3,json,sys
 #     print("========================================================")
 #     rdd.foreach(lambda record: print(record.encode('utf8')))
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Read the pyspark-kinesis stream with Kinesis receivers")
+    parser.add_argument('region')
+    parser.add_argument('output', nargs='?', help="S3 prefix for the text output, not written by default")
+    parser.add_argument('--stream-name', default='pyspark-kinesis')
+    parser.add_argument('--target-records-per-sec', type=int,
+                        help="size a newly created stream for this rate, 1 shard if not set")
+    parser.add_argument('--receivers', type=int,
+                        help="Kinesis receivers to start, defaults to one per open shard")
+    parser.add_argument('--batch-interval', type=float, default=2, help="seconds")
+    parser.add_argument('--block-interval', default='200ms',
+                        help="spark.streaming.blockInterval, i.e. the tasks per receiver and batch")
+    parser.add_argument('--checkpoint-interval', type=int, default=2, help="KCL checkpoint interval in seconds")
+    parser.add_argument('--decode', choices=kinesis_decode.MODES, default='dataframe',
+                        help="how the JSON messages are decoded, see kinesis_decode.py")
+    parser.add_argument('--endpoint-url', help="Kinesis endpoint, defaults to the regional one")
+    return parser.parse_args(argv)
+
+
+def receiver_count(shards, requested=None):
+    # one receiver per shard at most, a receiver without a shard lease just idles
+    return max(1, min(requested or shards, shards))
+
+
+def create_streams(ssc, app_name, stream_name, endpoint_url, region, receivers, checkpoint_interval):
+    """Start `receivers` Kinesis receivers and union them into one DStream.
+
+    They share the KCL application name, so the lease table spreads the shards across them
+    and each receiver pulls its own group of shards on its own executor core.
+    """
+    streams = [KinesisUtils.createStream(ssc, app_name, stream_name, endpoint_url, region,
+                                         InitialPositionInStream.LATEST, checkpoint_interval)
+               for _ in range(receivers)]
+    return streams[0] if receivers == 1 else ssc.union(*streams)
+
+
+def report_throughput(batch_interval):
+    def report(batch_time, rdd):
+        count = rdd.count()
+        print("{} records={} rate={:,.0f} rec/s".format(batch_time, count, count / batch_interval))
+    return report
+
+
 if __name__ == "__main__":
+    args = parse_args()
 
     # creating the Kinesis stream
-    stream_name='pyspark-kinesis'
-    client_region = sys.argv[1]
-    client = boto3.client('kinesis', client_region)
-    try:
-        print("create a new stream")
-        client.create_stream(
-                StreamName=stream_name,
-                ShardCount=1)
-    except:
-        print("the stream exists")
+    stream_name = args.stream_name
+    client_region = args.region
+    client = kinesis_writer.make_client(client_region, args.endpoint_url)
+    shard_count = kinesis_writer.shard_count_for(args.target_records_per_sec) if args.target_records_per_sec else 1
+    shards = kinesis_writer.ensure_stream(client, stream_name, shard_count)
+    receivers = receiver_count(shards, args.receivers)
     # creating a couple of messages to send to kinesis
     # messages = [
     #     {'message_type': 'message1', 'count': 2},
@@ -42,22 +85,36 @@ if __name__ == "__main__":
 
     # start Spark process, read from kinesis
     appName = "PythonStreamingKinesisAsl"
-    endpointUrl="https://kinesis."+client_region+".amazonaws.com"
-    sc = SparkContext(appName=appName)
-    ssc = StreamingContext(sc, 2)
+    endpointUrl = args.endpoint_url or "https://kinesis."+client_region+".amazonaws.com"
+    conf = SparkConf().setAppName(appName).set('spark.streaming.blockInterval', args.block_interval)
+    sc = SparkContext(conf=conf)
+    # every receiver pins a core for the life of the job, leave some for the batches
+    cores = int(sc.getConf().get('spark.executor.instances', '1')) * int(sc.getConf().get('spark.executor.cores', '1'))
+    if receivers >= cores:
+        print("WARNING: {} receivers on {} executor cores leaves no core to process the batches".format(receivers, cores))
+    print("stream {}: {} open shards, {} receivers".format(stream_name, shards, receivers))
+    ssc = StreamingContext(sc, args.batch_interval)
 
-    kinesis = KinesisUtils.createStream(ssc,appName,stream_name,endpointUrl,client_region, InitialPositionInStream.LATEST, 2)
-    kinesis.pprint()
+    # every batch is counted, then decoded and printed. Cached, the receiver blocks are read
+    # once for all of it, and Spark Streaming unpersists each batch once it's done
+    kinesis = create_streams(ssc, appName, stream_name, endpointUrl, client_region, receivers,
+                             args.checkpoint_interval).cache()
+    kinesis.foreachRDD(report_throughput(args.batch_interval))
     # # write to s3
     # py_rdd = kinesis.map(lambda x: json.loads(x.encode('utf8')))
-    # py_rdd.saveAsTextFiles(sys.argv[2])
+    # py_rdd.saveAsTextFiles(args.output)
+
+    # print to console, each batch decoded by the JVM JSON reader by default, see kinesis_decode.py
+    if args.decode == 'dataframe':
+        spark = SparkSession(sc)
 
-    def format_sample(x):
-        data = json.loads(x)
-        return (data['message_type'], json.dumps(data))
-    # print to console
-    parsed = kinesis.map(lambda x: format_sample(x))
-    parsed.pprint()
+        def show_batch(rdd):
+            if not rdd.isEmpty():
+                kinesis_decode.decode(rdd, args.decode, spark).show()
+        kinesis.foreachRDD(show_batch)
+    else:
+        parsed = kinesis.transform(lambda rdd: kinesis_decode.decode(rdd, args.decode))
+        parsed.pprint()
 
     ssc.start()
-    ssc.awaitTermination()
\ No newline at end of file
+    ssc.awaitTermination()
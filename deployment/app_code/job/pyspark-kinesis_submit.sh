@@ -10,8 +10,8 @@ aws emr-containers start-job-run \
 --job-driver '{
     "sparkSubmitJobDriver":{
         "entryPoint": "s3://'$S3BUCKET'/app_code/job/pyspark-kinesis.py",
-        "entryPointArguments":["'${AWS_REGION}'","s3://'$S3BUCKET'/asloutput/"],
-        "sparkSubmitParameters": "--jars https://repo1.maven.org/maven2/org/apache/spark/spark-streaming-kinesis-asl_2.12/3.1.2/spark-streaming-kinesis-asl_2.12-3.1.2.jar,https://repo1.maven.org/maven2/com/amazonaws/amazon-kinesis-client/1.12.0/amazon-kinesis-client-1.12.0.jar"}}' \
+        "entryPointArguments":["'${AWS_REGION}'","s3://'$S3BUCKET'/asloutput/","--target-records-per-sec","4000","--batch-interval","2","--block-interval","200ms"],
+        "sparkSubmitParameters": "--py-files s3://'$S3BUCKET'/app_code/job/kinesis_writer.py,s3://'$S3BUCKET'/app_code/job/kinesis_decode.py --conf spark.executor.instances=4 --conf spark.executor.cores=2 --jars https://repo1.maven.org/maven2/org/apache/spark/spark-streaming-kinesis-asl_2.12/3.1.2/spark-streaming-kinesis-asl_2.12-3.1.2.jar,https://repo1.maven.org/maven2/com/amazonaws/amazon-kinesis-client/1.12.0/amazon-kinesis-client-1.12.0.jar"}}' \
 --configuration-overrides '{
     "applicationConfiguration": [
         {
@@ -1,79 +1,203 @@
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import from_json, col
+from pyspark.sql.functions import from_json, col, date_format
 from pyspark.sql.types import StructField, StructType, StringType, IntegerType
-import boto3,json,sys
-
-# creating a Kinesis stream
-stream_name='pyspark-kinesis'
-client_region = sys.argv[1]
-client = boto3.client('kinesis', client_region)
-
-try:
-    print("create a new stream")
-    client.create_stream(
-            StreamName=stream_name,
-            ShardCount=1)
-except:
-    print("the stream exists")
-
-# sending a couple of messages to kinesis
-messages = [
-    {'message_type': 'message1', 'count': 2},
-    {'message_type': 'message2', 'count': 1},
-    {'message_type': 'message1', 'count': 2},
-    {'message_type': 'message3', 'count': 3},
-    {'message_type': 'message1', 'count': 5}
-]
-for message in messages:
-    client.put_record(
-        StreamName=stream_name,
-        Data=json.dumps(message),
-        PartitionKey='part_key')
-
-spark = SparkSession.builder \
-    .appName('PySparkKinesis') \
-    .getOrCreate()
-
-# spark.sparkContext.setLogLevel("DEBUG")
-kinesis = spark \
-    .readStream \
-    .format('kinesis') \
-    .option('streamName', stream_name) \
-    .option('endpointUrl', 'https://kinesis.'+client_region+'.amazonaws.com')\
-    .option('region', client_region) \
-    .option('startingposition', 'TRIM_HORIZON')\
-    .option('awsUseInstanceProfile', 'false') \
-    .load()
+import argparse,json,math
+import kinesis_writer
+import stream_metrics
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Read the pyspark-kinesis stream with the kinesis-sql connector")
+    parser.add_argument('region')
+    parser.add_argument('checkpoint', nargs='?', help="checkpoint location, required by the parquet sink")
+    parser.add_argument('output', nargs='?', help="parquet output path, required by the parquet sink")
+    parser.add_argument('--sink', choices=['console', 'parquet'], default='console')
+    parser.add_argument('--trigger', choices=['once', 'available-now'], default='once',
+                        help="available-now drains the backlog in batches of --max-records-per-shard")
+    parser.add_argument('--max-records-per-shard', type=int, default=100000,
+                        help="records fetched from each shard per batch")
+    parser.add_argument('--max-batches', type=int, default=1000, help="stop draining after this many batches")
+    parser.add_argument('--target-file-mb', type=int, default=128, help="approximate parquet file size")
+    parser.add_argument('--row-bytes', type=int, default=48,
+                        help="bytes per row in compressed parquet for the first batch, to turn --target-file-mb into "
+                             "rows. The next batches measure it on the files written")
+    parser.add_argument('--endpoint-url', help="Kinesis endpoint, defaults to the regional one")
+    parser.add_argument('--skip-sample', action='store_true', help="don't send the sample messages")
+    args = parser.parse_args(argv)
+    if args.sink == 'parquet' and not (args.checkpoint and args.output):
+        parser.error("the parquet sink needs the checkpoint and output arguments")
+    return args
 
 
 schema = StructType([
             StructField("message_type", StringType()),
             StructField("count", IntegerType())])
 
-     
-kinesis.selectExpr('CAST(data AS STRING)')\
-    .select(from_json('data', schema).alias('data'))\
-    .select('data.*')\
-    .writeStream \
-    .outputMode('append')\
-    .format('console') \
-    .trigger(once=True) \
-    .start() \
-    .awaitTermination()
-
-# write to s3
-# kinesis.selectExpr('CAST(data AS STRING)')\
-#     .select(from_json('data',data_schema).alias('data'))\
-#     .select('data.*')\
-#     .writeStream \
-#     .outputMode('append')\
-#     .format('parquet') \
-#     .option('truncate', True) \
-#     .option('checkpointLocation', sys.argv[2]) \
-#     .option('path',sys.argv[3]) \
-#     .trigger(processingTime='5 seconds') \
-#     .start() \
-#     .awaitTermination()
-
-# delete the kinesis stream
-# client.delete_stream(StreamName=stream_name)
+
+def read_stream(spark, stream_name, endpoint_url, region, max_records_per_shard):
+    kinesis = spark \
+        .readStream \
+        .format('kinesis') \
+        .option('streamName', stream_name) \
+        .option('endpointUrl', endpoint_url)\
+        .option('region', region) \
+        .option('startingposition', 'TRIM_HORIZON')\
+        .option('kinesis.executor.maxFetchRecordsPerShard', max_records_per_shard) \
+        .option('awsUseInstanceProfile', 'false') \
+        .load()
+    return kinesis.selectExpr('CAST(data AS STRING)', 'approximateArrivalTimestamp AS event_time')\
+        .select(from_json('data', schema).alias('data'), 'event_time')\
+        .select('data.*', 'event_time')
+
+
+def start_console(parsed):
+    return parsed.writeStream \
+        .queryName('kinesis_console') \
+        .outputMode('append')\
+        .format('console') \
+        .trigger(once=True) \
+        .start()
+
+
+def rows_per_file(target_file_mb, row_bytes):
+    return max(1, int(math.ceil(target_file_mb * 1024 * 1024 / float(row_bytes))))
+
+
+def start_parquet(parsed, checkpoint, output, max_rows_per_file):
+    # one writer task per hour directory, files rolled over at max_rows_per_file
+    return parsed \
+        .withColumn('dt', date_format('event_time', 'yyyy-MM-dd')) \
+        .withColumn('hour', date_format('event_time', 'HH')) \
+        .repartition('dt', 'hour') \
+        .writeStream \
+        .queryName('kinesis_parquet') \
+        .outputMode('append')\
+        .format('parquet') \
+        .partitionBy('dt', 'hour') \
+        .option('maxRecordsPerFile', max_rows_per_file) \
+        .option('checkpointLocation', checkpoint) \
+        .option('path', output) \
+        .trigger(once=True) \
+        .start()
+
+
+def last_progress(query):
+    progress = query.lastProgress
+    if progress is None or isinstance(progress, dict):
+        return progress
+    return json.loads(progress.json)
+
+
+def shard_positions(progress):
+    """{shard id: sequence number} the kinesis source of progress ended its batch at, shards not read yet left out."""
+    end = progress['sources'][0].get('endOffset') if progress and progress.get('sources') else None
+    if isinstance(end, str):
+        end = json.loads(end)
+    return {shard: int(position['iteratorPosition']) for shard, position in (end or {}).items()
+            if shard != 'metadata' and str(position.get('iteratorPosition', '')).isdigit()}
+
+
+def caught_up(positions, targets):
+    return all(positions.get(shard, -1) >= int(sequence_number) for shard, sequence_number in targets.items())
+
+
+def written_row_bytes(spark, output, progress):
+    """Bytes per row of the files the batch of progress wrote, from the sink's _spark_metadata log.
+
+    None without rows, or when the batch's log was compacted with the earlier ones (every 10th batch).
+    """
+    rows = progress['sink'].get('numOutputRows', -1) if progress.get('sink') else -1
+    rows = rows if rows > 0 else progress['numInputRows']
+    log_file = '{}/_spark_metadata/{}'.format(output, progress['batchId'])
+    jvm = spark.sparkContext._jvm
+    log_path = jvm.org.apache.hadoop.fs.Path(log_file)
+    if not rows or not log_path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration()).exists(log_path):
+        return None
+    # not spark.read, it skips everything under a directory starting with _
+    log = spark.sparkContext.textFile(log_file).collect()
+    # a version line, then one SinkFileStatus per line
+    sizes = [json.loads(line)['size'] for line in log if line.startswith('{')]
+    return float(sum(sizes)) / rows if sizes else None
+
+
+def drain(start, max_batches, targets=None, row_bytes=48, measure=lambda progress: None, max_empty=3):
+    """availableNow for the kinesis-sql connector: bounded trigger-once batches until the backlog is read.
+
+    The connector decides a batch's end offsets while the executors fetch, so Spark's own
+    availableNow would run a single capped batch. Each run resumes from the checkpoint. The
+    backlog is read once every shard reached its sequence number in targets, e.g. the
+    kinesis_writer.latest_sequence_numbers when the drain started. A batch can come back empty
+    before that, the drain gives up after max_empty of them in a row. Without targets it stops
+    at the first empty batch. start(row_bytes) runs a batch, and measure(progress) gives the
+    bytes per row of its files for the next one.
+    """
+    queries = []
+    empty = 0
+    for _ in range(max_batches):
+        query = start(row_bytes)
+        query.awaitTermination()
+        queries.append(query)
+        progress = last_progress(query)
+        rows = progress['numInputRows'] if progress else 0
+        print("batch {}: {} rows at {:.0f} bytes per row".format(len(queries), rows, row_bytes))
+        if rows:
+            row_bytes = measure(progress) or row_bytes
+        empty = 0 if rows else empty + 1
+        if targets and caught_up(shard_positions(progress), targets):
+            break
+        if empty >= (max_empty if targets else 1):
+            if targets:
+                print("WARNING: {} empty batches before reaching the latest sequence numbers".format(empty))
+            break
+    return queries
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    # creating a Kinesis stream
+    stream_name='pyspark-kinesis'
+    client_region = args.region
+    endpoint_url = args.endpoint_url or 'https://kinesis.'+client_region+'.amazonaws.com'
+    client = kinesis_writer.make_client(client_region, args.endpoint_url)
+    kinesis_writer.ensure_stream(client, stream_name, shard_count=1)
+
+    # sending a couple of messages to kinesis, batched by put_records, see kinesis_writer.py for load tests
+    messages = [
+        {'message_type': 'message1', 'count': 2},
+        {'message_type': 'message2', 'count': 1},
+        {'message_type': 'message1', 'count': 2},
+        {'message_type': 'message3', 'count': 3},
+        {'message_type': 'message1', 'count': 5}
+    ]
+    if not args.skip_sample:
+        writer = kinesis_writer.KinesisWriter(client, stream_name)
+        stats = writer.put((json.dumps(message), 'part_key') for message in messages)
+        print("sent {} records in {} calls, {} failed".format(stats['records'], stats['calls'], len(stats['failed'])))
+
+    spark = SparkSession.builder \
+        .appName('PySparkKinesis') \
+        .getOrCreate()
+
+    # spark.sparkContext.setLogLevel("DEBUG")
+    # export throughput metrics when --conf spark.stream.metrics.sinks=... is set, see stream_metrics.py
+    metrics = stream_metrics.attach(spark)
+    parsed = read_stream(spark, stream_name, endpoint_url, client_region, args.max_records_per_shard)
+
+    if args.sink == 'console':
+        queries = [start_console(parsed)]
+        queries[0].awaitTermination()
+    elif args.trigger == 'once':
+        queries = [start_parquet(parsed, args.checkpoint, args.output, rows_per_file(args.target_file_mb, args.row_bytes))]
+        queries[0].awaitTermination()
+    else:
+        # the backlog is what the shards hold now, records sent while draining are left to the next run
+        targets = kinesis_writer.latest_sequence_numbers(client, stream_name)
+        print("draining to {}".format(targets))
+        queries = drain(lambda row_bytes: start_parquet(parsed, args.checkpoint, args.output,
+                                                        rows_per_file(args.target_file_mb, row_bytes)),
+                        args.max_batches, targets, args.row_bytes,
+                        lambda progress: written_row_bytes(spark, args.output, progress))
+    stream_metrics.close(metrics, *queries)
+
+    # delete the kinesis stream
+    # client.delete_stream(StreamName=stream_name)
@@ -11,7 +11,7 @@ aws emr-containers start-job-run \
     "sparkSubmitJobDriver":{
         "entryPoint": "s3://'$S3BUCKET'/app_code/job/qubole-kinesis.py",
         "entryPointArguments":["'${AWS_REGION}'","s3://'${S3BUCKET}'/qubolecheckpoint","s3://'${S3BUCKET}'/qubole-kinesis-output"],
-        "sparkSubmitParameters": "--conf spark.cleaner.referenceTracking.cleanCheckpoints=true"}}' \
+        "sparkSubmitParameters": "--py-files s3://'$S3BUCKET'/app_code/job/stream_metrics.py,s3://'$S3BUCKET'/app_code/job/kinesis_writer.py --conf spark.stream.metrics.sinks=emf:stdout --conf spark.cleaner.referenceTracking.cleanCheckpoints=true"}}' \
 --configuration-overrides '{
     "applicationConfiguration": [
         {
@@ -0,0 +1,249 @@
+"""Throughput metrics of Structured Streaming queries, for autoscaling and alerting.
+
+Every query progress is flattened into gauges (input/processed rows per second, per-phase
+durations, watermark lag, state operator and observed metrics) and written by one or more sinks:
+
+  prom:<path>   Prometheus text exposition, the file is replaced on every batch so the
+                node_exporter textfile collector can pick it up. prom:stdout prints it.
+  emf:<path>    CloudWatch Embedded Metric Format, one JSON line per batch appended to the
+                file. emf:stdout writes to the driver log for the CloudWatch agent/Fluent Bit.
+
+Attach it from any job with:
+
+  import stream_metrics
+  metrics = stream_metrics.attach(spark, "prom:/tmp/stream.prom,emf:stdout")
+  ...
+  stream_metrics.close(metrics)
+
+The spec defaults to the spark.stream.metrics.sinks conf, e.g.
+--conf spark.stream.metrics.sinks=emf:stdout. Spark 3.4+ uses a Python StreamingQueryListener,
+older releases fall back to a thread polling the progress of the active queries.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+CONF_KEY = "spark.stream.metrics.sinks"
+EMF_NAMESPACE = "EMRStreaming"
+DURATION_PHASES = ["addBatch", "getBatch", "getOffset", "latestOffset", "queryPlanning",
+  "walCommit", "commitOffsets", "triggerExecution"]
+STATE_METRICS = {"numRowsTotal": "Count", "numRowsUpdated": "Count", "numRowsRemoved": "Count",
+  "memoryUsedBytes": "Bytes", "commitTimeMs": "Milliseconds", "numRowsDroppedByWatermark": "Count"}
+
+def _parse_time(text):
+  # progress timestamps look like 2024-01-01T00:00:00.000Z
+  return datetime.strptime(text.replace("Z", "+0000"), "%Y-%m-%dT%H:%M:%S.%f%z").timestamp()
+
+def progress_metrics(progress):
+  """Flatten one progress dict into {metric name: (value, CloudWatch unit)}."""
+  metrics = {
+    "input_rows": (progress.get("numInputRows", 0), "Count"),
+    "input_rows_per_second": (progress.get("inputRowsPerSecond") or 0.0, "Count/Second"),
+    "processed_rows_per_second": (progress.get("processedRowsPerSecond") or 0.0, "Count/Second"),
+  }
+  for phase in DURATION_PHASES:
+    if phase in progress.get("durationMs", {}):
+      metrics["duration_{}_ms".format(phase)] = (progress["durationMs"][phase], "Milliseconds")
+
+  watermark = progress.get("eventTime", {}).get("watermark")
+  # until the first watermark Spark reports the epoch, which isn't a lag
+  if watermark and progress.get("timestamp") and _parse_time(watermark) > 0:
+    lag = _parse_time(progress["timestamp"]) - _parse_time(watermark)
+    metrics["watermark_lag_ms"] = (round(lag * 1000), "Milliseconds")
+
+  state = {}
+  for op in progress.get("stateOperators", []):
+    for name, unit in STATE_METRICS.items():
+      if name in op:
+        value, _ = state.get(name, (0, unit))
+        state[name] = (value + op[name], unit)
+    for name, value in op.get("customMetrics", {}).items():
+      total, _ = state.get(name, (0, "None"))
+      state[name] = (total + value, "None")
+  for name, metric in state.items():
+    metrics["state_" + name] = metric
+
+  # Dataset.observe metrics, e.g. the latency histograms of msk_consumer --latency-metrics
+  for name, row in progress.get("observedMetrics", {}).items():
+    for field, value in row.items():
+      if isinstance(value, (int, float)) and not isinstance(value, bool):
+        metrics["{}_{}".format(name, field)] = (value, "Milliseconds" if field.endswith("_ms") else "Count")
+
+  for source in progress.get("sources", []):
+    behind = source.get("metrics", {}).get("maxOffsetsBehindLatest")
+    if behind is not None:
+      value, _ = metrics.get("source_max_offsets_behind_latest", (0, "Count"))
+      metrics["source_max_offsets_behind_latest"] = (value + float(behind), "Count")
+  return metrics
+
+def query_name(progress):
+  return progress.get("name") or progress.get("id", "unknown")
+
+class PrometheusTextSink:
+  """Keep the latest metrics of every query and write them in Prometheus text format."""
+
+  def __init__(self, path, prefix="spark_stream_"):
+    self.path = path
+    self.prefix = prefix
+    self._latest = {}
+    self._lock = threading.Lock()
+
+  def render(self):
+    lines, names = [], sorted({name for metrics in self._latest.values() for name in metrics})
+    for name in names:
+      metric = self.prefix + name
+      lines.append("# TYPE {} gauge".format(metric))
+      for query, metrics in sorted(self._latest.items()):
+        if name in metrics:
+          lines.append('{}{{query="{}"}} {}'.format(metric, query.replace('"', '\\"'), float(metrics[name][0])))
+    return "\n".join(lines) + "\n"
+
+  def emit(self, progress, metrics):
+    with self._lock:
+      self._latest[query_name(progress)] = metrics
+      text = self.render()
+    if self.path == "stdout":
+      sys.stdout.write(text)
+      sys.stdout.flush()
+      return
+    # write then rename, a scraper never sees a half written file
+    tmp = self.path + ".tmp"
+    with open(tmp, "w") as f:
+      f.write(text)
+    os.replace(tmp, self.path)
+
+class EmfSink:
+  """Append one CloudWatch Embedded Metric Format record per batch."""
+
+  def __init__(self, path, namespace=EMF_NAMESPACE):
+    self.path = path
+    self.namespace = namespace
+    self._lock = threading.Lock()
+
+  def record(self, progress, metrics):
+    record = {"_aws": {"Timestamp": int(time.time() * 1000), "CloudWatchMetrics": [{
+      "Namespace": self.namespace, "Dimensions": [["query"]],
+      "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in sorted(metrics.items())]}]},
+      "query": query_name(progress), "batchId": progress.get("batchId")}
+    record.update({name: value for name, (value, _) in metrics.items()})
+    return record
+
+  def emit(self, progress, metrics):
+    line = json.dumps(self.record(progress, metrics)) + "\n"
+    with self._lock:
+      if self.path == "stdout":
+        sys.stdout.write(line)
+        sys.stdout.flush()
+      else:
+        with open(self.path, "a") as f:
+          f.write(line)
+
+SINKS = {"prom": PrometheusTextSink, "emf": EmfSink}
+
+def sinks_from_spec(spec):
+  """Build sinks from a comma-separated spec such as 'prom:/tmp/stream.prom,emf:stdout'."""
+  sinks = []
+  for item in filter(None, (s.strip() for s in spec.split(","))):
+    kind, _, target = item.partition(":")
+    if kind not in SINKS:
+      raise ValueError("unknown metrics sink {!r}, choose from {}".format(kind, sorted(SINKS)))
+    sinks.append(SINKS[kind](target or "stdout"))
+  return sinks
+
+class ProgressExporter:
+  """Turn progress dicts into metrics and hand them to every sink, a failing sink never stops the query."""
+
+  def __init__(self, sinks):
+    self.sinks = sinks
+
+  def export(self, progress):
+    metrics = progress_metrics(progress)
+    for sink in self.sinks:
+      try:
+        sink.emit(progress, metrics)
+      except Exception as e:
+        print("stream_metrics: {} failed: {}".format(type(sink).__name__, e), file=sys.stderr)
+
+class ProgressPoller(threading.Thread):
+  """Fallback for Spark < 3.4: poll recentProgress of the active queries from a daemon thread."""
+
+  def __init__(self, spark, exporter, interval=5.0):
+    super().__init__(name="stream-metrics-poller", daemon=True)
+    self.spark = spark
+    self.exporter = exporter
+    self.interval = interval
+    self._seen = {}
+    self._queries = {}
+    self._stopped = threading.Event()
+
+  def track(self, query):
+    self._queries[query.id] = query
+
+  def poll(self):
+    # terminated queries are kept, so their last batches are exported on stop()
+    for query in self.spark.streams.active:
+      self.track(query)
+    for query in list(self._queries.values()):
+      for progress in query.recentProgress:
+        progress = progress if isinstance(progress, dict) else json.loads(progress.json)
+        if progress["batchId"] > self._seen.get(query.id, -1):
+          self._seen[query.id] = progress["batchId"]
+          self.exporter.export(progress)
+
+  def run(self):
+    while not self._stopped.wait(self.interval):
+      self.poll()
+
+  def stop(self):
+    self._stopped.set()
+    self.poll()
+
+def _listener_class():
+  from pyspark.sql.streaming import StreamingQueryListener
+
+  class MetricsListener(StreamingQueryListener):
+    def __init__(self, exporter):
+      self.exporter = exporter
+
+    def onQueryStarted(self, event):
+      pass
+
+    def onQueryProgress(self, event):
+      self.exporter.export(json.loads(event.progress.json))
+
+    def onQueryIdle(self, event):
+      pass
+
+    def onQueryTerminated(self, event):
+      pass
+
+  return MetricsListener
+
+def attach(spark, spec=None, poll_interval=5.0):
+  """Export the progress of every streaming query of this session. Returns the listener or poller, None if no sink."""
+  spec = spec if spec is not None else spark.conf.get(CONF_KEY, "")
+  sinks = sinks_from_spec(spec)
+  if not sinks:
+    return None
+  exporter = ProgressExporter(sinks)
+  try:
+    listener = _listener_class()(exporter)
+    spark.streams.addListener(listener)
+    return listener
+  except (ImportError, AttributeError):
+    poller = ProgressPoller(spark, exporter, poll_interval)
+    poller.start()
+    return poller
+
+def close(handle, *queries):
+  """Export what the poller hasn't seen yet, call it after the queries end. No-op for a listener.
+
+  Pass short-lived queries (e.g. trigger once) that may have ended before the poller saw them.
+  """
+  if isinstance(handle, ProgressPoller):
+    for query in queries:
+      handle.track(query)
+    handle.stop()
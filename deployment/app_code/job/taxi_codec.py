@@ -0,0 +1,453 @@
+"""Payload codecs for the taxirides/taxifares input topics and the driver count output topic.
+
+The pure Python encoders/decoders are used by producers and tools that don't run Spark.
+decode_payload/encode_payload build the matching Spark expressions for msk_consumer.py,
+pyspark is only imported when they are called.
+
+Codecs:
+  csv      comma-separated text, the format of nycTaxiRides.gz (input default)
+  json     one JSON object per record (output default)
+  avro     schemaless Avro binary datum, needs the spark-avro package
+  protobuf proto3 binary, needs the spark-protobuf package (Spark 3.5+)
+  fixed    little-endian fixed-width binary, decoded with a pandas UDF (rides and counts only)
+"""
+import json
+import struct
+from datetime import datetime, timezone
+
+CODECS = ["csv", "json", "avro", "protobuf", "fixed"]
+CORRUPT_RECORD_COL = "_corrupt_record"
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+SPARK_TIMESTAMP_FORMAT = "yyyy-MM-dd HH:mm:ss"
+
+# (name, kind) of every field the producer sends, in taxiRidesSchema order.
+# timestamps travel as epoch milliseconds in the binary codecs.
+RIDE_FIELDS = [("rideId", "long"), ("isStart", "string"), ("endTime", "timestamp"),
+  ("startTime", "timestamp"), ("startLon", "float"), ("startLat", "float"),
+  ("endLon", "float"), ("endLat", "float"), ("passengerCnt", "short"),
+  ("taxiId", "long"), ("driverId", "long")]
+# nycTaxiFares.gz lines, e.g. 1,2013000001,2013000001,2013-01-01 00:00:00,CSH,0.0,0.0,21.5
+FARE_FIELDS = [("rideId", "long"), ("taxiId", "long"), ("driverId", "long"),
+  ("startTime", "timestamp"), ("paymentType", "string"), ("tip", "float"),
+  ("tolls", "float"), ("totalFare", "float")]
+COUNT_FIELDS = [("driverId", "long"), ("windowStart", "timestamp"),
+  ("windowEnd", "timestamp"), ("count", "long")]
+
+RIDE_FIXED = struct.Struct("<qBqqffffhqq")
+COUNT_FIXED = struct.Struct("<qqqq")
+
+def millis_to_text(ms):
+  return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+def text_to_millis(text):
+  return int(datetime.strptime(text, TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+def parse_ride_line(line, fields=RIDE_FIELDS):
+  """Convert one nycTaxiRides CSV line into a ride tuple in RIDE_FIELDS order.
+
+  Pass fields=FARE_FIELDS for a nycTaxiFares line.
+  """
+  values = line.strip().split(",")
+  if len(values) != len(fields):
+    raise ValueError("expected {} fields, got {}".format(len(fields), len(values)))
+  return tuple(_from_text(kind, v) for (_, kind), v in zip(fields, values))
+
+def _from_text(kind, value):
+  if kind == "string":
+    return value
+  if kind == "timestamp":
+    return text_to_millis(value)
+  if kind == "float":
+    return float(value)
+  return int(value)
+
+def _to_text(kind, value):
+  if kind == "timestamp":
+    return millis_to_text(value)
+  if kind == "float":
+    return repr(float(value))
+  return str(value)
+
+def to_float32(value):
+  # the binary codecs carry single precision floats, like FloatType in taxiRidesSchema
+  return struct.unpack("<f", struct.pack("<f", value))[0]
+
+#############################
+#######  csv / json   #######
+#############################
+def _csv_encoder(fields):
+  def encode(record):
+    return ",".join(_to_text(kind, v) for (_, kind), v in zip(fields, record)).encode("utf-8")
+  return encode
+
+def _csv_decoder(fields):
+  def decode(payload):
+    values = payload.decode("utf-8").split(",")
+    if len(values) != len(fields):
+      raise ValueError("expected {} fields, got {}".format(len(fields), len(values)))
+    return tuple(_from_text(kind, v) for (_, kind), v in zip(fields, values))
+  return decode
+
+def _json_encoder(fields):
+  def encode(record):
+    return json.dumps({name: millis_to_text(v) if kind == "timestamp" else v
+      for (name, kind), v in zip(fields, record)}, separators=(",", ":")).encode("utf-8")
+  return encode
+
+def _json_decoder(fields):
+  def decode(payload):
+    data = json.loads(payload)
+    return tuple(text_to_millis(data[name]) if kind == "timestamp" else data[name]
+      for name, kind in fields)
+  return decode
+
+#############################
+#######      avro     #######
+#############################
+AVRO_TYPES = {"long": "long", "short": "int", "float": "float", "string": "string",
+  "timestamp": {"type": "long", "logicalType": "timestamp-millis"}}
+
+def avro_schema(name, fields):
+  return json.dumps({"type": "record", "name": name, "namespace": "taxirides",
+    "fields": [{"name": n, "type": AVRO_TYPES[kind]} for n, kind in fields]})
+
+def _write_varint(buf, n):
+  while n > 0x7F:
+    buf.append((n & 0x7F) | 0x80)
+    n >>= 7
+  buf.append(n)
+
+def _read_varint(payload, pos):
+  shift = result = 0
+  while True:
+    b = payload[pos]
+    pos += 1
+    result |= (b & 0x7F) << shift
+    if not b & 0x80:
+      return result, pos
+    shift += 7
+
+def _avro_encoder(fields):
+  def encode(record):
+    buf = bytearray()
+    for (_, kind), v in zip(fields, record):
+      if kind == "float":
+        buf += struct.pack("<f", v)
+      elif kind == "string":
+        data = v.encode("utf-8")
+        _write_varint(buf, len(data) << 1)
+        buf += data
+      else:
+        _write_varint(buf, (v << 1) ^ (v >> 63))
+    return bytes(buf)
+  return encode
+
+def _avro_decoder(fields):
+  def decode(payload):
+    pos, out = 0, []
+    for _, kind in fields:
+      if kind == "float":
+        out.append(struct.unpack_from("<f", payload, pos)[0])
+        pos += 4
+        continue
+      n, pos = _read_varint(payload, pos)
+      n = (n >> 1) ^ -(n & 1)
+      if kind == "string":
+        out.append(payload[pos:pos + n].decode("utf-8"))
+        pos += n
+      else:
+        out.append(n)
+    if pos != len(payload):
+      raise ValueError("trailing bytes in avro payload")
+    return tuple(out)
+  return decode
+
+#############################
+#######    protobuf   #######
+#############################
+PROTO_PACKAGE = "taxirides"
+PROTO_MESSAGES = {"TaxiRide": RIDE_FIELDS, "DriverWindowCount": COUNT_FIELDS, "TaxiFare": FARE_FIELDS}
+# wire fields of the input records, by message name
+RECORDS = {"TaxiRide": RIDE_FIELDS, "TaxiFare": FARE_FIELDS}
+# descriptor.proto FieldDescriptorProto.Type values
+PROTO_TYPES = {"long": 3, "timestamp": 3, "short": 5, "float": 2, "string": 9}
+MASK64 = (1 << 64) - 1
+
+def _proto_key(buf, number, wire_type):
+  _write_varint(buf, (number << 3) | wire_type)
+
+def _proto_bytes(buf, number, data):
+  _proto_key(buf, number, 2)
+  _write_varint(buf, len(data))
+  buf += data
+
+def _proto_encoder(fields):
+  def encode(record):
+    # every field is written, including zero values, so readers never need proto3 defaults
+    buf = bytearray()
+    for number, ((_, kind), v) in enumerate(zip(fields, record), start=1):
+      if kind == "float":
+        _proto_key(buf, number, 5)
+        buf += struct.pack("<f", v)
+      elif kind == "string":
+        _proto_bytes(buf, number, v.encode("utf-8"))
+      else:
+        _proto_key(buf, number, 0)
+        _write_varint(buf, v & MASK64)
+    return bytes(buf)
+  return encode
+
+def _proto_decoder(fields):
+  defaults = [0.0 if kind == "float" else "" if kind == "string" else 0 for _, kind in fields]
+  def decode(payload):
+    out, pos = list(defaults), 0
+    while pos < len(payload):
+      key, pos = _read_varint(payload, pos)
+      number, wire_type = key >> 3, key & 7
+      if wire_type == 0:
+        v, pos = _read_varint(payload, pos)
+        v = v - (1 << 64) if v >> 63 else v
+      elif wire_type == 5:
+        v = struct.unpack_from("<f", payload, pos)[0]
+        pos += 4
+      elif wire_type == 2:
+        n, pos = _read_varint(payload, pos)
+        v = payload[pos:pos + n].decode("utf-8")
+        pos += n
+      else:
+        raise ValueError("unsupported protobuf wire type {}".format(wire_type))
+      if 1 <= number <= len(fields):
+        out[number - 1] = v
+    return tuple(out)
+  return decode
+
+def proto_descriptor_set():
+  """Serialized FileDescriptorSet for PROTO_MESSAGES, the input of from_protobuf/to_protobuf.
+
+  Built by hand so the job doesn't need protoc, see taxirides.proto for the same definition.
+  """
+  file_proto = bytearray()
+  _proto_bytes(file_proto, 1, b"taxirides.proto")
+  _proto_bytes(file_proto, 2, PROTO_PACKAGE.encode())
+  for message, fields in PROTO_MESSAGES.items():
+    msg = bytearray()
+    _proto_bytes(msg, 1, message.encode())
+    for number, (name, kind) in enumerate(fields, start=1):
+      field = bytearray()
+      _proto_bytes(field, 1, name.encode())
+      for tag, value in ((3, number), (4, 1), (5, PROTO_TYPES[kind])):
+        _proto_key(field, tag, 0)
+        _write_varint(field, value)
+      _proto_bytes(msg, 2, bytes(field))
+    _proto_bytes(file_proto, 4, bytes(msg))
+  _proto_bytes(file_proto, 12, b"proto3")
+  descriptor_set = bytearray()
+  _proto_bytes(descriptor_set, 1, bytes(file_proto))
+  return bytes(descriptor_set)
+
+#############################
+#######  fixed width  #######
+#############################
+def _fixed_encoder(fields):
+  if fields is FARE_FIELDS:
+    raise ValueError("the fixed codec only carries rides and counts")
+  if fields is RIDE_FIELDS:
+    return lambda r: RIDE_FIXED.pack(r[0], r[1] == "START", *r[2:])
+  return lambda r: COUNT_FIXED.pack(*r)
+
+def _fixed_decoder(fields):
+  if fields is FARE_FIELDS:
+    raise ValueError("the fixed codec only carries rides and counts")
+  if fields is RIDE_FIELDS:
+    def decode(payload):
+      r = RIDE_FIXED.unpack(payload)
+      return (r[0], "START" if r[1] else "END") + r[2:]
+    return decode
+  return COUNT_FIXED.unpack
+
+# the json output keeps the to_json(struct("*")) layout: {"driverId":..,"window":{"start":..,"end":..},"count":..}
+def _json_count_encoder(fields):
+  def encode(record):
+    start, end = (datetime.fromtimestamp(ms / 1000, tz=timezone.utc).isoformat(timespec="milliseconds")
+      .replace("+00:00", "Z") for ms in record[1:3])
+    return json.dumps({"driverId": record[0], "window": {"start": start, "end": end},
+      "count": record[3]}, separators=(",", ":")).encode("utf-8")
+  return encode
+
+def _json_count_decoder(fields):
+  def decode(payload):
+    data = json.loads(payload)
+    start, end = (int(datetime.fromisoformat(data["window"][k].replace("Z", "+00:00")).timestamp() * 1000)
+      for k in ("start", "end"))
+    return (data["driverId"], start, end, data["count"])
+  return decode
+
+_ENCODERS = {"csv": _csv_encoder, "json": _json_encoder, "avro": _avro_encoder,
+  "protobuf": _proto_encoder, "fixed": _fixed_encoder}
+_DECODERS = {"csv": _csv_decoder, "json": _json_decoder, "avro": _avro_decoder,
+  "protobuf": _proto_decoder, "fixed": _fixed_decoder}
+
+def ride_encoder(codec):
+  """Return a function turning a ride tuple (RIDE_FIELDS order) into message bytes."""
+  return _ENCODERS[codec](RIDE_FIELDS)
+
+def ride_decoder(codec):
+  return _DECODERS[codec](RIDE_FIELDS)
+
+def fare_encoder(codec):
+  return _ENCODERS[codec](FARE_FIELDS)
+
+def fare_decoder(codec):
+  return _DECODERS[codec](FARE_FIELDS)
+
+def count_encoder(codec):
+  return (_json_count_encoder if codec == "json" else _ENCODERS[codec])(COUNT_FIELDS)
+
+def count_decoder(codec):
+  """Return a function turning an output topic message into (driverId, windowStart, windowEnd, count)."""
+  return (_json_count_decoder if codec == "json" else _DECODERS[codec])(COUNT_FIELDS)
+
+#############################
+#######  Spark side   #######
+#############################
+def _spark_fields(fields):
+  from pyspark.sql.types import StructType, StructField, LongType, StringType, FloatType, ShortType, TimestampType
+  types = {"long": LongType(), "string": StringType(), "float": FloatType(),
+    "short": ShortType(), "timestamp": TimestampType()}
+  return StructType([StructField(name, types[kind]) for name, kind in fields])
+
+def _millis_to_timestamp(c):
+  return (c / 1000).cast("timestamp")
+
+def _timestamp_to_millis(c):
+  return (c.cast("double") * 1000).cast("long")
+
+def _fixed_ride_udf():
+  from pyspark.sql.functions import pandas_udf
+  import numpy as np
+  import pandas as pd
+
+  dtype = np.dtype([("rideId", "<i8"), ("isStart", "u1"), ("endTime", "<i8"), ("startTime", "<i8"),
+    ("startLon", "<f4"), ("startLat", "<f4"), ("endLon", "<f4"), ("endLat", "<f4"),
+    ("passengerCnt", "<i2"), ("taxiId", "<i8"), ("driverId", "<i8")])
+
+  @pandas_udf(_spark_fields(RIDE_FIELDS))
+  def decode_fixed(values: pd.Series) -> pd.DataFrame:
+    ok = values.map(lambda v: v is not None and len(v) == dtype.itemsize)
+    arr = np.frombuffer(b"".join(values[ok]), dtype=dtype)
+    out = pd.DataFrame(index=values.index, columns=dtype.names)
+    for name, kind in RIDE_FIELDS:
+      column = arr[name]
+      if kind == "timestamp":
+        # epoch millis are UTC, a naive value would be read in the session time zone
+        column = pd.to_datetime(column, unit="ms", utc=True)
+      elif name == "isStart":
+        column = np.where(column == 1, "START", "END")
+      out.loc[ok, name] = column
+    return out
+  return decode_fixed
+
+def _fixed_count_udf():
+  from pyspark.sql.functions import pandas_udf
+  import numpy as np
+  import pandas as pd
+
+  dtype = np.dtype([(name, "<i8") for name, _ in COUNT_FIELDS])
+
+  @pandas_udf("binary")
+  def encode_fixed(counts: pd.DataFrame) -> pd.Series:
+    arr = np.empty(len(counts), dtype=dtype)
+    for name, _ in COUNT_FIELDS:
+      arr[name] = counts[name].to_numpy()
+    buf = arr.tobytes()
+    return pd.Series([buf[i:i + dtype.itemsize] for i in range(0, len(buf), dtype.itemsize)])
+  return encode_fixed
+
+def decode_payload(sdf, codec, schema, record="TaxiRide", keep=()):
+  """Decode the `value` column of sdf into the producer fields of schema plus CORRUPT_RECORD_COL.
+
+  record names the input message, TaxiRide or TaxiFare. CORRUPT_RECORD_COL holds the raw
+  record (base64 for binary codecs) when it can't be decoded. The columns named in keep,
+  e.g. the Kafka record timestamp, are passed through.
+  """
+  from pyspark.sql.functions import col, from_csv, from_json, base64, when, lit
+  wire_fields = RECORDS[record]
+  fields = [f for f in schema if f.name in dict(wire_fields)]
+  names = [f.name for f in fields]
+  value = col("value")
+
+  if codec in ("csv", "json"):
+    ddl = ", ".join("`{}` {}".format(f.name, f.dataType.simpleString()) for f in fields)
+    ddl += ", `{}` string".format(CORRUPT_RECORD_COL)
+    options = {"mode": "PERMISSIVE", "columnNameOfCorruptRecord": CORRUPT_RECORD_COL,
+      "timestampFormat": SPARK_TIMESTAMP_FORMAT}
+    parse = from_csv if codec == "csv" else from_json
+    return sdf.select([parse(value.cast("string"), ddl, options).alias("r")] + list(keep)) \
+      .select(["r." + name for name in names] + ["r." + CORRUPT_RECORD_COL] + list(keep))
+
+  if codec == "avro":
+    from pyspark.sql.avro.functions import from_avro
+    decoded = from_avro(value, avro_schema(record, wire_fields), {"mode": "PERMISSIVE"})
+  elif codec == "protobuf":
+    from pyspark.sql.protobuf.functions import from_protobuf
+    decoded = from_protobuf(value, PROTO_PACKAGE + "." + record, options={"mode": "PERMISSIVE"},
+      binaryDescriptorSet=proto_descriptor_set())
+  elif codec == "fixed":
+    if record != "TaxiRide":
+      raise ValueError("the fixed codec only carries rides and counts")
+    decoded = _fixed_ride_udf()(value)
+  else:
+    raise ValueError("unknown codec {}, choose from {}".format(codec, CODECS))
+
+  sdf = sdf.select([value, decoded.alias("r")] + list(keep))
+  kinds = dict(wire_fields)
+  columns = []
+  for f in fields:
+    c = col("r." + f.name)
+    if codec == "protobuf" and kinds[f.name] == "timestamp":
+      c = _millis_to_timestamp(c)
+    columns.append(c.cast(f.dataType).alias(f.name))
+  malformed = col("r").isNull() | col("r.rideId").isNull()
+  return sdf.select(columns + [when(malformed, base64(value)).otherwise(lit(None)).alias(CORRUPT_RECORD_COL)]
+    + list(keep))
+
+def encode_payload(sdf, codec, key=None):
+  """Encode driver window counts (driverId, window, count) into a Kafka `value` column.
+
+  With key set, the named column is added as the string record `key`, e.g. "driverId".
+  A boolean `final` column, as in the early aggregation, goes into a `final` record header
+  so the payload layout stays the same.
+  """
+  from pyspark.sql.functions import col, struct, to_json, concat_ws, date_format, array, lit
+  extra = ["final"] if "final" in sdf.columns else []
+  counts = sdf.select(["driverId", col("window.start").alias("windowStart"),
+    col("window.end").alias("windowEnd"), "count"] + extra)
+  as_millis = [col("driverId"), _timestamp_to_millis(col("windowStart")).alias("windowStart"),
+    _timestamp_to_millis(col("windowEnd")).alias("windowEnd"), col("count")]
+
+  if codec == "json":
+    value = to_json(struct("driverId", struct(col("windowStart").alias("start"),
+      col("windowEnd").alias("end")).alias("window"), "count"))
+  elif codec == "csv":
+    value = concat_ws(",", "driverId", date_format("windowStart", SPARK_TIMESTAMP_FORMAT),
+      date_format("windowEnd", SPARK_TIMESTAMP_FORMAT), "count")
+  elif codec == "avro":
+    from pyspark.sql.avro.functions import to_avro
+    value = to_avro(struct("driverId", "windowStart", "windowEnd", "count"),
+      avro_schema("DriverWindowCount", COUNT_FIELDS))
+  elif codec == "protobuf":
+    from pyspark.sql.protobuf.functions import to_protobuf
+    value = to_protobuf(struct(*as_millis), PROTO_PACKAGE + ".DriverWindowCount",
+      binaryDescriptorSet=proto_descriptor_set())
+  elif codec == "fixed":
+    value = _fixed_count_udf()(struct(*as_millis))
+  else:
+    raise ValueError("unknown codec {}, choose from {}".format(codec, CODECS))
+
+  columns = [value.alias("value")]
+  if key:
+    columns.insert(0, col(key).cast("string").alias("key"))
+  if extra:
+    columns.append(array(struct(lit("final").alias("key"),
+      col("final").cast("string").cast("binary").alias("value"))).alias("headers"))
+  return counts.select(columns)
@@ -0,0 +1,258 @@
+"""Seeded synthetic taxi rides in the nycTaxiRides format, for load tests that can't use the 2013 sample file.
+
+Records are generated with NumPy in blocks of BLOCK_RIDES rides, whatever the chunk size
+the outputs are read in, so a seed gives the same records everywhere. Every ride gives a START and an END
+event, and the fields follow taxi_codec.RIDE_FIELDS, so the CSV lines parse with
+taxiRidesSchema and the tuples go straight into msk_producer.py. Like nycTaxiRides, the
+3rd column holds the ride start and the 4th the ride end, 1970-01-01 for START events.
+
+  drivers           driverId cardinality
+  skew              Zipf exponent (> 1) of the driverIds, 0 for uniform
+  disorder_seconds  records are emitted up to this much after their event time, out of order
+  late_rate         share of records held back late_seconds more, e.g. to exercise the watermark
+
+Outputs are tuples (rides), CSV lines (csv_lines, write_csv), Parquet files (write_parquet,
+needs pyarrow) and column arrays (chunks).
+
+  python3 taxi_generator.py csv rides.csv.gz --rows 10000000 --drivers 50000 --skew 1.2
+  python3 taxi_generator.py parquet /tmp/rides --rows 10000000 --rows-per-file 1000000
+  python3 taxi_generator.py bench --rows 5000000
+"""
+import argparse
+import gzip
+import os
+import time
+
+import numpy as np
+
+from taxi_codec import RIDE_FIELDS, TIMESTAMP_FORMAT, text_to_millis
+
+FIELD_NAMES = [name for name, _ in RIDE_FIELDS]
+DRIVER_BASE = 2013000000
+# pickups and drop-offs scatter around midtown Manhattan, clipped to the geo_grid bounds
+CENTER = (-73.975, 40.755)
+SPREAD = (0.04, 0.05)
+BOUNDS = (-74.30, 40.48, -73.65, 40.95)
+# rides drawn at a time, the `chunk` of the outputs only slices the records drawn this way
+BLOCK_RIDES = 500000
+
+class RideGenerator:
+
+  def __init__(self, seed=42, drivers=10000, skew=0.0, start="2013-01-01 00:00:00", rides_per_second=1000,
+      disorder_seconds=0.0, late_rate=0.0, late_seconds=60.0, mean_trip_seconds=900):
+    self.rng = np.random.default_rng(seed)
+    self.drivers = drivers
+    self.skew = skew
+    self.rides_per_second = rides_per_second
+    self.disorder_ms = disorder_seconds * 1000
+    self.late_rate = late_rate
+    self.late_ms = late_seconds * 1000
+    self.mean_trip_ms = mean_trip_seconds * 1000
+    self._next_ride = 1
+    self._clock_ms = text_to_millis(start) // 1000 * 1000
+    self._pending = None
+
+  def _driver_index(self, n):
+    if self.skew > 1:
+      # the Zipf tail beyond `drivers` wraps around instead of piling up on the last driver
+      return (self.rng.zipf(self.skew, n) - 1) % self.drivers
+    return self.rng.integers(0, self.drivers, n)
+
+  def _coordinates(self, n):
+    # rounded to the 6 decimals of the CSV, so every output carries the same values
+    lon = np.clip(self.rng.normal(CENTER[0], SPREAD[0], n), BOUNDS[0], BOUNDS[2] - 1e-6)
+    lat = np.clip(self.rng.normal(CENTER[1], SPREAD[1], n), BOUNDS[1], BOUNDS[3] - 1e-6)
+    return np.round(lon, 6), np.round(lat, 6)
+
+  def _events(self, rides):
+    """START and END events of `rides` new rides, as columns plus eventTime and emitTime."""
+    ride_id = np.arange(self._next_ride, self._next_ride + rides, dtype=np.int64)
+    self._next_ride += rides
+    # whole seconds, like the CSV timestamps
+    span = int(rides / self.rides_per_second) + 1
+    starts = self._clock_ms + 1000 * np.sort(self.rng.integers(0, span, rides))
+    self._clock_ms = int(starts[-1]) + 1000
+    ends = starts + 1000 * (self.rng.exponential(self.mean_trip_ms / 1000, rides).astype(np.int64) + 60)
+    driver = DRIVER_BASE + self._driver_index(rides)
+    start_lon, start_lat = self._coordinates(rides)
+    end_lon, end_lat = self._coordinates(rides)
+    passengers = self.rng.integers(1, 7, rides).astype(np.int16)
+
+    both = lambda a: np.concatenate([a, a])
+    events = {
+      "rideId": both(ride_id),
+      "isStart": np.concatenate([np.ones(rides, bool), np.zeros(rides, bool)]),
+      "endTime": both(starts),  # 3rd column: ride start, see the module docstring
+      "startTime": np.concatenate([np.zeros(rides, np.int64), ends]),
+      "startLon": both(start_lon), "startLat": both(start_lat), "endLon": both(end_lon), "endLat": both(end_lat),
+      "passengerCnt": both(passengers), "taxiId": both(driver), "driverId": both(driver),
+    }
+    events["eventTime"] = np.concatenate([starts, ends])
+    emit = events["eventTime"] + (self.rng.random(2 * rides) * self.disorder_ms).astype(np.int64)
+    if self.late_rate:
+      emit += np.where(self.rng.random(2 * rides) < self.late_rate, int(self.late_ms), 0)
+    events["emitTime"] = emit
+    return events
+
+  def _blocks(self, total):
+    """Yield the records of BLOCK_RIDES rides at a time in emission order, `total` records (None = forever)."""
+    emitted = 0
+    while total is None or emitted < total:
+      events = self._events(BLOCK_RIDES)
+      if self._pending is not None:
+        events = {k: np.concatenate([self._pending[k], v]) for k, v in events.items()}
+      # nothing generated later can be emitted before the clock of the new rides
+      ready = events["emitTime"] < self._clock_ms
+      order = np.argsort(events["emitTime"][ready], kind="stable")[:None if total is None else total - emitted]
+      out = {k: v[ready][order] for k, v in events.items()}
+      self._pending = {k: v[~ready] for k, v in events.items()}
+      emitted += len(order)
+      if len(order):
+        yield out
+
+  def chunks(self, total, chunk=1000000):
+    """Yield dicts of column arrays (RIDE_FIELDS plus eventTime/emitTime), `total` records (None = forever) in emission order.
+
+    Timestamps are epoch millis, isStart is a bool array. A record isn't emitted before every
+    record with an earlier emitTime, so END events and late records carry over to later chunks.
+    Every chunk holds `chunk` records but the last one.
+    """
+    buffered, size = [], 0
+    for block in self._blocks(total):
+      buffered.append(block)
+      size += len(block["rideId"])
+      while size >= chunk:
+        merged = _concat(buffered)
+        yield {k: v[:chunk] for k, v in merged.items()}
+        buffered = [{k: v[chunk:] for k, v in merged.items()}]
+        size -= chunk
+    if size:
+      yield _concat(buffered)
+
+  def rides(self, total, chunk=100000):
+    """Yield ride tuples as taxi_codec.parse_ride_line returns them."""
+    for c in self.chunks(total, chunk):
+      columns = [c[name].tolist() for name in FIELD_NAMES]
+      columns[1] = ["START" if s else "END" for s in columns[1]]
+      yield from zip(*columns)
+
+  def csv_lines(self, total, chunk=1000000):
+    """Yield blocks of newline-terminated nycTaxiRides CSV lines, one string per chunk."""
+    for c in self.chunks(total, chunk):
+      yield format_csv(c)
+
+  def write_csv(self, path, total, chunk=1000000):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "wt") as f:
+      for block in self.csv_lines(total, chunk):
+        f.write(block)
+
+  def write_parquet(self, directory, total, rows_per_file=1000000):
+    """Write `total` records as Parquet files of taxiRidesSchema's columns, plus eventTime."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    os.makedirs(directory, exist_ok=True)
+    for i, c in enumerate(self.chunks(total, rows_per_file)):
+      columns = {name: c[name] for name in FIELD_NAMES + ["eventTime"]}
+      columns["isStart"] = np.where(c["isStart"], "START", "END")
+      for name in ("endTime", "startTime", "eventTime"):
+        columns[name] = c[name].astype("datetime64[ms]")
+      pq.write_table(pa.table(columns), os.path.join(directory, "part-{:05d}.parquet".format(i)))
+
+def _concat(blocks):
+  return blocks[0] if len(blocks) == 1 else {k: np.concatenate([b[k] for b in blocks]) for k in blocks[0]}
+
+def _digits(values, width):
+  # (n, width) ASCII digits of non-negative integers, zero padded
+  powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+  return (values[:, None] // powers % 10 + 48).astype(np.uint8)
+
+def _text(strings, width):
+  # (n, width) bytes of ASCII strings, right padded with NUL
+  return np.frombuffer(np.asarray(strings, dtype="S{}".format(width)).tobytes(), np.uint8).reshape(-1, width)
+
+def _timestamps(millis):
+  # each distinct second is formatted once, a chunk only spans a few of them
+  seconds, inverse = np.unique(millis // 1000, return_inverse=True)
+  text = np.char.replace((seconds.astype("datetime64[s]")).astype(str), "T", " ")
+  return _text(text, 19)[inverse.ravel()]
+
+def format_csv(c):
+  """CSV text of one chunk of columns, in RIDE_FIELDS order.
+
+  Fields are written as ASCII bytes into one (rows, width) matrix and the padding of the
+  variable width ones is masked out, as formatting every value with np.char or str would
+  be several times slower. Coordinates are assumed to be west and north, as BOUNDS are.
+  """
+  assert TIMESTAMP_FORMAT == "%Y-%m-%d %H:%M:%S"
+  ride_width = len(str(int(c["rideId"].max())))
+  driver = _digits(c["driverId"], 10)
+
+  def degrees(values, sign):
+    micros = np.rint(np.abs(values) * 1e6).astype(np.int64)
+    return [sign, _digits(micros // 1000000, 2), ".", _digits(micros % 1000000, 6), ","]
+
+  fields = [_digits(c["rideId"], ride_width), ",", _text(["END", "START"], 5)[c["isStart"].astype(np.int8)], ",",
+    _timestamps(c["endTime"]), ",", _timestamps(c["startTime"]), ","]
+  fields += degrees(c["startLon"], "-") + degrees(c["startLat"], "") + degrees(c["endLon"], "-") + degrees(c["endLat"], "")
+  fields += [_digits(c["passengerCnt"], 1), ",", driver, ",", driver, "\n"]
+  fields = [np.frombuffer(f.encode(), np.uint8) if isinstance(f, str) else f for f in fields]
+
+  rows = np.empty((len(driver), sum(f.shape[-1] for f in fields)), np.uint8)
+  offset = 0
+  for f in fields:
+    rows[:, offset:offset + f.shape[-1]] = f
+    offset += f.shape[-1]
+  keep = np.ones(rows.shape, bool)
+  ride_digits = np.floor(np.log10(c["rideId"])).astype(np.int64) + 1
+  keep[:, :ride_width] = np.arange(ride_width) >= (ride_width - ride_digits)[:, None]
+  keep[:, ride_width + 1:ride_width + 6] = rows[:, ride_width + 1:ride_width + 6] != 0
+  return rows[keep].tobytes().decode("ascii")
+
+def generator_from_args(args):
+  start = args.start
+  if start == "now":
+    start = time.strftime(TIMESTAMP_FORMAT, time.gmtime())
+  return RideGenerator(args.seed, args.drivers, args.skew, start, args.rides_per_second,
+    disorder_seconds=args.disorder_seconds, late_rate=args.late_rate, late_seconds=args.late_seconds)
+
+def add_generator_args(parser):
+  parser.add_argument("--seed", type=int, default=42)
+  parser.add_argument("--drivers", type=int, default=10000)
+  parser.add_argument("--skew", type=float, default=0.0, help="Zipf exponent of driverId (> 1), 0 = uniform")
+  parser.add_argument("--start", default="2013-01-01 00:00:00",
+    help="event time of the first ride in UTC, 'now' for rides that keep up with the wall clock")
+  parser.add_argument("--rides-per-second", type=float, default=1000,
+    help="rides per second of event time, half of the records/sec since every ride has a START and an END")
+  parser.add_argument("--disorder-seconds", type=float, default=0.0)
+  parser.add_argument("--late-rate", type=float, default=0.0)
+  parser.add_argument("--late-seconds", type=float, default=60.0)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Generate synthetic nycTaxiRides records")
+  sub = parser.add_subparsers(dest="output", required=True)
+  p = sub.add_parser("csv", help="CSV lines, gzipped if the path ends with .gz")
+  p.add_argument("path")
+  p = sub.add_parser("parquet", help="Parquet files, needs pyarrow")
+  p.add_argument("path")
+  p.add_argument("--rows-per-file", type=int, default=1000000)
+  p = sub.add_parser("bench", help="records/sec of the column arrays, the tuples and the CSV text")
+  for p in sub.choices.values():
+    p.add_argument("--rows", type=int, default=1000000)
+    add_generator_args(p)
+  args = parser.parse_args()
+
+  start = time.perf_counter()
+  if args.output == "csv":
+    generator_from_args(args).write_csv(args.path, args.rows)
+  elif args.output == "parquet":
+    generator_from_args(args).write_parquet(args.path, args.rows, args.rows_per_file)
+  else:
+    for name, consume in (("chunks", lambda g: sum(len(c["rideId"]) for c in g.chunks(args.rows))),
+        ("rides", lambda g: sum(1 for _ in g.rides(args.rows))),
+        ("csv_lines", lambda g: sum(block.count("\n") for block in g.csv_lines(args.rows)))):
+      start = time.perf_counter()
+      rows = consume(generator_from_args(args))
+      print("{:<10}{:>14,.0f} records/sec".format(name, rows / (time.perf_counter() - start)))
+    raise SystemExit
+  print("{:,} records in {:.1f}s".format(args.rows, time.perf_counter() - start))
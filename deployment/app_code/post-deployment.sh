@@ -64,6 +64,8 @@ echo "Installing Kafka Client tool ..."
 wget https://archive.apache.org/dist/kafka/2.8.1/kafka_2.12-2.8.1.tgz
 tar -xzf kafka_2.12-2.8.1.tgz
 rm kafka_2.12-2.8.1.tgz
+# python client used by app_code/job/msk_producer.py
+pip3 install --user kafka-python lz4 numpy
 
 # 3. connect to the EKS newly created
 echo $(aws cloudformation describe-stacks --stack-name $stack_name --query "Stacks[0].Outputs[?starts_with(OutputKey,'eksclusterEKSConfig')].OutputValue" --output text) | bash
@@ -6,6 +6,9 @@ from aws_cdk import (aws_eks as eks, aws_ec2 as ec2)
 from aws_cdk.aws_iam import IRole
 from aws_cdk.lambda_layer_kubectl_v28 import KubectlV28Layer
 
+# instance types of the etl-spot nodegroup, the executor pod templates without Karpenter are limited to them
+SPOT_INSTANCE_TYPES = ['r5.xlarge', 'r4.xlarge', 'r5a.xlarge']
+
 class EksConst(Construct):
 
     @property
@@ -23,6 +26,7 @@ class EksConst(Construct):
         eks_adminrole: IRole, 
         emr_svc_role: IRole, 
         fg_pod_role: IRole, 
+        karpenter: bool = False,
         **kwargs
     ) -> None:
         super().__init__(scope, id, **kwargs)
@@ -55,14 +59,16 @@ class EksConst(Construct):
     
 
         # 3. Add Spot managed NodeGroup to EKS (Run Spark exectutor on spot)
+        # With Karpenter, it provisions the executor nodes. The nodegroup keeps a fixed size, as the
+        # cluster-autoscaler would otherwise scale it up for the same Pending executors
         self._my_cluster.add_nodegroup_capacity('spot-mn',
             nodegroup_name = 'etl-spot',
             node_role = noderole,
             capacity_type=eks.CapacityType.SPOT,
             desired_size = 1,
-            max_size = 30,
+            max_size = 1 if karpenter else 30,
             disk_size = 50,
-            instance_types=[ec2.InstanceType("r5.xlarge"),ec2.InstanceType("r4.xlarge"),ec2.InstanceType("r5a.xlarge")],
+            instance_types=[ec2.InstanceType(t) for t in SPOT_INSTANCE_TYPES],
             labels = {'app':'spark', 'lifecycle':'Ec2Spot'},
             tags = {'Name':'Spot-'+eksname, 'k8s.io/cluster-autoscaler/enabled': 'true', 'k8s.io/cluster-autoscaler/'+eksname: 'owned'}
         )
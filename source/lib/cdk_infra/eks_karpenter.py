@@ -0,0 +1,98 @@
+# // Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# // SPDX-License-Identifier: License :: OSI Approved :: MIT No Attribution License (MIT-0)
+
+from constructs import Construct
+from aws_cdk import (Duration, Tags, aws_iam as iam, aws_sqs as sqs, aws_events as events, aws_events_targets as targets)
+from aws_cdk.aws_eks import ICluster, KubernetesManifest
+from aws_cdk.aws_iam import IRole
+from lib.util.manifest_reader import load_yaml_replace_var_local
+import os
+
+class KarpenterConst(Construct):
+    """Karpenter provisioning Spark nodes just in time, next to the cluster-autoscaler nodegroups.
+
+    Drivers go to the on-demand NodePool, executors to a diversified spot NodePool of
+    amd64 and arm64 (Graviton) instances. Both carry the labels of the managed nodegroups,
+    so the existing pod templates schedule on them unchanged.
+    """
+
+    @property
+    def interruption_queue(self):
+        return self._queue
+
+    def __init__(self, scope: Construct, id: str,
+        eks_cluster: ICluster,
+        eksname: str,
+        noderole: IRole,
+        chart_version: str = '0.37.0',
+        **kwargs
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        source_dir=os.path.split(os.environ['VIRTUAL_ENV'])[0]+'/source'
+
+        # 1. Nodes are launched into the private subnets carrying the discovery tag
+        for subnet in eks_cluster.vpc.private_subnets:
+            Tags.of(subnet).add('karpenter.sh/discovery', eksname)
+
+        # 2. Spot interruptions and rebalance recommendations reach Karpenter through SQS,
+        # so it drains executors before the 2 minute warning runs out
+        self._queue = sqs.Queue(self, 'InterruptionQueue',
+            retention_period=Duration.minutes(5),
+            enforce_ssl=True
+        )
+        _interruption_events = {
+            'SpotInterruption': ('aws.ec2', 'EC2 Spot Instance Interruption Warning'),
+            'Rebalance': ('aws.ec2', 'EC2 Instance Rebalance Recommendation'),
+            'InstanceStateChange': ('aws.ec2', 'EC2 Instance State-change Notification'),
+            'ScheduledChange': ('aws.health', 'AWS Health Event'),
+        }
+        for rule_id, (source, detail_type) in _interruption_events.items():
+            events.Rule(self, rule_id,
+                event_pattern=events.EventPattern(source=[source], detail_type=[detail_type]),
+                targets=[targets.SqsQueue(self._queue)]
+            )
+
+        # 3. Controller service account
+        _karpenter_sa = eks_cluster.add_service_account('KarpenterSa',
+            name='karpenter',
+            namespace='kube-system'
+        )
+        _karpenter_role = load_yaml_replace_var_local(source_dir+'/app_resources/karpenter-iam-role.yaml',
+            fields={
+                "{{node_role_arn}}": noderole.role_arn,
+                "{{queue_arn}}": self._queue.queue_arn
+            }
+        )
+        for statmt in _karpenter_role:
+            _karpenter_sa.add_to_principal_policy(iam.PolicyStatement.from_json(statmt))
+
+        # 4. Karpenter controller and its CRDs
+        _chart = eks_cluster.add_helm_chart('KarpenterChart',
+            chart='karpenter',
+            repository='oci://public.ecr.aws/karpenter/karpenter',
+            release='karpenter',
+            version=chart_version,
+            create_namespace=False,
+            namespace='kube-system',
+            values=load_yaml_replace_var_local(source_dir+'/app_resources/karpenter-values.yaml',
+                fields={
+                    "{{cluster_name}}": eksname,
+                    "{{queue_name}}": self._queue.queue_name
+                }
+            )
+        )
+        _chart.node.add_dependency(_karpenter_sa)
+
+        # 5. EC2NodeClass and the driver/executor NodePools, once the CRDs exist
+        _nodepools = KubernetesManifest(self, 'NodePools',
+            cluster=eks_cluster,
+            manifest=load_yaml_replace_var_local(source_dir+'/app_resources/karpenter-nodepools.yaml',
+                fields={
+                    "{{cluster_name}}": eksname,
+                    "{{node_role_name}}": noderole.role_name
+                },
+                multi_resource=True
+            )
+        )
+        _nodepools.node.add_dependency(_chart)
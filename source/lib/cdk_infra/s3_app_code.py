@@ -10,6 +10,10 @@ class S3AppCodeConst(Construct):
     def code_bucket(self):
         return self.bucket_name
 
+    @property
+    def bucket(self):
+        return self._artifact_bucket
+
     def __init__(self,scope: Construct, id: str, **kwargs,) -> None:
         super().__init__(scope, id, **kwargs)
 
@@ -0,0 +1,55 @@
+# // Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# // SPDX-License-Identifier: License :: OSI Approved :: MIT No Attribution License (MIT-0)
+
+from constructs import Construct
+from aws_cdk import (aws_s3 as s3, aws_s3_deployment as s3deploy)
+from aws_cdk.aws_eks import ICluster, KubernetesManifest
+from lib.util.manifest_reader import load_yaml_local
+from lib.util.pod_templates import load_families, nodegroup_families, render_all
+import os
+
+class SparkPodTemplateConst(Construct):
+    """Spark pod templates per instance family, uploaded to s3://<code bucket>/pod_templates.
+
+    Next to each family's executor.yaml sits the spark-defaults.json whose memory, overhead and
+    cores produce the requests of the templates, see lib/util/pod_templates.py. With
+    instance_types, the ones of the nodegroups when there is no Karpenter, only the families
+    that can run on them are rendered.
+    """
+
+    @property
+    def location(self):
+        return self._location
+
+    def __init__(self, scope: Construct, id: str,
+        eks_cluster: ICluster,
+        code_bucket: s3.IBucket,
+        families=None,
+        executor_cores: int = 2,
+        instance_types=None,
+        **kwargs
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        source_dir=os.path.split(os.environ['VIRTUAL_ENV'])[0]+'/source'
+
+        # 1. Drivers outrank executors, executors never preempt
+        KubernetesManifest(self, 'PriorityClasses',
+            cluster=eks_cluster,
+            manifest=load_yaml_local(source_dir+'/app_resources/spark-priority-classes.yaml', multi_resource=True)
+        )
+
+        # 2. Render the templates and their spark-defaults, the json files refer to the templates by their S3 path.
+        # A prefix of its own, the app_code deployment prunes everything under app_code
+        self._location = 's3://' + code_bucket.bucket_name + '/pod_templates'
+        _families = load_families(families)
+        if instance_types is not None:
+            _families = nodegroup_families(_families, instance_types, requested=families is not None)
+        _files = render_all(_families, self._location, executor_cores)
+        s3deploy.BucketDeployment(self, 'DeployPodTemplates',
+            sources=[s3deploy.Source.json_data(name, doc) if name.endswith('.json') else s3deploy.Source.yaml_data(name, doc)
+                for name, doc in _files.items()],
+            destination_bucket=code_bucket,
+            destination_key_prefix='pod_templates',
+            memory_limit=256
+        )
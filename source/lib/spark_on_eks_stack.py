@@ -5,12 +5,14 @@ from aws_cdk import Stack
 from constructs import Construct
 from lib.cdk_infra.network_sg import NetworkSgConst
 from lib.cdk_infra.iam_roles import IamConst
-from lib.cdk_infra.eks_cluster import EksConst
+from lib.cdk_infra.eks_cluster import EksConst, SPOT_INSTANCE_TYPES
 from lib.cdk_infra.eks_service_account import EksSAConst
 from lib.cdk_infra.eks_base_app import EksBaseAppConst
 from lib.cdk_infra.s3_app_code import S3AppCodeConst
 from lib.cdk_infra.spark_permission import SparkOnEksConst
+from lib.cdk_infra.spark_pod_templates import SparkPodTemplateConst
 from lib.util.manifest_reader import *
+from lib.util.synth_profiler import context_flag
 
 class SparkOnEksStack(Stack):
 
@@ -44,9 +46,20 @@ class SparkOnEksStack(Stack):
         # 2. EKS base infra
         self.network_sg = NetworkSgConst(self,'network-sg', eksname)
         iam = IamConst(self,'iam_roles', eksname)
-        self.eks_cluster = EksConst(self,'eks_cluster', eksname, self.network_sg.vpc, iam.managed_node_role, iam.admin_role, iam.emr_svc_role, iam.fg_pod_role)
+        # OPTIONAL: Karpenter provisions Spark nodes just in time, `-c enable_karpenter=true`
+        karpenter = context_flag(self, 'enable_karpenter', False)
+        self.eks_cluster = EksConst(self,'eks_cluster', eksname, self.network_sg.vpc, iam.managed_node_role, iam.admin_role, iam.emr_svc_role, iam.fg_pod_role, karpenter)
         EksSAConst(self, 'eks_service_account', self.eks_cluster.my_cluster)
         EksBaseAppConst(self, 'eks_base_app', self.eks_cluster.my_cluster)
 
+        if karpenter:
+            from lib.cdk_infra.eks_karpenter import KarpenterConst
+            KarpenterConst(self, 'karpenter', self.eks_cluster.my_cluster, eksname, iam.managed_node_role)
+
         # 3. Setup Spark environment, Register for EMR on EKS
-        self.emr = SparkOnEksConst(self,'spark_permission',self.eks_cluster.my_cluster, self.app_s3.code_bucket, self.eks_cluster.awsAuth)
\ No newline at end of file
+        self.emr = SparkOnEksConst(self,'spark_permission',self.eks_cluster.my_cluster, self.app_s3.code_bucket, self.eks_cluster.awsAuth)
+
+        # 4. Pod templates per instance family with their spark-defaults, `-c spark_pod_families=r5,r5d` renders a subset.
+        # Without Karpenter, only the families of the etl-spot nodegroup
+        SparkPodTemplateConst(self, 'spark_pod_templates', self.eks_cluster.my_cluster, self.app_s3.bucket,
+            self.node.try_get_context('spark_pod_families'), instance_types=None if karpenter else SPOT_INSTANCE_TYPES)
\ No newline at end of file
@@ -4,18 +4,159 @@ import yaml
 import urllib.request as request
 import os.path as path
 import sys
+import os
+import json
+import time
+import hashlib
+import atexit
+import copy
+import functools
+import re
 
-def load_yaml_remotely(url, multi_resource=False):
+# libyaml's C parser when PyYAML was built with it, several times faster than the pure Python one
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+PLACEHOLDER = re.compile(r'{{\s*[\w.-]+\s*}}')
+_parsed = {}
+
+# Remote manifests are cached on disk by content hash, so `cdk synth` doesn't download them
+# every time and can run without network access:
+#   MANIFEST_CACHE_DIR   cache location, ~/.cache/emr-stream-demo/manifests by default
+#   MANIFEST_CACHE_TTL   seconds before a cached URL is revalidated with its ETag, 86400 by default
+#   MANIFEST_OFFLINE=1   never touch the network, fail on a URL that isn't cached
+# A load pinned to a sha256 only accepts that content and needs no revalidation.
+CACHE_STATS = {"hits": 0, "misses": 0, "revalidated": 0, "stale": 0}
+_stats_reported = []
+
+def cache_dir():
+    return os.environ.get('MANIFEST_CACHE_DIR') or path.join(path.expanduser('~'), '.cache', 'emr-stream-demo', 'manifests')
+
+def _offline():
+    return os.environ.get('MANIFEST_OFFLINE', '').lower() in ('1', 'true', 'yes')
+
+def _read_index(cache):
     try:
-        file_to_parse = request.urlopen(url)
-        if multi_resource:
-            yaml_data = list(yaml.full_load_all(file_to_parse))
-        else:
-            yaml_data = yaml.full_load(file_to_parse) 
+        with open(path.join(cache, 'index.json')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def _write_atomically(file, data):
+    # several synths may share a cache, readers never see a half written file
+    tmp = "{}.{}.tmp".format(file, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, file)
+
+def _report_cache_stats():
+    print("manifest cache: {hits} hits, {misses} misses, {revalidated} revalidated, {stale} stale".format(**CACHE_STATS),
+        file=sys.stderr)
+
+def _fail(message):
+    print(message)
+    sys.exit(1)
+
+def fetch_remotely(url, sha256=None):
+    """Text of url through the on-disk cache, see the MANIFEST_* settings above."""
+    if not _stats_reported:
+        _stats_reported.append(atexit.register(_report_cache_stats))
+    cache = cache_dir()
+    index = _read_index(cache)
+    entry = index.get(url)
+    cached = None
+    if entry and (sha256 is None or entry['sha256'] == sha256):
+        try:
+            with open(path.join(cache, 'objects', entry['sha256']), 'rb') as f:
+                cached = f.read()
+        except IOError:
+            pass
+        # a corrupted object is fetched again
+        if cached is not None and hashlib.sha256(cached).hexdigest() != entry['sha256']:
+            cached = None
+
+    if cached is not None and (_offline() or sha256 is not None
+            or time.time() - entry['fetched'] < float(os.environ.get('MANIFEST_CACHE_TTL', 86400))):
+        CACHE_STATS['hits'] += 1
+        return cached.decode('utf-8')
+    if _offline():
+        _fail("{} is not in the manifest cache {}{}, run `cdk synth` once with network access or unset MANIFEST_OFFLINE"
+            "".format(url, cache, " with sha256 " + sha256 if sha256 else ""))
+
+    req = request.Request(url)
+    if cached is not None and entry.get('etag'):
+        req.add_header('If-None-Match', entry['etag'])
+    try:
+        with request.urlopen(req, timeout=30) as f:
+            data, etag = f.read(), f.headers.get('ETag')
+    except request.HTTPError as e:
+        if e.code != 304:
+            if cached is None:
+                _fail("Cannot download {}: {}".format(url, e))
+            CACHE_STATS['stale'] += 1
+            print("Cannot revalidate {}: {}, using the cached copy".format(url, e), file=sys.stderr)
+            return cached.decode('utf-8')
+        CACHE_STATS['revalidated'] += 1
+        data, etag = cached, e.headers.get('ETag') or entry.get('etag')
+    except (request.URLError, OSError) as e:
+        if cached is None:
+            _fail("Cannot download {}: {}".format(url, getattr(e, 'reason', e)))
+        CACHE_STATS['stale'] += 1
+        print("Cannot revalidate {}: {}, using the cached copy".format(url, getattr(e, 'reason', e)), file=sys.stderr)
+        return cached.decode('utf-8')
+    else:
+        CACHE_STATS['misses'] += 1
+
+    digest = hashlib.sha256(data).hexdigest()
+    if sha256 is not None and digest != sha256:
+        _fail("{} has sha256 {}, expected {}".format(url, digest, sha256))
+    os.makedirs(path.join(cache, 'objects'), exist_ok=True)
+    if data is not cached:
+        _write_atomically(path.join(cache, 'objects', digest), data)
+    index = _read_index(cache)
+    index[url] = {'sha256': digest, 'etag': etag, 'fetched': time.time()}
+    _write_atomically(path.join(cache, 'index.json'), json.dumps(index, indent=1, sort_keys=True).encode('utf-8'))
+    return data.decode('utf-8')
+
+@functools.lru_cache(maxsize=64)
+def _fields_pattern(keys):
+    # longest first, a key that is the prefix of another never takes its match
+    return re.compile('|'.join(re.escape(k) for k in sorted(keys, key=len, reverse=True)))
+
+def render_template(text, fields, strict=True, source='template'):
+    """Replace every key of fields in one regex pass. With strict, a {{placeholder}} left without a value is an error."""
+    keys = tuple(k for k in fields if k)
+    if keys:
+        text = _fields_pattern(keys).sub(lambda m: fields[m.group(0)], text)
+    if strict:
+        missing = sorted(set(PLACEHOLDER.findall(text)))
+        if missing:
+            _fail("{} has placeholders without a value: {}".format(source, ", ".join(missing)))
+    return text
+
+def parse_yaml(text, multi_resource=False):
+    if multi_resource:
+        return list(yaml.load_all(text, Loader=YAML_LOADER))
+    return yaml.load(text, Loader=YAML_LOADER)
+
+def _memoized(file_name, fields, multi_resource, strict=True):
+    """Parsed file_name with fields filled in, parsed once per (file, mtime, fields) and copied for every caller.
+
+    The constructs get their own copy, as CDK keeps what they pass and some of them modify it.
+    """
+    stat = os.stat(file_name)
+    key = (file_name, stat.st_mtime_ns, stat.st_size, tuple(sorted(fields.items())), multi_resource, strict)
+    if key not in _parsed:
+        with open(file_name, 'r') as f:
+            _parsed[key] = parse_yaml(render_template(f.read(), fields, strict, file_name), multi_resource)
+    return copy.deepcopy(_parsed[key])
+
+def load_yaml_remotely(url, multi_resource=False, sha256=None):
+    file_to_parse = fetch_remotely(url, sha256)
+    try:
+        yaml_data = parse_yaml(file_to_parse, multi_resource)
         # print(yaml_data)  
-    except:
+    except yaml.YAMLError:
         print("Cannot read yaml config file {}, check formatting."
-                "".format(file_to_parse))
+                "".format(url))
         sys.exit(1)
         
     return yaml_data 
@@ -29,39 +170,27 @@ def load_yaml_local(yaml_file, multi_resource=False):
         sys.exit(1)
 
     try:
-        with open(file_to_parse, 'r') as yaml_stream:
-            if multi_resource:
-                yaml_data = list(yaml.full_load_all(yaml_stream))
-            else:
-                yaml_data = yaml.full_load(yaml_stream) 
-            # print(yaml_data)    
-    except:
+        yaml_data = _memoized(file_to_parse, {}, multi_resource, strict=False)
+        # print(yaml_data)    
+    except yaml.YAMLError:
         print("Cannot read yaml config file {}, check formatting."
                 "".format(file_to_parse))
         sys.exit(1)
         
     return yaml_data 
 
-def load_yaml_replace_var_remotely(url, fields, multi_resource=False):
-    try:
-        with request.urlopen(url) as f:
-            file_to_replace = f.read().decode('utf-8')
-            for searchwrd,replwrd in fields.items():
-                file_to_replace = file_to_replace.replace(searchwrd, replwrd)
-
-        if multi_resource:
-            yaml_data = list(yaml.full_load_all(file_to_replace))
-        else:
-            yaml_data = yaml.full_load(file_to_replace) 
-        # print(yaml_data)
-    except request.URLError as e:
-        print(e.reason)
-        sys.exit(1)
+def load_yaml_replace_var_remotely(url, fields, multi_resource=False, sha256=None):
+    # the cache keeps the downloaded template, the fields are filled in on every load.
+    # Not strict, upstream templates carry placeholders of their own, e.g. {{http_server_port}}
+    file_to_replace = render_template(fetch_remotely(url, sha256), fields, strict=False, source=url)
+    yaml_data = parse_yaml(file_to_replace, multi_resource)
+    # print(yaml_data)
 
     return yaml_data
 
 
-def load_yaml_replace_var_local(yaml_file, fields, multi_resource=False, write_output=False):
+def load_yaml_replace_var_local(yaml_file, fields, multi_resource=False, write_output=False, strict=True):
+    """Load yaml_file with every {{placeholder}} key of fields replaced, see render_template."""
 
     file_to_replace=path.join(path.dirname(__file__), yaml_file)
     if not path.exists(file_to_replace):
@@ -70,22 +199,60 @@ def load_yaml_replace_var_local(yaml_file, fields, multi_resource=False, write_o
         sys.exit(1)
 
     try:
-        with open(file_to_replace, 'r') as f:
-            filedata = f.read()
-
-            for searchwrd, replwrd in fields.items():
-                filedata = filedata.replace(searchwrd, replwrd)
-            if multi_resource:
-                yaml_data = list(yaml.full_load_all(filedata))
-            else:
-                yaml_data = yaml.full_load(filedata) 
+        yaml_data = _memoized(file_to_replace, fields, multi_resource, strict)
         if write_output:
             with open(file_to_replace, "w") as f:
                 yaml.dump(yaml_data, f, default_flow_style=False, allow_unicode = True, sort_keys=False)
     
         # print(yaml_data)
-    except request.URLError as e:
-        print(e.reason)
+    except yaml.YAMLError as e:
+        print("Cannot read yaml config file {}, check formatting: {}"
+                "".format(file_to_replace, e))
         sys.exit(1)
 
     return yaml_data
+
+
+def _bench(runs=200):
+    """Time the local loads of one `cdk synth`, the previous replace loop and full_load against the current loader."""
+    resources = path.join(path.dirname(path.dirname(path.dirname(path.abspath(__file__)))), 'app_resources')
+    token = "${Token[TOKEN.%d]}"
+    # the loads of SparkOnEksStack and EMREC2Stack, CDK tokens standing in for the deploy-time values
+    synth = [('alb-values.yaml', {"{{region_name}}": token % 1, "{{cluster_name}}": token % 2, "{{vpc_id}}": token % 3}, False),
+        ('autoscaler-values.yaml', {"{{region_name}}": token % 1, "{{cluster_name}}": token % 2}, False),
+        ('autoscaler-iam-role.yaml', {}, False), ('alb-iam-role.yaml', {}, False),
+        ('native-spark-rbac.yaml', {"{{MY_SA}}": token % 4}, False),
+        ('native-spark-iam-role.yaml', {"{{codeBucket}}": token % 5}, False),
+        ('emr-rbac.yaml', {"{{NAMESPACE}}": "emr"}, True), ('emr-rbac.yaml', {"{{NAMESPACE}}": "emr-serverless"}, True),
+        ('emr-iam-role.yaml', {"{{codeBucket}}": token % 5}, False), ('emr-iam-role.yaml', {"{{codeBucket}}": token % 5}, False)]
+
+    def previous(file_name, fields, multi_resource):
+        with open(file_name, 'r') as f:
+            filedata = f.read()
+        for searchwrd, replwrd in fields.items():
+            filedata = filedata.replace(searchwrd, replwrd)
+        return list(yaml.full_load_all(filedata)) if multi_resource else yaml.full_load(filedata)
+
+    def current(file_name, fields, multi_resource):
+        return load_yaml_replace_var_local(file_name, fields, multi_resource)
+
+    results = {}
+    for name, load in (('replace+full_load', previous), ('regex+{}+memo'.format(YAML_LOADER.__name__), current)):
+        start = time.perf_counter()
+        for _ in range(runs):
+            # a synth is a new process, the memo only helps within it
+            _parsed.clear()
+            loaded = [load(path.join(resources, f), fields, multi) for f, fields, multi in synth]
+        results[name] = (time.perf_counter() - start) / runs * 1000
+        print("{:<32}{:>8.2f} ms per synth".format(name, results[name]))
+    assert loaded == [previous(path.join(resources, f), fields, multi) for f, fields, multi in synth]
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark of the manifest loading helpers")
+    parser.add_argument('command', choices=['bench'])
+    parser.add_argument('--runs', type=int, default=200, help="synths timed by bench")
+    args = parser.parse_args()
+    _bench(args.runs)
@@ -0,0 +1,217 @@
+# // Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# // SPDX-License-Identifier: License :: OSI Approved :: MIT No Attribution License (MIT-0)
+import math
+import os.path as path
+import sys
+import json
+
+try:
+    from lib.util.manifest_reader import load_yaml_local, load_yaml_replace_var_local
+except ImportError:
+    # run as a script, see __main__
+    from manifest_reader import load_yaml_local, load_yaml_replace_var_local
+
+# Spark driver and executor pod templates per instance family, rendered from source/app_resources.
+# The memory and cpu requests in a template are the ones Spark derives from the spark-defaults
+# rendered with it, so the scheduler packs executors onto nodes the way they will actually run.
+RESOURCES = path.join(path.dirname(path.dirname(path.dirname(path.abspath(__file__)))), 'app_resources')
+FAMILIES_FILE = path.join(RESOURCES, 'spark-instance-families.yaml')
+LOCAL_DIR = '/data/spark-local'
+# left on every node for the kubelet, the system reservations and the daemonsets
+RESERVED_FRACTION = 0.15
+MIN_OVERHEAD_MIB = 384
+DRIVER_SCRATCH_GIB = 10
+LOCAL_STORAGE = ('ebs', 'nvme')
+# vCPUs of the instance sizes in spark-instance-families.yaml
+SIZE_VCPUS = {'large': 2, 'xlarge': 4, '2xlarge': 8, '4xlarge': 16}
+# root volume of the Karpenter nodes, see karpenter-nodepools.yaml. The etl-spot nodegroup has
+# 50 GB, but only on xlarge instances, i.e. more per vCPU
+ROOT_VOLUME_GIB = 100
+# of the local storage, the kubelet's nodefs eviction threshold and the container images and logs
+EVICTION_FRACTION = 0.1
+SYSTEM_GIB = 10
+
+def _fail(message):
+    print(message, file=sys.stderr)
+    sys.exit(1)
+
+def load_families(names=None):
+    """Profiles of spark-instance-families.yaml, all of them or the comma separated / listed names."""
+    families = load_yaml_local(FAMILIES_FILE)
+    if names is None:
+        return families
+    if isinstance(names, str):
+        names = [n.strip() for n in names.split(',') if n.strip()]
+    unknown = [n for n in names if n not in families]
+    if unknown:
+        _fail("Unknown instance families {}, {} has {}".format(", ".join(unknown), FAMILIES_FILE, ", ".join(families)))
+    return {n: families[n] for n in names}
+
+def nodegroup_families(families, instance_types, requested=False):
+    """The families with one of instance_types, i.e. the ones the managed nodegroups can run without Karpenter.
+
+    The executors of the other families would stay Pending, they are left out. With requested,
+    for families asked for by name, they fail instead.
+    """
+    placeable = {n: p for n, p in families.items() if any("{}.{}".format(n, size) in instance_types for size in p['sizes'])}
+    if requested and len(placeable) < len(families):
+        _fail("No nodegroup runs the instance types of {}, they need `-c enable_karpenter=true`".format(
+            ", ".join(n for n in families if n not in placeable)))
+    return placeable
+
+def node_scratch_gib(profile, size):
+    """GiB of ephemeral storage the executors can request on a node of the family and size of profile."""
+    if profile['local_storage'] == 'nvme':
+        storage = profile['instance_store_gib_per_vcpu'] * SIZE_VCPUS[size]
+    else:
+        storage = ROOT_VOLUME_GIB
+    return storage * (1 - EVICTION_FRACTION) - SYSTEM_GIB
+
+def split_overhead(container_mib, overhead_factor):
+    """(memory, memoryOverhead) in MiB that add up to container_mib, overhead as Spark would size it for that memory."""
+    overhead = max(MIN_OVERHEAD_MIB, math.ceil(container_mib * overhead_factor / (1 + overhead_factor)))
+    return container_mib - overhead, overhead
+
+def executor_sizing(profile, cores=2, overhead_factor=0.1):
+    """Memory, overhead and cpu request of an executor with `cores` cores on the family of profile.
+
+    An executor gets its cores' share of the node memory minus RESERVED_FRACTION, so the
+    executors fill a node of any size of the family without leaving memory stranded. Their
+    scratch space has to fit the local storage of every size, see node_scratch_gib.
+    """
+    container_mib = int(cores * profile['memory_per_vcpu_gib'] * 1024 * (1 - RESERVED_FRACTION))
+    memory, overhead = split_overhead(container_mib, overhead_factor)
+    if memory <= 0:
+        _fail("{} cores leave no executor memory on {} GiB per vCPU".format(cores, profile['memory_per_vcpu_gib']))
+    scratch = int(cores * profile['scratch_gib_per_vcpu'])
+    for size in profile['sizes']:
+        executors = SIZE_VCPUS[size] // cores
+        if executors * scratch > node_scratch_gib(profile, size):
+            _fail("{} executors of {} GiB scratch exceed the {:.0f} GiB of local storage of a {} node".format(
+                executors, scratch, node_scratch_gib(profile, size), size))
+    return {
+        'cores': cores,
+        'memory_mib': memory,
+        'overhead_mib': overhead,
+        'cpu_millis': int(cores * 1000 * (1 - RESERVED_FRACTION)),
+        'scratch_gib': scratch,
+    }
+
+def driver_sizing(memory_mib=2048, cores=1, overhead_factor=0.1):
+    overhead = max(MIN_OVERHEAD_MIB, math.ceil(memory_mib * overhead_factor))
+    return {
+        'cores': cores,
+        'memory_mib': memory_mib,
+        'overhead_mib': overhead,
+        'cpu_millis': int(cores * 1000 * (1 - RESERVED_FRACTION)),
+        'scratch_gib': DRIVER_SCRATCH_GIB,
+    }
+
+def _fields(sizing):
+    return {
+        "{{cpu}}": "{}m".format(sizing['cpu_millis']),
+        "{{memory}}": "{}Mi".format(sizing['memory_mib'] + sizing['overhead_mib']),
+        "{{scratch}}": "{}Gi".format(sizing['scratch_gib']),
+        "{{local_dir}}": LOCAL_DIR,
+    }
+
+def check_pod_template(pod, role, sizing):
+    """Problems of a rendered template: missing priority class, spread or local dir, requests off the Spark sizing."""
+    problems = []
+    spec = pod.get('spec', {})
+    container_name = 'spark-kubernetes-' + role
+    if spec.get('priorityClassName') != 'spark-' + role:
+        problems.append("priorityClassName is {}, expected spark-{}".format(spec.get('priorityClassName'), role))
+    if not any(c.get('labelSelector', {}).get('matchLabels', {}).get('spark-role') == role
+            for c in spec.get('topologySpreadConstraints', [])):
+        problems.append("no topology spread over the {} pods".format(role))
+    containers = [c for c in spec.get('containers', []) if c.get('name') == container_name]
+    if len(containers) != 1:
+        return problems + ["expected one container named {}".format(container_name)]
+    container = containers[0]
+    local_dirs = [v['name'] for v in spec.get('volumes', []) if v['name'].startswith('spark-local-dir-')]
+    mounts = {m['name']: m['mountPath'] for m in container.get('volumeMounts', [])}
+    if not local_dirs:
+        problems.append("no spark-local-dir-* volume")
+    for name in local_dirs:
+        if mounts.get(name) != LOCAL_DIR:
+            problems.append("{} is mounted at {}, expected {}".format(name, mounts.get(name), LOCAL_DIR))
+    expected = _fields(sizing)
+    resources = container.get('resources', {})
+    requests, limits = resources.get('requests', {}), resources.get('limits', {})
+    for key, field in (('cpu', "{{cpu}}"), ('memory', "{{memory}}"), ('ephemeral-storage', "{{scratch}}")):
+        if requests.get(key) != expected[field]:
+            problems.append("requests.{} is {}, Spark requests {}".format(key, requests.get(key), expected[field]))
+    if limits.get('memory') != requests.get('memory'):
+        problems.append("limits.memory {} differs from requests.memory {}".format(limits.get('memory'), requests.get('memory')))
+    return problems
+
+def _checked(pod, role, sizing, source):
+    problems = check_pod_template(pod, role, sizing)
+    if problems:
+        _fail("{} renders an invalid {} pod template:\n  {}".format(source, role, "\n  ".join(problems)))
+    return pod
+
+def render_driver_template(sizing):
+    file_name = path.join(RESOURCES, 'spark-driver-template.yaml')
+    return _checked(load_yaml_replace_var_local(file_name, _fields(sizing)), 'driver', sizing, file_name)
+
+def render_executor_template(family, profile, sizing):
+    if profile['local_storage'] not in LOCAL_STORAGE:
+        _fail("{}: local_storage is {}, expected one of {}".format(family, profile['local_storage'], ", ".join(LOCAL_STORAGE)))
+    file_name = path.join(RESOURCES, 'spark-executor-template.yaml')
+    fields = dict(_fields(sizing), **{
+        "{{family}}": family,
+        "{{instance_types}}": json.dumps(["{}.{}".format(family, size) for size in profile['sizes']]),
+    })
+    return _checked(load_yaml_replace_var_local(file_name, fields), 'executor', sizing, file_name)
+
+def spark_defaults(driver, executor, driver_template_path, executor_template_path):
+    """spark-defaults classification matching the templates, for --configuration-overrides of start-job-run."""
+    return {
+        "classification": "spark-defaults",
+        "properties": {
+            "spark.kubernetes.driver.podTemplateFile": driver_template_path,
+            "spark.kubernetes.executor.podTemplateFile": executor_template_path,
+            "spark.driver.memory": "{}m".format(driver['memory_mib']),
+            "spark.driver.memoryOverhead": "{}m".format(driver['overhead_mib']),
+            "spark.driver.cores": str(driver['cores']),
+            "spark.kubernetes.driver.request.cores": "{}m".format(driver['cpu_millis']),
+            "spark.executor.memory": "{}m".format(executor['memory_mib']),
+            "spark.executor.memoryOverhead": "{}m".format(executor['overhead_mib']),
+            "spark.executor.cores": str(executor['cores']),
+            "spark.kubernetes.executor.request.cores": "{}m".format(executor['cpu_millis']),
+            "spark.local.dir": LOCAL_DIR,
+        }
+    }
+
+def render_all(families, location, executor_cores=2, overhead_factor=0.1, driver_memory_mib=2048):
+    """{relative path: document} of every family: the driver and executor templates and their spark-defaults.json.
+
+    location is where the files end up, e.g. s3://bucket/pod_templates, the spark-defaults refer to the templates by it.
+    """
+    driver = driver_sizing(driver_memory_mib, overhead_factor=overhead_factor)
+    driver_template = render_driver_template(driver)
+    files = {'driver.yaml': driver_template}
+    for family, profile in families.items():
+        executor = executor_sizing(profile, executor_cores, overhead_factor)
+        files[family + '/executor.yaml'] = render_executor_template(family, profile, executor)
+        files[family + '/spark-defaults.json'] = spark_defaults(driver, executor,
+            location + '/driver.yaml', '{}/{}/executor.yaml'.format(location, family))
+    return files
+
+
+if __name__ == '__main__':
+    import argparse
+    import yaml
+    parser = argparse.ArgumentParser(description="Render the Spark pod templates of the instance families")
+    parser.add_argument('--families', help="comma separated, all families of {} by default".format(path.basename(FAMILIES_FILE)))
+    parser.add_argument('--executor-cores', type=int, default=2)
+    parser.add_argument('--overhead-factor', type=float, default=0.1)
+    parser.add_argument('--driver-memory-mib', type=int, default=2048)
+    parser.add_argument('--location', default='s3://$S3BUCKET/pod_templates')
+    args = parser.parse_args()
+    families = load_families(args.families)
+    for name, document in render_all(families, args.location, args.executor_cores, args.overhead_factor, args.driver_memory_mib).items():
+        print("# {}/{}".format(args.location, name))
+        print(json.dumps(document, indent=2) if name.endswith('.json') else yaml.safe_dump(document, sort_keys=False))
@@ -0,0 +1,99 @@
+# // Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# // SPDX-License-Identifier: License :: OSI Approved :: MIT No Attribution License (MIT-0)
+import importlib
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+# modules whose constructs get timed, app.py imports the stacks as source.lib.*, they import lib.*
+CONSTRUCT_MODULES = ('lib.', 'source.lib.')
+
+def context_flag(app, name, default=False):
+    """Boolean context value, `-c name=false` on the command line arrives as a string."""
+    value = app.node.try_get_context(name)
+    if value is None:
+        return default
+    if isinstance(value, str):
+        return value.strip().lower() not in ('', '0', 'false', 'no', 'off')
+    return bool(value)
+
+def env_flag(name):
+    return os.environ.get(name, '').strip().lower() not in ('', '0', 'false', 'no', 'off')
+
+class SynthProfiler:
+    """Where the time of one `cdk synth` goes: imports, construct construction and app.synth().
+
+    Construct times are inclusive, a stack's time contains the constructs it creates. Timings
+    are always recorded, as `-c profile_synth` is only known once aws_cdk is imported, and
+    report() prints them when the profiler is enabled.
+    """
+
+    def __init__(self, enabled=False, out=sys.stderr):
+        self.enabled = enabled
+        self.out = out
+        self.timings = []
+        self._instrumented = set()
+        self._installed = False
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, kind, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings.append((kind, name, time.perf_counter() - start))
+
+    def load(self, module_name, attribute=None):
+        """Import module_name, timed, and time the constructs it brings in. Returns the module or one of its attributes."""
+        self.install()
+        with self.phase('import', module_name):
+            module = importlib.import_module(module_name)
+        return getattr(module, attribute) if attribute else module
+
+    def install(self):
+        """Time every Construct subclass of the CONSTRUCT_MODULES defined from now on.
+
+        Construct.__init_subclass__ wraps their __init__ as the class is created, so constructs
+        imported later, e.g. inside a stack's __init__, are timed as well.
+        """
+        if self._installed:
+            return
+        from constructs import Construct
+        profiler = self
+
+        def init_subclass(cls, **kwargs):
+            super(Construct, cls).__init_subclass__(**kwargs)
+            if cls.__module__.startswith(CONSTRUCT_MODULES) and '__init__' in vars(cls):
+                profiler._wrap(cls)
+
+        Construct.__init_subclass__ = classmethod(init_subclass)
+        self._installed = True
+
+    def _wrap(self, cls):
+        if cls in self._instrumented:
+            return
+        init = cls.__init__
+        profiler = self
+
+        def timed_init(construct, *args, **kwargs):
+            start = time.perf_counter()
+            init(construct, *args, **kwargs)
+            profiler.timings.append(('construct', '{} ({})'.format(construct.node.path, cls.__name__),
+                time.perf_counter() - start))
+
+        timed_init.__wrapped__ = init
+        cls.__init__ = timed_init
+        self._instrumented.add(cls)
+
+    def report(self):
+        if not self.enabled or not self.timings:
+            return
+        rows = sorted(self.timings, key=lambda t: t[2], reverse=True)
+        width = max(len(name) for _, name, _ in rows)
+        lines = ["{:<10} {:<{}} {:>10}".format('phase', 'name', width, 'ms')]
+        lines += ["{:<10} {:<{}} {:>10.1f}".format(kind, name, width, seconds * 1000) for kind, name, seconds in rows]
+        # constructs nest and imports pull in each other, the rows don't add up to the total
+        lines.append("{:<10} {:<{}} {:>10.1f}".format('total', 'app.py', width, (time.perf_counter() - self._start) * 1000))
+        print("\n".join(lines), file=self.out)
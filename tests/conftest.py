@@ -0,0 +1,26 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the Spark jobs import each other as top-level modules, like spark-submit --py-files does,
+# and the CDK app imports lib.* from source/
+sys.path[:0] = [os.path.join(ROOT, "deployment", "app_code", "job"), os.path.join(ROOT, "source")]
+
+
+@pytest.fixture(scope="session")
+def spark():
+  pytest.importorskip("pyspark")
+  if not (os.environ.get("JAVA_HOME") or shutil.which("java")):
+    pytest.skip("Spark needs a Java runtime")
+  from pyspark.sql import SparkSession
+  session = SparkSession.builder \
+    .master("local[2]") \
+    .appName("tests") \
+    .config("spark.sql.shuffle.partitions", "4") \
+    .config("spark.ui.enabled", "false") \
+    .getOrCreate()
+  yield session
+  session.stop()
@@ -0,0 +1,73 @@
+import math
+
+import pytest
+
+import backpressure
+
+TARGET = 10.0
+HYSTERESIS = backpressure.BackpressureController(TARGET).hysteresis
+
+
+def kafka_source(end, latest, topic="taxirides"):
+  lags = [latest[p] - end[p] for p in end]
+  return {"endOffset": {topic: end}, "latestOffset": {topic: latest},
+    "metrics": {"maxOffsetsBehindLatest": str(max(lags)), "avgOffsetsBehindLatest": str(sum(lags) / len(lags))}}
+
+
+@pytest.mark.parametrize("initial_cap, settle_batches", [(100000, 10), (5000, 30)])
+def test_simulation_settles_on_the_target(initial_cap, settle_batches):
+  batches, restarts = backpressure.simulate(TARGET, initial_cap=initial_cap, noise=0.1, seed=7)
+  settled = batches[settle_batches:]
+  # batches filled up to the cap take the target, give or take what the hysteresis lets through
+  full = [b["seconds"] for b in settled if b["rows"] == b["cap"]]
+  assert len(full) > 50
+  assert all(abs(s - TARGET) <= HYSTERESIS * TARGET for s in full), (min(full), max(full))
+  # the others were smaller because the backlog was drained
+  assert max(b["seconds"] for b in settled) <= (1 + HYSTERESIS) * TARGET
+  assert settled[-1]["backlog"] < settled[-1]["cap"]
+  # the cap moves by at most 2x per restart, so it takes about log2 of the way to the right cap, then stays
+  right_cap = 40000 * (TARGET - 2.0)
+  assert restarts <= math.ceil(abs(math.log2(right_cap / initial_cap))) + 2
+  assert len({b["cap"] for b in settled}) == 1
+
+
+def test_uncapped_batches_overshoot():
+  batches, restarts = backpressure.simulate(TARGET, controlled=False, noise=0.1, seed=7)
+  assert restarts == 0 and max(b["seconds"] for b in batches) > 5 * TARGET
+
+
+def test_controller_keeps_the_cap_within_the_hysteresis():
+  controller = backpressure.BackpressureController(TARGET, initial_cap=100000)
+  # 10% more capacity than the cap uses doesn't restart the query
+  for _ in range(10):
+    assert controller.update({"numInputRows": 100000, "durationMs": {"triggerExecution": 9100}}) is None
+  # twice as much moves the smoothed estimate past the hysteresis, by at most max_step
+  fast = {"numInputRows": 100000, "durationMs": {"triggerExecution": 4000},
+    "sources": [kafka_source({"0": 0}, {"0": 1000000})]}
+  cap, trigger = controller.update(fast)
+  assert (1 + HYSTERESIS) * 100000 < cap <= 200000 and trigger == 0
+  # and the next restart waits min_batches batches
+  assert [controller.update(fast) for _ in range(controller.min_batches - 1)] == [None] * (controller.min_batches - 1)
+  assert controller.restarts == 1
+
+
+def test_offsets_behind_sums_all_partitions():
+  source = kafka_source({"0": 100, "1": 200, "2": 300}, {"0": 1100, "1": 1200, "2": 5300})
+  assert backpressure.offsets_behind(source) == 7000
+  # progress.json may carry the offsets as JSON strings
+  as_strings = dict(source, endOffset='{"taxirides": {"0": 100, "1": 200, "2": 300}}', latestOffset=None)
+  assert backpressure.offsets_behind(as_strings) == pytest.approx(7000)
+  assert backpressure.offsets_behind({"metrics": {"maxOffsetsBehindLatest": "5000"}}) is None
+
+
+def test_controller_sees_the_backlog_of_every_partition():
+  # 16 partitions 20000 offsets behind each: the worst partition is below half the cap, the total is 3x the cap
+  partitions = [str(p) for p in range(16)]
+  batch = {"numInputRows": 100000, "durationMs": {"triggerExecution": 10000},
+    "sources": [kafka_source(dict.fromkeys(partitions, 0), dict.fromkeys(partitions, 20000))]}
+  controller = backpressure.BackpressureController(TARGET, initial_cap=100000)
+  controller.trigger_seconds = TARGET
+  controller.update(batch)
+  assert controller.behind == 320000
+  # so it keeps running batches back to back instead of waiting for the trigger interval
+  assert controller.proposal() == (100000, 0)
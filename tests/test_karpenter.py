@@ -0,0 +1,114 @@
+import json
+import os
+
+import pytest
+
+pytest.importorskip("yaml")
+
+from lib.util.manifest_reader import load_yaml_replace_var_local
+
+RESOURCES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "source", "app_resources")
+
+
+def render(file_name, fields, multi_resource=False):
+  return load_yaml_replace_var_local(os.path.join(RESOURCES, file_name), fields, multi_resource)
+
+
+def requirements(pool):
+  return {r["key"]: (r["operator"], r["values"]) for r in pool["spec"]["template"]["spec"]["requirements"]}
+
+
+@pytest.fixture(scope="module")
+def nodepools():
+  documents = render("karpenter-nodepools.yaml", {"{{cluster_name}}": "demo", "{{node_role_name}}": "node-role"},
+    multi_resource=True)
+  return {(d["kind"], d["metadata"]["name"]): d for d in documents}
+
+
+def test_node_class(nodepools):
+  spec = nodepools[("EC2NodeClass", "spark")]["spec"]
+  assert spec["role"] == "node-role"
+  assert spec["subnetSelectorTerms"] == [{"tags": {"karpenter.sh/discovery": "demo"}}]
+  assert spec["securityGroupSelectorTerms"] == [{"tags": {"aws:eks:cluster-name": "demo"}}]
+  assert spec["instanceStorePolicy"] == "RAID0"
+
+
+@pytest.mark.parametrize("name, capacity_type, label, lifecycle, categories, sizes", [
+  ("spark-driver", "on-demand", "ON_DEMAND", "OnDemand", ["m", "c"], ["large", "xlarge", "2xlarge"]),
+  ("spark-executor", "spot", "SPOT", "Ec2Spot", ["c", "m", "r"], ["xlarge", "2xlarge", "4xlarge"]),
+])
+def test_node_pools(nodepools, name, capacity_type, label, lifecycle, categories, sizes):
+  pool = nodepools[("NodePool", name)]
+  found = requirements(pool)
+  assert found["karpenter.sh/capacity-type"] == ("In", [capacity_type])
+  assert found["karpenter.k8s.aws/instance-category"] == ("In", categories)
+  assert found["karpenter.k8s.aws/instance-size"] == ("In", sizes)
+  assert found["kubernetes.io/arch"] == ("In", ["amd64", "arm64"])
+  # the labels the nodegroups carry, the pod templates select nodes by them
+  labels = pool["spec"]["template"]["metadata"]["labels"]
+  assert labels["eks.amazonaws.com/capacityType"] == label and labels["lifecycle"] == lifecycle
+  assert pool["spec"]["template"]["spec"]["nodeClassRef"] == {"name": "spark"}
+  assert pool["spec"]["disruption"]["consolidationPolicy"] == "WhenEmpty"
+
+
+def test_controller_values():
+  values = render("karpenter-values.yaml", {"{{cluster_name}}": "demo", "{{queue_name}}": "demo-interruptions"})
+  assert values["settings"] == {"clusterName": "demo", "interruptionQueue": "demo-interruptions"}
+  assert values["serviceAccount"] == {"create": False, "name": "karpenter"}
+
+
+def test_controller_policy():
+  statements = render("karpenter-iam-role.yaml",
+    {"{{node_role_arn}}": "arn:aws:iam::111122223333:role/node", "{{queue_arn}}": "arn:aws:sqs:us-east-1:111122223333:q"})
+  by_sid = {s["Sid"]: s for s in statements}
+  assert by_sid["AllowPassingNodeRole"]["Resource"] == ["arn:aws:iam::111122223333:role/node"]
+  assert by_sid["AllowInterruptionQueue"]["Resource"] == ["arn:aws:sqs:us-east-1:111122223333:q"]
+  assert "sqs:ReceiveMessage" in by_sid["AllowInterruptionQueue"]["Action"]
+
+
+def test_karpenter_construct_synthesizes(monkeypatch):
+  pytest.importorskip("aws_cdk")
+  pytest.importorskip("aws_cdk.lambda_layer_kubectl_v28")
+  from aws_cdk import App, Stack, aws_ec2 as ec2, aws_eks as eks, aws_iam as iam
+  from aws_cdk.assertions import Match, Template
+  from aws_cdk.lambda_layer_kubectl_v28 import KubectlV28Layer
+  from lib.cdk_infra.eks_karpenter import KarpenterConst
+
+  # the construct finds app_resources next to the virtualenv, like `cdk synth` from the repo root
+  monkeypatch.setenv("VIRTUAL_ENV", os.path.join(os.path.dirname(RESOURCES), "..", ".venv"))
+  stack = Stack(App(), "karpenter-test")
+  cluster = eks.Cluster(stack, "EKS", vpc=ec2.Vpc(stack, "Vpc"), cluster_name="demo", default_capacity=0,
+    version=eks.KubernetesVersion.V1_28, kubectl_layer=KubectlV28Layer(stack, "KubectlLayer"))
+  noderole = iam.Role(stack, "NodeRole", assumed_by=iam.ServicePrincipal("ec2.amazonaws.com"))
+  KarpenterConst(stack, "karpenter", cluster, "demo", noderole)
+
+  template = Template.from_stack(stack)
+  template.resource_count_is("AWS::SQS::Queue", 1)
+  template.resource_count_is("AWS::Events::Rule", 4)
+  template.has_resource_properties("AWS::Events::Rule", {
+    "EventPattern": {"source": ["aws.ec2"], "detail-type": ["EC2 Spot Instance Interruption Warning"]}})
+  template.has_resource_properties("Custom::AWSCDK-EKS-HelmChart", {
+    "Chart": "karpenter", "Release": "karpenter", "Namespace": "kube-system"})
+  manifests = template.find_resources("Custom::AWSCDK-EKS-KubernetesResource",
+    {"Properties": {"Manifest": Match.any_value()}})
+  assert any("spark-executor" in json.dumps(m["Properties"]["Manifest"]) for m in manifests.values())
+
+
+@pytest.mark.parametrize("karpenter, max_size", [(False, 30), (True, 1)])
+def test_spot_nodegroup_is_left_to_karpenter(karpenter, max_size):
+  pytest.importorskip("aws_cdk")
+  pytest.importorskip("aws_cdk.lambda_layer_kubectl_v28")
+  from aws_cdk import App, Stack, aws_ec2 as ec2, aws_iam as iam
+  from aws_cdk.assertions import Template
+  from lib.cdk_infra.eks_cluster import EksConst
+
+  stack = Stack(App(), "nodegroups-test")
+  role = lambda name, service: iam.Role(stack, name, assumed_by=iam.ServicePrincipal(service))
+  EksConst(stack, "eks", "demo", ec2.Vpc(stack, "Vpc"), role("Node", "ec2.amazonaws.com"),
+    role("Admin", "ec2.amazonaws.com"), role("Emr", "emr-containers.amazonaws.com"),
+    role("Fargate", "eks-fargate-pods.amazonaws.com"), karpenter)
+  nodegroups = Template.from_stack(stack).find_resources("AWS::EKS::Nodegroup")
+  scaling = {n["Properties"]["NodegroupName"]: n["Properties"]["ScalingConfig"] for n in nodegroups.values()}
+  # only the spot nodegroup competes with Karpenter's executor NodePool for the Pending executors
+  assert scaling["etl-spot"] == {"DesiredSize": 1, "MaxSize": max_size, "MinSize": 1}
+  assert scaling["etl-ondemand"]["MaxSize"] == 5
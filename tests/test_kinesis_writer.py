@@ -0,0 +1,156 @@
+import hashlib
+
+import pytest
+
+import kinesis_writer
+
+HALF = 2 ** 127
+
+
+class Throttled(Exception):
+  pass
+
+
+class FakeKinesis:
+  """put_records/list_shards stand-in. `failures` lists, per call, the Data values to report as failed."""
+
+  class exceptions:
+    ProvisionedThroughputExceededException = Throttled
+
+  def __init__(self, shards=None, failures=(), throttles=0, shards_after_wait=None):
+    self.shards = shards if shards is not None else [shard("shardId-0", 0, 2 ** 128 - 1)]
+    self.shards_after_wait = shards_after_wait
+    self.failures = list(failures)
+    self.throttles = throttles
+    self.calls = []
+    self.waited = []
+
+  def list_shards(self, **kwargs):
+    return {"Shards": self.shards}
+
+  def get_waiter(self, name):
+    fake = self
+
+    class Waiter:
+      def wait(self, StreamName):
+        fake.waited.append((name, StreamName))
+        fake.shards = fake.shards_after_wait
+
+    return Waiter()
+
+  def put_records(self, StreamName, Records):
+    self.calls.append([r["Data"] for r in Records])
+    if self.throttles:
+      self.throttles -= 1
+      raise Throttled()
+    failed = self.failures.pop(0) if self.failures else ()
+    results = [{"ErrorCode": "ProvisionedThroughputExceededException"} if r["Data"] in failed else {"SequenceNumber": "1"}
+      for r in Records]
+    return {"FailedRecordCount": sum("ErrorCode" in r for r in results), "Records": results}
+
+
+def shard(shard_id, start, end):
+  return {"ShardId": shard_id, "HashKeyRange": {"StartingHashKey": str(start), "EndingHashKey": str(end)},
+    "SequenceNumberRange": {"StartingSequenceNumber": "0"}}
+
+
+def entries(n, data_bytes=10):
+  return [{"Data": str(i).encode().ljust(data_bytes, b"x"), "PartitionKey": str(i)} for i in range(n)]
+
+
+def writer(client, **kwargs):
+  return kinesis_writer.KinesisWriter(client, "stream", sleep=lambda s: None, rand=lambda a, b: b, **kwargs)
+
+
+def test_pack_respects_the_record_count_limit():
+  assert [len(b) for b in kinesis_writer.pack(entries(1200))] == [500, 500, 200]
+
+
+def test_pack_respects_the_payload_limit():
+  # 5 records of ~1 MB fit in the 5 MiB of a call, a 6th doesn't
+  batches = list(kinesis_writer.pack(entries(12, data_bytes=1000000)))
+  assert [len(b) for b in batches] == [5, 5, 2]
+  for batch in batches:
+    assert sum(len(e["Data"]) + len(e["PartitionKey"]) for e in batch) <= kinesis_writer.MAX_BYTES_PER_CALL
+
+
+def test_pack_rejects_oversized_records():
+  with pytest.raises(ValueError):
+    list(kinesis_writer.pack(entries(1, data_bytes=kinesis_writer.MAX_RECORD_BYTES + 1)))
+
+
+def test_send_retries_only_the_failed_entries():
+  batch = entries(5)
+  client = FakeKinesis(failures=[{batch[1]["Data"], batch[3]["Data"]}, {batch[3]["Data"]}])
+  calls, retried, failed = writer(client)._send(batch)
+  assert client.calls == [[e["Data"] for e in batch], [batch[1]["Data"], batch[3]["Data"]], [batch[3]["Data"]]]
+  assert (calls, retried, failed) == (3, 3, [])
+
+
+def test_send_retries_a_throttled_call_and_gives_up_after_max_retries():
+  batch = entries(3)
+  client = FakeKinesis(throttles=1, failures=[{batch[0]["Data"]}] * 10)
+  calls, retried, failed = writer(client, max_retries=2)._send(batch)
+  assert calls == 3 and retried == 3 + 1 + 1
+  assert failed == [batch[0]]
+
+
+def test_shard_map_routes_by_md5_hash_range():
+  shards = kinesis_writer.ShardMap([shard("high", HALF, 2 ** 128 - 1), shard("low", 0, HALF - 1)])
+  for key in map(str, range(200)):
+    hash_key = int(hashlib.md5(key.encode()).hexdigest(), 16)
+    assert shards.shard_for(key) == ("low" if hash_key < HALF else "high")
+
+
+def test_shard_map_needs_open_shards():
+  with pytest.raises(ValueError, match="no open shards"):
+    kinesis_writer.ShardMap([])
+
+
+def test_writer_waits_for_a_stream_being_created():
+  client = FakeKinesis(shards=[], shards_after_wait=[shard("low", 0, HALF - 1), shard("high", HALF, 2 ** 128 - 1)])
+  stats = writer(client).put([("payload", str(i)) for i in range(50)])
+  assert client.waited == [("stream_exists", "stream")]
+  assert stats["records"] == 50 and stats["failed"] == [] and stats["calls"] == 2
+
+
+def test_shard_count_for():
+  assert kinesis_writer.shard_count_for(5000, avg_record_bytes=200) == 7  # record bound: 5 shards + 25%
+  assert kinesis_writer.shard_count_for(1000, avg_record_bytes=4096) == 5  # byte bound: 3.9 shards + 25%
+  assert kinesis_writer.shard_count_for(1000, avg_record_bytes=4096, headroom=1) == 4
+  assert kinesis_writer.shard_count_for(0) == 1
+
+
+class FakeShardReader:
+  """get_shard_iterator/get_records stand-in over {shard id: [(arrival time, sequence number)]}, 2 records per call."""
+
+  def __init__(self, records):
+    self.records = records
+    self.lookbacks = []
+
+  def list_shards(self, **kwargs):
+    return {"Shards": [shard(shard_id, 0, 1) for shard_id in self.records]}
+
+  def get_shard_iterator(self, StreamName, ShardId, ShardIteratorType, Timestamp):
+    self.lookbacks.append((ShardId, 1000 - Timestamp))
+    return {"ShardIterator": (ShardId, sum(arrival < Timestamp for arrival, _ in self.records[ShardId]))}
+
+  def get_records(self, ShardIterator, Limit):
+    shard_id, position = ShardIterator
+    records = self.records[shard_id]
+    page = [{"SequenceNumber": sequence_number} for _, sequence_number in records[position:position + 2]]
+    behind = 1000 * (len(records) - position - len(page))
+    return {"Records": page, "MillisBehindLatest": behind, "NextShardIterator": (shard_id, position + len(page))}
+
+
+def test_latest_sequence_numbers():
+  client = FakeShardReader({
+    "busy": [(t, str(t)) for t in range(900, 1000)],
+    # nothing in the last 10 or 60 seconds, the lookback widens to 600
+    "quiet": [(100, "1"), (800, "2")],
+    "empty": [],
+  })
+  latest = kinesis_writer.latest_sequence_numbers(client, "stream", clock=lambda: 1000)
+  assert latest == {"busy": "999", "quiet": "2"}
+  assert [lookback for shard_id, lookback in client.lookbacks if shard_id == "quiet"] == [10, 60, 600]
+  assert len([shard_id for shard_id, _ in client.lookbacks if shard_id == "empty"]) == 5
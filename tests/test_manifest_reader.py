@@ -0,0 +1,171 @@
+import hashlib
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+pytest.importorskip("yaml")
+
+from lib.util import manifest_reader
+
+BODY = b'kind: ConfigMap\nmetadata:\n  name: "{{cluster_name}}"\n'
+FIELDS = {"{{cluster_name}}": "demo"}
+
+
+class Served:
+  """What the stand-in server answers: body, ETag, an error status, and the requests it got."""
+
+  def __init__(self):
+    self.body, self.etag, self.status = BODY, '"v1"', 200
+    self.requests = []
+
+
+@pytest.fixture
+def server():
+  served = Served()
+
+  class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      served.requests.append(dict(self.headers))
+      if served.status != 200:
+        self.send_error(served.status)
+        return
+      if self.headers.get('If-None-Match') == served.etag:
+        self.send_response(304)
+        self.send_header('ETag', served.etag)
+        self.end_headers()
+        return
+      self.send_response(200)
+      self.send_header('ETag', served.etag)
+      self.end_headers()
+      self.wfile.write(served.body)
+
+    def log_message(self, *args):
+      pass
+
+  httpd = HTTPServer(('127.0.0.1', 0), Handler)
+  thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+  thread.start()
+  served.url = "http://127.0.0.1:{}/quickstart.yaml".format(httpd.server_address[1])
+
+  def stop():
+    httpd.shutdown()
+    # closed, so a request is refused rather than left waiting for the download timeout
+    httpd.server_close()
+
+  served.stop = stop
+  yield served
+  stop()
+
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+  monkeypatch.setenv('MANIFEST_CACHE_DIR', str(tmp_path))
+  monkeypatch.delenv('MANIFEST_CACHE_TTL', raising=False)
+  monkeypatch.delenv('MANIFEST_OFFLINE', raising=False)
+  monkeypatch.setattr(manifest_reader, 'CACHE_STATS', dict.fromkeys(manifest_reader.CACHE_STATS, 0))
+  # no cache summary printed at exit for every test
+  monkeypatch.setattr(manifest_reader, '_stats_reported', [None])
+  return tmp_path
+
+
+def load(url, **kwargs):
+  return manifest_reader.load_yaml_replace_var_remotely(url, FIELDS, **kwargs)
+
+
+def test_miss_then_hit(server, cache):
+  assert load(server.url) == {'kind': 'ConfigMap', 'metadata': {'name': 'demo'}}
+  assert load(server.url)['kind'] == 'ConfigMap'
+  assert manifest_reader.CACHE_STATS == {'hits': 1, 'misses': 1, 'revalidated': 0, 'stale': 0}
+  assert len(server.requests) == 1
+  assert (cache / 'objects' / hashlib.sha256(BODY).hexdigest()).read_bytes() == BODY
+
+
+def test_revalidates_with_the_etag_after_the_ttl(server, monkeypatch):
+  load(server.url)
+  monkeypatch.setenv('MANIFEST_CACHE_TTL', '0')
+  assert load(server.url)['metadata']['name'] == 'demo'
+  assert manifest_reader.CACHE_STATS['revalidated'] == 1
+  assert server.requests[-1]['If-None-Match'] == '"v1"'
+  # a changed manifest replaces the cached one
+  server.body, server.etag = BODY.replace(b'ConfigMap', b'Secret'), '"v2"'
+  assert load(server.url)['kind'] == 'Secret'
+  assert manifest_reader.CACHE_STATS['misses'] == 2
+
+
+@pytest.mark.parametrize("failure", ["error status", "server down"])
+def test_falls_back_to_the_cached_copy(server, monkeypatch, failure):
+  load(server.url)
+  monkeypatch.setenv('MANIFEST_CACHE_TTL', '0')
+  if failure == "error status":
+    server.status = 500
+  else:
+    server.stop()
+  assert load(server.url)['kind'] == 'ConfigMap'
+  assert manifest_reader.CACHE_STATS['stale'] == 1
+
+
+def test_uncached_download_failure_fails(server):
+  server.status = 404
+  with pytest.raises(SystemExit):
+    load(server.url)
+
+
+def test_offline(server, monkeypatch):
+  load(server.url)
+  monkeypatch.setenv('MANIFEST_OFFLINE', '1')
+  monkeypatch.setenv('MANIFEST_CACHE_TTL', '0')
+  assert load(server.url)['kind'] == 'ConfigMap'
+  with pytest.raises(SystemExit):
+    load(server.url + '?uncached')
+  assert len(server.requests) == 1, "offline mode must not touch the network"
+
+
+def test_sha256_pinning(server, monkeypatch):
+  pinned = hashlib.sha256(BODY).hexdigest()
+  load(server.url, sha256=pinned)
+  monkeypatch.setenv('MANIFEST_CACHE_TTL', '0')
+  assert load(server.url, sha256=pinned)['kind'] == 'ConfigMap'
+  assert len(server.requests) == 1, "a pinned load needs no revalidation"
+  with pytest.raises(SystemExit):
+    load(server.url, sha256='0' * 64)
+
+
+def test_render_fails_on_a_placeholder_without_a_value():
+  with pytest.raises(SystemExit):
+    manifest_reader.render_template('a: {{cluster_name}}\nb: {{ region }}\n', FIELDS)
+  # not strict, e.g. for upstream templates, the placeholder is kept
+  assert manifest_reader.render_template('b: {{region}}', FIELDS, strict=False) == 'b: {{region}}'
+
+
+def test_render_substitutes_the_longest_key_first():
+  fields = {'{{name}}': 'short', '{{name}}_suffix': 'long'}
+  assert manifest_reader.render_template('{{name}}_suffix {{name}}', fields) == 'long short'
+  fields = {'{{name}}_suffix': 'long', '{{name}}': 'short'}
+  assert manifest_reader.render_template('{{name}}_suffix {{name}}', fields) == 'long short'
+
+
+def test_local_load_is_parsed_again_after_the_file_changes(tmp_path, monkeypatch):
+  monkeypatch.setattr(manifest_reader, '_parsed', {})
+  template = tmp_path / 'config.yaml'
+  template.write_bytes(BODY)
+  assert manifest_reader.load_yaml_replace_var_local(str(template), FIELDS)['kind'] == 'ConfigMap'
+  template.write_bytes(BODY.replace(b'ConfigMap', b'Namespace'))
+  # same size, only the mtime tells them apart
+  stat = template.stat()
+  os.utime(template, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+  assert manifest_reader.load_yaml_replace_var_local(str(template), FIELDS)['kind'] == 'Namespace'
+  assert len(manifest_reader._parsed) == 2
+
+
+def test_local_load_gives_every_caller_its_own_copy(tmp_path, monkeypatch):
+  monkeypatch.setattr(manifest_reader, '_parsed', {})
+  template = tmp_path / 'config.yaml'
+  template.write_bytes(BODY)
+  first = manifest_reader.load_yaml_replace_var_local(str(template), FIELDS)
+  first['metadata']['name'] = 'changed'
+  second = manifest_reader.load_yaml_replace_var_local(str(template), FIELDS)
+  assert second == {'kind': 'ConfigMap', 'metadata': {'name': 'demo'}}
+  assert second['metadata'] is not first['metadata']
+  assert len(manifest_reader._parsed) == 1
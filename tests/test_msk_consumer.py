@@ -0,0 +1,136 @@
+import datetime
+
+import pytest
+
+pytest.importorskip("pyspark")
+pd = pytest.importorskip("pandas")
+np = pytest.importorskip("numpy")
+
+import msk_consumer
+
+
+class FakeGroupState:
+  """The part of pyspark's GroupState that the applyInPandasWithState functions use."""
+
+  def __init__(self, watermark_ms):
+    self.watermark_ms = watermark_ms
+    self.value = None
+    self.timeout = None
+
+  @property
+  def exists(self):
+    return self.value is not None
+
+  @property
+  def get(self):
+    return self.value
+
+  def update(self, value):
+    self.value = value
+
+  def remove(self):
+    self.value = None
+
+  def setTimeoutTimestamp(self, millis):
+    self.timeout = millis
+
+  def getCurrentWatermarkMs(self):
+    return self.watermark_ms
+
+
+def rides_at(*millis):
+  return pd.DataFrame({"timestamp": pd.to_datetime(list(millis), unit="ms")})
+
+
+def test_advance_windows_adds_rides_and_closes_passed_windows():
+  windows = {}
+  changed, closed = msk_consumer.advance_windows(windows, np.array([12000, 13000, 17000]), 0, 10000, 5000)
+  assert windows == {5000: 2, 10000: 3, 15000: 1}
+  assert (changed, closed) == ([5000, 10000, 15000], [])
+  # a ride whose windows all ended before the watermark is dropped
+  changed, closed = msk_consumer.advance_windows(windows, np.array([4000]), 15000, 10000, 5000)
+  assert windows == {10000: 3, 15000: 1}
+  assert (changed, closed) == ([], [(5000, 2)])
+
+
+def test_early_count_update_emits_provisional_then_final_counts():
+  update = msk_consumer.early_count_updater(10000, 5000, "UTC")
+  state = FakeGroupState(watermark_ms=0)
+  out = pd.concat(update((7,), iter([rides_at(12000, 13000, 17000)]), state))
+  assert list(out["driverId"]) == [7, 7, 7]
+  assert [w["start"] for w in out["window"]] == list(pd.to_datetime([5000, 10000, 15000], unit="ms"))
+  assert list(out["count"]) == [2, 3, 1] and not out["final"].any()
+  assert state.timeout == 14999
+
+  # an event time timeout without new rides closes the window the watermark has passed
+  state.watermark_ms = 15000
+  out = pd.concat(update((7,), iter([]), state))
+  assert [(w["start"], n, final) for w, n, final in zip(out["window"], out["count"], out["final"])] == \
+    [(pd.Timestamp(5000, unit="ms"), 2, True)]
+  assert sorted(zip(*state.get)) == [(10000, 3), (15000, 1)]
+  assert state.timeout == 19999
+
+  state.watermark_ms = 30000
+  out = pd.concat(update((7,), iter([]), state))
+  assert list(out["count"]) == [3, 1] and out["final"].all()
+  assert not state.exists
+
+
+def test_range_millis():
+  assert msk_consumer.range_millis("@1356998400000") == 1356998400000
+  assert msk_consumer.range_millis("@2013-01-01 00:00:10") == 1356998410000
+  for spec in ("earliest", "latest", '{"0": 12}', '@{"0": 1356998400000}'):
+    assert msk_consumer.range_millis(spec) is None
+
+
+def test_kafka_range_options():
+  assert msk_consumer.kafka_range_options("taxirides") == \
+    {"startingOffsets": "earliest", "endingOffsets": "latest"}
+  assert msk_consumer.kafka_range_options("taxirides", ' {"0": 12, "1": 30}', "@2013-01-01 00:00:10") == \
+    {"startingOffsets": '{"taxirides": {"0": 12, "1": 30}}', "endingTimestamp": "1356998410000"}
+  assert msk_consumer.kafka_range_options("taxirides", "@1356998400000", '@{"0": 1356998410000}') == \
+    {"startingTimestamp": "1356998400000", "endingOffsetsByTimestamp": '{"taxirides": {"0": 1356998410000}}'}
+  with pytest.raises(ValueError):
+    msk_consumer.kafka_range_options("taxirides", "yesterday")
+
+
+def test_replay_report():
+  first = datetime.datetime(2013, 1, 1, 0, 0, 0)
+  observed = {"rides": 36000, "first": first, "last": first + datetime.timedelta(hours=1)}
+  assert msk_consumer.replay_report(observed, 12.04, 8) == {"rides": 36000, "seconds": 12.0, "rides_per_sec": 2990,
+    "partitions": 8, "first": "2013-01-01 00:00:00", "last": "2013-01-01 01:00:00", "times_real_time": 299.0}
+  assert msk_consumer.replay_report({"rides": 0, "first": None, "last": None}, 0.5, 8) == \
+    {"rides": 0, "seconds": 0.5, "rides_per_sec": 0, "partitions": 8}
+
+
+def run_batches(spark, aggregation, batches, tmp_path, name):
+  """Stream `batches` of (driverId, seconds after 2013-01-01) rides through aggregation, one trigger per batch."""
+  source = tmp_path / (name + "-in")
+  source.mkdir()
+  rides = spark.readStream.schema("driverId long, timestamp timestamp").option("maxFilesPerTrigger", 1) \
+    .json(str(source))
+  query = aggregation(rides, "10 seconds", "5 seconds", "2 seconds").writeStream \
+    .format("memory").queryName(name).outputMode("append") \
+    .option("checkpointLocation", str(tmp_path / (name + "-checkpoint"))).start()
+  try:
+    for i, batch in enumerate(batches):
+      (source / "{:03d}.json".format(i)).write_text("".join(
+        '{{"driverId": {}, "timestamp": "2013-01-01T00:00:{:02d}Z"}}\n'.format(d, s) for d, s in batch))
+      query.processAllAvailable()
+  finally:
+    query.stop()
+  start = datetime.datetime(2013, 1, 1)
+  return {(row["driverId"], int((row["window"]["start"] - start).total_seconds())): row["count"]
+    for row in spark.table(name).collect()}
+
+
+def test_pane_counts_drop_late_rows_when_their_pane_closes(spark, tmp_path):
+  spark.conf.set("spark.sql.session.timeZone", "UTC")
+  # the ride at 8s comes after the watermark reached 10s: its pane [5, 10) and window [0, 10) are closed,
+  # the window [5, 15) is still open. The last batch moves the watermark past every window.
+  batches = [[(1, 1), (1, 12)], [(1, 8)], [(2, 50)]]
+  windows = run_batches(spark, msk_consumer.driver_window_counts, batches, tmp_path, "windows")
+  panes = run_batches(spark, msk_consumer.driver_pane_counts, batches, tmp_path, "panes")
+  assert windows[(1, 5)] == 2 and panes[(1, 5)] == 1
+  del windows[(1, 5)], panes[(1, 5)]
+  assert windows == panes == {(1, -5): 1, (1, 0): 1, (1, 10): 1}
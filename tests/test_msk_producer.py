@@ -0,0 +1,71 @@
+import functools
+import io
+
+import msk_producer
+import taxi_codec
+import taxi_generator
+
+
+class FakeClock:
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.now += seconds
+
+
+def test_token_bucket_holds_the_rate():
+  clock = FakeClock()
+  bucket = msk_producer.TokenBucket(1000, capacity=100, clock=clock, sleep=clock.sleep)
+  for _ in range(50):
+    bucket.acquire(100)
+  # the first 100 events are the initial burst, the other 4900 come at 1000/sec
+  assert abs(clock.now - 4.9) < 1e-6
+
+
+def test_token_bucket_does_not_wait_within_the_burst():
+  clock = FakeClock()
+  bucket = msk_producer.TokenBucket(10, capacity=50, clock=clock, sleep=clock.sleep)
+  assert bucket.acquire(50) == 0.0
+  assert bucket.acquire(5) == 0.5
+
+
+def test_produce_keys_rides_by_driver():
+  producer = msk_producer.create_producer("memory", compression="lz4", linger_ms=5)
+  rides = list(taxi_generator.RideGenerator(seed=7, drivers=50).rides(2000))
+  out = io.StringIO()
+  sent = msk_producer.produce(producer, iter(rides), codec="csv", reporter=msk_producer.ThroughputReporter(out=out))
+  assert sent == 2000
+  assert producer.config["compression_type"] == "lz4" and producer.config["linger_ms"] == 5
+  partitions = {}
+  decode = taxi_codec.ride_decoder("csv")
+  for (topic, partition), records in producer.records.items():
+    assert topic == "taxirides"
+    for key, value in records:
+      assert key == str(decode(value)[10]).encode()
+      assert partitions.setdefault(key, partition) == partition, "a driver spans several partitions"
+  assert sum(len(r) for r in producer.records.values()) == 2000
+
+
+def test_produce_stops_at_the_limit_and_reports_failures():
+  producer = msk_producer.MemoryProducer(fail_every=10)
+  out = io.StringIO()
+  reporter = msk_producer.ThroughputReporter(out=out)
+  sent = msk_producer.produce(producer, taxi_generator.RideGenerator(seed=1).rides(None), limit=500, reporter=reporter)
+  assert sent == 500
+  assert (reporter.sent, reporter.acked, reporter.failed) == (500, 450, 50)
+  assert out.getvalue().splitlines()[-1].startswith("sent=500 acked=450 failed=50 ")
+
+
+def test_produce_paces_to_the_rate(monkeypatch):
+  clock = FakeClock()
+  monkeypatch.setattr(msk_producer, "TokenBucket",
+    functools.partial(msk_producer.TokenBucket, clock=clock, sleep=clock.sleep))
+  producer = msk_producer.MemoryProducer()
+  msk_producer.produce(producer, taxi_generator.RideGenerator(seed=1).rides(None), rate=5000, chunk=500,
+    limit=20000, reporter=msk_producer.ThroughputReporter(out=io.StringIO(), clock=clock))
+  # one second of burst, then 15000 events at 5000/sec
+  assert abs(clock.now - 3.0) < 0.01
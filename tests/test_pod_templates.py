@@ -0,0 +1,121 @@
+import os
+
+import pytest
+
+pytest.importorskip("yaml")
+
+from lib.util import pod_templates
+from lib.util.manifest_reader import load_yaml_local
+
+FAMILIES = pod_templates.load_families()
+LOCATION = "s3://bucket/pod_templates"
+
+
+def mib(setting):
+  assert setting.endswith("m")
+  return int(setting[:-1])
+
+
+def container(pod, role):
+  [c] = [c for c in pod["spec"]["containers"] if c["name"] == "spark-kubernetes-" + role]
+  return c
+
+
+@pytest.fixture(scope="module")
+def rendered():
+  return pod_templates.render_all(FAMILIES, LOCATION)
+
+
+@pytest.mark.parametrize("family", sorted(FAMILIES))
+def test_executor_requests_match_spark_defaults(rendered, family):
+  properties = rendered[family + "/spark-defaults.json"]["properties"]
+  executor = container(rendered[family + "/executor.yaml"], "executor")
+  requests = executor["resources"]["requests"]
+  memory = mib(properties["spark.executor.memory"]) + mib(properties["spark.executor.memoryOverhead"])
+  assert requests["memory"] == executor["resources"]["limits"]["memory"] == "{}Mi".format(memory)
+  assert requests["cpu"] == properties["spark.kubernetes.executor.request.cores"]
+  assert properties["spark.kubernetes.executor.podTemplateFile"] == "{}/{}/executor.yaml".format(LOCATION, family)
+  assert properties["spark.kubernetes.driver.podTemplateFile"] == LOCATION + "/driver.yaml"
+
+
+@pytest.mark.parametrize("family", sorted(FAMILIES))
+def test_driver_requests_match_spark_defaults(rendered, family):
+  properties = rendered[family + "/spark-defaults.json"]["properties"]
+  requests = container(rendered["driver.yaml"], "driver")["resources"]["requests"]
+  memory = mib(properties["spark.driver.memory"]) + mib(properties["spark.driver.memoryOverhead"])
+  assert requests["memory"] == "{}Mi".format(memory)
+  assert requests["cpu"] == properties["spark.kubernetes.driver.request.cores"]
+
+
+@pytest.mark.parametrize("family", sorted(FAMILIES))
+def test_executor_placement(rendered, family):
+  spec = rendered[family + "/executor.yaml"]["spec"]
+  terms = spec["affinity"]["nodeAffinity"]["requiredDuringSchedulingIgnoredDuringExecution"]["nodeSelectorTerms"]
+  [expression] = terms[0]["matchExpressions"]
+  assert expression["values"] == ["{}.{}".format(family, size) for size in FAMILIES[family]["sizes"]]
+  assert rendered[family + "/executor.yaml"]["metadata"]["labels"]["spark-instance-family"] == family
+
+
+@pytest.mark.parametrize("role, name", [("driver", "driver.yaml"), ("executor", "r5d/executor.yaml")])
+def test_priority_spread_and_local_dir(rendered, role, name):
+  pod = rendered[name]
+  spec = pod["spec"]
+  priority_classes = {p["metadata"]["name"] for p in load_yaml_local(
+    os.path.join(pod_templates.RESOURCES, "spark-priority-classes.yaml"), multi_resource=True)}
+  assert spec["priorityClassName"] == "spark-" + role and spec["priorityClassName"] in priority_classes
+  [spread] = spec["topologySpreadConstraints"]
+  assert spread["topologyKey"] == "kubernetes.io/hostname"
+  assert spread["labelSelector"]["matchLabels"] == {"spark-role": role}
+  [volume] = [v for v in spec["volumes"] if v["name"] == "spark-local-dir-1"]
+  c = container(pod, role)
+  assert volume["emptyDir"]["sizeLimit"] == c["resources"]["requests"]["ephemeral-storage"]
+  assert {"name": "spark-local-dir-1", "mountPath": pod_templates.LOCAL_DIR} in c["volumeMounts"]
+  assert rendered["r5d/spark-defaults.json"]["properties"]["spark.local.dir"] == pod_templates.LOCAL_DIR
+
+
+@pytest.mark.parametrize("family", sorted(FAMILIES))
+@pytest.mark.parametrize("cores", [1, 2, 3, 4])
+def test_executor_sizing_fits_the_node(family, cores):
+  profile = FAMILIES[family]
+  sizing = pod_templates.executor_sizing(profile, cores)
+  pod = pod_templates.render_executor_template(family, profile, sizing)
+  assert pod_templates.check_pod_template(pod, "executor", sizing) == []
+  node_mib = cores * profile["memory_per_vcpu_gib"] * 1024
+  assert sizing["memory_mib"] + sizing["overhead_mib"] <= node_mib * (1 - pod_templates.RESERVED_FRACTION)
+  assert sizing["overhead_mib"] >= pod_templates.MIN_OVERHEAD_MIB and sizing["cpu_millis"] < cores * 1000
+  # the scratch space of every executor of a node fits its local storage, at every size
+  for size in profile["sizes"]:
+    executors = pod_templates.SIZE_VCPUS[size] // cores
+    assert executors * sizing["scratch_gib"] <= pod_templates.node_scratch_gib(profile, size)
+  if profile["local_storage"] == "ebs":
+    largest = max(pod_templates.SIZE_VCPUS[size] for size in profile["sizes"])
+    assert largest // cores * sizing["scratch_gib"] < pod_templates.ROOT_VOLUME_GIB
+
+
+def test_executor_sizing_fails_past_the_local_storage():
+  profile = dict(FAMILIES["r5"], scratch_gib_per_vcpu=8)
+  with pytest.raises(SystemExit):
+    pod_templates.executor_sizing(profile, 2)
+
+
+def test_nodegroup_families():
+  nodegroup = ["r5.xlarge", "r4.xlarge", "r5a.xlarge"]
+  assert list(pod_templates.nodegroup_families(FAMILIES, nodegroup)) == ["r5"]
+  assert list(pod_templates.nodegroup_families(pod_templates.load_families("r5"), nodegroup, requested=True)) == ["r5"]
+  # asked for by name, a family the nodegroups can't run is an error rather than left out
+  with pytest.raises(SystemExit):
+    pod_templates.nodegroup_families(pod_templates.load_families("r5,r5d"), nodegroup, requested=True)
+
+
+def test_check_pod_template_finds_problems(rendered):
+  driver = pod_templates.driver_sizing()
+  pod = rendered["driver.yaml"]
+  broken = dict(pod, spec=dict(pod["spec"], priorityClassName="spark-executor", topologySpreadConstraints=[]))
+  problems = pod_templates.check_pod_template(broken, "driver", driver)
+  assert len(problems) == 2 and "priorityClassName" in problems[0] and "topology spread" in problems[1]
+  assert pod_templates.check_pod_template(pod, "driver", pod_templates.driver_sizing(4096))
+
+
+def test_unknown_family_fails():
+  with pytest.raises(SystemExit):
+    pod_templates.load_families("r5,x9z")
@@ -0,0 +1,100 @@
+import glob
+import importlib.util
+import json
+import os
+
+import pytest
+
+pytest.importorskip("pyspark")
+
+from conftest import ROOT
+
+spec = importlib.util.spec_from_file_location("qubole_kinesis", os.path.join(ROOT, "deployment", "app_code", "job", "qubole-kinesis.py"))
+qubole_kinesis = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(qubole_kinesis)
+
+
+def kinesis_progress(rows, positions, batch_id=0):
+  # the kinesis-sql connector's offsets: a metadata entry, then one position per shard
+  end = {"metadata": {"streamName": "pyspark-kinesis", "batchId": str(batch_id)}}
+  end.update({shard: {"iteratorType": "AFTER_SEQUENCE_NUMBER", "iteratorPosition": str(p)} for shard, p in positions.items()})
+  return {"batchId": batch_id, "numInputRows": rows, "sources": [{"endOffset": json.dumps(end)}], "sink": {"numOutputRows": rows}}
+
+
+class FakeQuery:
+  def __init__(self, progress):
+    self.lastProgress = progress
+
+  def awaitTermination(self):
+    pass
+
+
+class FakeSource:
+  """start() of drain over a list of progress dicts, one per trigger-once batch, records the row_bytes of every batch."""
+
+  def __init__(self, progresses):
+    self.progresses = list(progresses)
+    self.row_bytes = []
+
+  def __call__(self, row_bytes):
+    self.row_bytes.append(row_bytes)
+    return FakeQuery(self.progresses.pop(0) if self.progresses else kinesis_progress(0, {}))
+
+
+def test_drain_reads_past_empty_batches_up_to_the_latest_sequence_numbers():
+  source = FakeSource([
+    kinesis_progress(100, {"shardId-0": 100, "shardId-1": 50}),
+    # the connector can come back with nothing while records are left
+    kinesis_progress(0, {"shardId-0": 100, "shardId-1": 50}),
+    kinesis_progress(80, {"shardId-0": 150, "shardId-1": 180}),
+    kinesis_progress(10, {"shardId-0": 160, "shardId-1": 190}),
+  ])
+  queries = qubole_kinesis.drain(source, 10, targets={"shardId-0": "150", "shardId-1": "180"})
+  assert len(queries) == 3
+
+
+def test_drain_gives_up_after_empty_batches():
+  source = FakeSource([kinesis_progress(100, {"shardId-0": 100})])
+  assert len(qubole_kinesis.drain(source, 10, targets={"shardId-0": "500"}, max_empty=3)) == 4
+  # without targets, at the first empty batch
+  source = FakeSource([kinesis_progress(100, {"shardId-0": 100})])
+  assert len(qubole_kinesis.drain(source, 10)) == 2
+  assert len(qubole_kinesis.drain(FakeSource([kinesis_progress(1, {})] * 20), 5)) == 5
+
+
+def test_drain_sizes_files_with_the_measured_row_bytes():
+  source = FakeSource([kinesis_progress(100, {"shardId-0": 100}, 0), kinesis_progress(0, {"shardId-0": 100}, 1)])
+  qubole_kinesis.drain(source, 10, row_bytes=48, measure=lambda progress: 31.5)
+  assert source.row_bytes == [48, 31.5]
+  assert qubole_kinesis.rows_per_file(128, 32) == 4 * 1024 * 1024
+
+
+def test_shard_positions():
+  progress = kinesis_progress(5, {"shardId-0": 12345678901234567890123, "shardId-1": 7})
+  # a shard the connector hasn't read yet has no sequence number
+  end = json.loads(progress["sources"][0]["endOffset"])
+  end["shardId-2"] = {"iteratorType": "TRIM_HORIZON", "iteratorPosition": ""}
+  progress["sources"][0]["endOffset"] = end
+  assert qubole_kinesis.shard_positions(progress) == {"shardId-0": 12345678901234567890123, "shardId-1": 7}
+  assert qubole_kinesis.caught_up({"shardId-0": 10}, {"shardId-0": "10"})
+  assert not qubole_kinesis.caught_up({"shardId-0": 10}, {"shardId-0": "10", "shardId-1": "1"})
+
+
+def test_parquet_batches_measure_their_row_size(spark, tmp_path):
+  # a file source stands in for Kinesis, with the columns read_stream gives
+  source = tmp_path / "source"
+  source.mkdir()
+  rows = [{"message_type": "message{}".format(i % 3), "count": i, "event_time": "2024-01-01 10:{:02d}:00".format(i % 60)}
+    for i in range(5000)]
+  (source / "batch-0.json").write_text("\n".join(json.dumps(r) for r in rows))
+  parsed = spark.readStream.schema("message_type string, count int, event_time timestamp").json(str(source))
+  output, checkpoint = str(tmp_path / "output"), str(tmp_path / "checkpoint")
+
+  start = lambda row_bytes: qubole_kinesis.start_parquet(parsed, checkpoint, output, qubole_kinesis.rows_per_file(1, row_bytes))
+  measured = []
+  queries = qubole_kinesis.drain(start, 5, row_bytes=48,
+    measure=lambda progress: measured.append(qubole_kinesis.written_row_bytes(spark, output, progress)) or measured[-1])
+  assert len(queries) == 2 and len(measured) == 1
+  files = glob.glob(os.path.join(output, "dt=2024-01-01", "hour=10", "*.parquet"))
+  assert measured[0] == pytest.approx(sum(os.path.getsize(f) for f in files) / 5000.0)
+  assert spark.read.parquet(output).count() == 5000
@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+import stream_metrics
+
+PROGRESS = {
+  "id": "8c1e", "name": "driver_counts", "batchId": 7, "timestamp": "2024-01-01T00:01:00.000Z",
+  "numInputRows": 1200, "inputRowsPerSecond": 240.0, "processedRowsPerSecond": 600.0,
+  "durationMs": {"addBatch": 1500, "triggerExecution": 2000, "unknownPhase": 5},
+  "eventTime": {"watermark": "2024-01-01T00:00:50.000Z"},
+  "stateOperators": [
+    {"numRowsTotal": 100, "memoryUsedBytes": 4096, "customMetrics": {"rocksdbBytesCopied": 10}},
+    {"numRowsTotal": 20, "memoryUsedBytes": 1024, "customMetrics": {"rocksdbBytesCopied": 5}}],
+  "observedMetrics": {"latency": {"max_ms": 830, "le_1000": 12, "flag": True}},
+  "sources": [{"metrics": {"maxOffsetsBehindLatest": "300"}}, {"metrics": {"maxOffsetsBehindLatest": "50"}}],
+}
+
+
+def test_progress_metrics():
+  metrics = stream_metrics.progress_metrics(PROGRESS)
+  assert metrics == {
+    "input_rows": (1200, "Count"),
+    "input_rows_per_second": (240.0, "Count/Second"),
+    "processed_rows_per_second": (600.0, "Count/Second"),
+    "duration_addBatch_ms": (1500, "Milliseconds"),
+    "duration_triggerExecution_ms": (2000, "Milliseconds"),
+    "watermark_lag_ms": (10000, "Milliseconds"),
+    "state_numRowsTotal": (120, "Count"),
+    "state_memoryUsedBytes": (5120, "Bytes"),
+    "state_rocksdbBytesCopied": (15, "None"),
+    "latency_max_ms": (830, "Milliseconds"),
+    "latency_le_1000": (12, "Count"),
+    "source_max_offsets_behind_latest": (350.0, "Count"),
+  }
+
+
+def test_no_watermark_lag_before_the_first_watermark():
+  progress = dict(PROGRESS, eventTime={"watermark": "1970-01-01T00:00:00.000Z"})
+  assert "watermark_lag_ms" not in stream_metrics.progress_metrics(progress)
+  assert "watermark_lag_ms" not in stream_metrics.progress_metrics(dict(PROGRESS, eventTime={}))
+
+
+def test_prometheus_text_sink(tmp_path):
+  path = tmp_path / "stream.prom"
+  sink = stream_metrics.PrometheusTextSink(str(path))
+  sink.emit(PROGRESS, {"input_rows": (1200, "Count"), "watermark_lag_ms": (10000, "Milliseconds")})
+  sink.emit({"name": 'other "query"'}, {"input_rows": (5, "Count")})
+  assert path.read_text() == "\n".join([
+    "# TYPE spark_stream_input_rows gauge",
+    'spark_stream_input_rows{query="driver_counts"} 1200.0',
+    'spark_stream_input_rows{query="other \\"query\\""} 5.0',
+    "# TYPE spark_stream_watermark_lag_ms gauge",
+    'spark_stream_watermark_lag_ms{query="driver_counts"} 10000.0',
+  ]) + "\n"
+  assert not (tmp_path / "stream.prom.tmp").exists()
+
+
+def test_emf_sink(tmp_path, monkeypatch):
+  monkeypatch.setattr(stream_metrics.time, "time", lambda: 1704067260.5)
+  path = tmp_path / "stream.emf"
+  sink = stream_metrics.EmfSink(str(path))
+  metrics = {"input_rows": (1200, "Count"), "watermark_lag_ms": (10000, "Milliseconds")}
+  sink.emit(PROGRESS, metrics)
+  sink.emit(PROGRESS, metrics)
+  records = [json.loads(line) for line in path.read_text().splitlines()]
+  assert len(records) == 2
+  assert records[0] == {
+    "_aws": {"Timestamp": 1704067260500, "CloudWatchMetrics": [{"Namespace": "EMRStreaming", "Dimensions": [["query"]],
+      "Metrics": [{"Name": "input_rows", "Unit": "Count"}, {"Name": "watermark_lag_ms", "Unit": "Milliseconds"}]}]},
+    "query": "driver_counts", "batchId": 7, "input_rows": 1200, "watermark_lag_ms": 10000}
+
+
+def test_sinks_from_spec_and_failing_sinks(tmp_path, capsys):
+  sinks = stream_metrics.sinks_from_spec("prom:{}, emf".format(tmp_path / "x.prom"))
+  assert [type(s) for s in sinks] == [stream_metrics.PrometheusTextSink, stream_metrics.EmfSink]
+  assert sinks[1].path == "stdout"
+  with pytest.raises(ValueError):
+    stream_metrics.sinks_from_spec("statsd:localhost")
+  # a sink that can't write doesn't stop the others
+  broken = stream_metrics.PrometheusTextSink(str(tmp_path / "missing" / "x.prom"))
+  stream_metrics.ProgressExporter([broken, sinks[1]]).export(PROGRESS)
+  out, err = capsys.readouterr()
+  assert json.loads(out)["input_rows"] == 1200 and "PrometheusTextSink failed" in err
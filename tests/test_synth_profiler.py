@@ -0,0 +1,55 @@
+import io
+import types
+
+import pytest
+
+pytest.importorskip("aws_cdk")
+
+from aws_cdk import App
+from constructs import Construct
+
+from lib.util import synth_profiler
+
+
+@pytest.fixture
+def profiler(monkeypatch):
+  monkeypatch.setattr(synth_profiler, "CONSTRUCT_MODULES", ("lib.", "timed."))
+  profiler = synth_profiler.SynthProfiler(out=io.StringIO())
+  yield profiler
+  # install() hooks every later subclass of Construct
+  if "__init_subclass__" in vars(Construct):
+    del Construct.__init_subclass__
+
+
+def define(module_name):
+  """A Construct subclass with a child, defined in module_name as if that module was imported now."""
+  module = types.ModuleType(module_name)
+  exec("from constructs import Construct\n"
+    "class Child(Construct):\n"
+    "  def __init__(self, scope, id):\n"
+    "    super().__init__(scope, id)\n"
+    "class Parent(Construct):\n"
+    "  def __init__(self, scope, id):\n"
+    "    super().__init__(scope, id)\n"
+    "    Child(self, 'child')\n", module.__dict__)
+  return module
+
+
+def test_constructs_defined_after_install_are_timed(profiler):
+  profiler.install()
+  # e.g. a construct module imported inside a stack's __init__, after the stack module was loaded
+  timed = define("timed.constructs")
+  timed.Parent(App(), "parent")
+  define("other.constructs").Parent(App(), "untimed")
+  assert [name for kind, name, _ in profiler.timings if kind == "construct"] == ["parent/child (Child)", "parent (Parent)"]
+
+
+def test_phases_are_recorded_before_the_profiler_is_enabled(profiler):
+  with profiler.phase("import", "aws_cdk"):
+    pass
+  profiler.report()
+  assert profiler.out.getvalue() == ""
+  # enabled later, e.g. by -c profile_synth once aws_cdk is imported, the import is still reported
+  profiler.enabled = True
+  profiler.report()
+  assert "aws_cdk" in profiler.out.getvalue()
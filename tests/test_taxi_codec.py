@@ -0,0 +1,46 @@
+import pytest
+
+import taxi_codec
+
+RIDE = taxi_codec.parse_ride_line(
+  "7,START,2013-01-01 00:05:00,2013-01-01 00:00:00,-73.866135,40.77109,-73.961334,40.764563,6,2013000108,2013000108")
+RIDE = RIDE[:4] + tuple(taxi_codec.to_float32(v) for v in RIDE[4:8]) + RIDE[8:]
+COUNT = (2013000108, 1356998400000, 1356998410000, 3)
+
+
+@pytest.mark.parametrize("codec", taxi_codec.CODECS)
+def test_ride_round_trip(codec):
+  assert taxi_codec.ride_decoder(codec)(taxi_codec.ride_encoder(codec)(RIDE)) == RIDE
+
+
+@pytest.mark.parametrize("codec", taxi_codec.CODECS)
+def test_count_round_trip(codec):
+  assert taxi_codec.count_decoder(codec)(taxi_codec.count_encoder(codec)(COUNT)) == COUNT
+
+
+def test_fixed_codec_rejects_fares():
+  with pytest.raises(ValueError):
+    taxi_codec.fare_encoder("fixed")
+
+
+def test_codecs_round_trip_in_spark(spark):
+  import msk_benchmark
+  results = msk_benchmark.bench_codecs(spark, 200)
+  for codec in ("csv", "json", "fixed"):
+    assert results[codec]["round_trip_ok"], results
+  # avro and protobuf only without their packages on the class path
+  for codec in ("avro", "protobuf"):
+    assert results[codec].get("round_trip_ok") or "skipped" in results[codec], results
+
+
+def test_fixed_timestamps_ignore_the_session_time_zone(spark):
+  from msk_consumer import parse_data_from_kafka_message, taxiRidesSchema
+  previous = spark.conf.get("spark.sql.session.timeZone")
+  spark.conf.set("spark.sql.session.timeZone", "America/New_York")
+  try:
+    payloads = spark.createDataFrame([(taxi_codec.ride_encoder("fixed")(RIDE),)], "value binary")
+    parsed, _ = parse_data_from_kafka_message(payloads, taxiRidesSchema, "fixed")
+    millis = parsed.selectExpr("unix_millis(endTime)", "unix_millis(startTime)").first()
+  finally:
+    spark.conf.set("spark.sql.session.timeZone", previous)
+  assert tuple(millis) == RIDE[2:4]
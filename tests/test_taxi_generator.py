@@ -0,0 +1,46 @@
+import gzip
+
+import numpy as np
+import pytest
+
+import taxi_codec
+import taxi_generator
+
+BLOCK_RIDES = 2000
+ROWS = 3 * BLOCK_RIDES + 1234
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+  # END events and late records carry over several blocks
+  monkeypatch.setattr(taxi_generator, "BLOCK_RIDES", BLOCK_RIDES)
+
+
+def generator():
+  return taxi_generator.RideGenerator(seed=11, drivers=500, skew=1.2, disorder_seconds=30, late_rate=0.01)
+
+
+def test_outputs_hold_the_same_records_for_a_seed(tmp_path):
+  rides = list(generator().rides(ROWS))
+  lines = "".join(generator().csv_lines(ROWS)).splitlines()
+  path = str(tmp_path / "rides.csv.gz")
+  generator().write_csv(path, ROWS)
+  with gzip.open(path, "rt") as f:
+    written = f.read().splitlines()
+  assert len(rides) == ROWS
+  assert written == lines
+  assert [taxi_codec.parse_ride_line(line) for line in lines] == rides
+
+
+@pytest.mark.parametrize("chunk", [1, 999, 5000, 10 ** 6])
+def test_records_do_not_depend_on_the_chunk_size(chunk):
+  expected = next(generator().chunks(ROWS, ROWS))
+  chunks = list(generator().chunks(ROWS, chunk))
+  assert all(len(c["rideId"]) == chunk for c in chunks[:-1])
+  for name, column in expected.items():
+    assert np.array_equal(np.concatenate([c[name] for c in chunks]), column), name
+
+
+def test_records_are_emitted_in_emit_time_order():
+  emit = np.concatenate([c["emitTime"] for c in generator().chunks(ROWS, 5000)])
+  assert (np.diff(emit) >= 0).all()